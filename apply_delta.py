@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import logging
+import shutil
+import sys
+from argparse import ArgumentParser
+from processors.delta import apply_delta, list_bundles
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Merge bundles written by '
+                                    '`process_all.py --export` into a copy '
+                                    'of the output.')
+    ap.add_argument('bundles',
+                    help='A bundle, or a directory of bundles for one '
+                         'dataset.')
+    ap.add_argument('output_dir',
+                    help='Directory holding the copy of the dataset’s '
+                         'output.')
+    ap.add_argument('--remove', action='store_true',
+                    help='Delete each bundle once it has been applied.')
+    args = ap.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO,
+                        stream=sys.stdout)
+
+    for bundle in list_bundles(args.bundles):
+        apply_delta(bundle, args.output_dir)
+        if args.remove:
+            shutil.rmtree(bundle)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.reader import OutputReader  # noqa: E402
+from synthetic import make_trajectory_output, make_vector_output  # noqa: E402
+
+# Keyword arguments of make_vector_output() for each layout of /spectra.
+VECTOR_LAYOUTS = {
+    'family': {'driver': 'family'},
+    'single': {'driver': None},
+    'row-chunks': {'driver': None, 'chunks': 'rows'},
+    'contiguous': {'driver': None, 'chunks': None},
+    'lzf': {'driver': None, 'chunks': 'rows', 'compression': 'lzf'},
+}
+TRAJECTORY_LAYOUTS = {
+    'groups': {},
+    'packed': {'packed': True},
+}
+# Metadata queries like those of DEVAS Web’s filter controls.
+QUERIES = [
+    {'Number': 0},
+    {'Projects': 'MARS'},
+    {'Sample': ['S1', 'S2', 'S3'], 'Number': lambda n: n > 0},
+    {'DistToTarget': lambda d: d < 3, 'e_SiO2': lambda c: c > 40},
+]
+
+
+def io_counters():
+    """
+    Returns
+    -------
+        Bytes this process has asked to read so far, and bytes actually
+        read from storage, from Linux’s `/proc/self/io`, or zeros if it
+        is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except OSError:
+        return 0, 0
+    return int(fields['rchar']), int(fields['read_bytes'])
+
+
+def evict(output_dir):
+    """
+    Ask the OS to drop an output’s files from its page cache, so that
+    the next read comes from storage.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory holding the output.
+    """
+    for name in os.listdir(output_dir):
+        fd = os.open(os.path.join(output_dir, name), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def measure(operation, arguments, before=None):
+    """
+    Time an operation once for each argument.
+
+    Parameters
+    ----------
+    operation
+        Function of one argument.
+    arguments : list
+        Arguments to call it with.
+    before
+        Function of one argument, called before each timed call.
+
+    Returns
+    -------
+        A list of latencies in seconds and the mean bytes requested and
+        read from storage per call.
+    """
+    times = []
+    requested = read = 0
+    for argument in arguments:
+        if before:
+            before(argument)
+        counters = io_counters()
+        tic = perf_counter()
+        operation(argument)
+        times.append(perf_counter() - tic)
+        after = io_counters()
+        requested += after[0] - counters[0]
+        read += after[1] - counters[1]
+    return times, requested / len(arguments), read / len(arguments)
+
+
+def load_all(output_dir):
+    """
+    Load a vector output’s whole spectra matrix and metadata table, as
+    DEVAS Web does when it opens a dataset.
+    """
+    with OutputReader(output_dir, cache_size=0) as reader:
+        reader.spectra()
+        for column in reader.metadata().values():
+            np.array(column)
+
+
+def vector_workloads(output_dir, repeats, fetches, rng):
+    """
+    Parameters
+    ----------
+    output_dir : string
+        Directory holding a vector output.
+    repeats : int
+        Number of full-matrix loads.
+    fetches : int
+        Number of single-ID fetches.
+    rng
+        Random number generator.
+
+    Returns
+    -------
+        A dict of workload name to result of `measure()`.
+    """
+    results = {
+        'full (cold)': measure(load_all, [output_dir] * repeats,
+                               before=evict),
+        'full (warm)': measure(load_all, [output_dir] * repeats),
+    }
+    with OutputReader(output_dir, cache_size=0) as reader:
+        ids = np.unique(reader.meta[reader.key_field()][:reader.rows])
+        order = rng.choice(ids, fetches)
+        evict(output_dir)
+        results['fetch (cold)'] = measure(
+            reader.fetch, order[:max(1, fetches // 10)],
+            before=lambda id: evict(output_dir))
+        results['fetch (warm)'] = measure(reader.fetch, order)
+
+    def query(conditions):
+        with OutputReader(output_dir, cache_size=0) as reader:
+            reader.select(**conditions)
+    results['filter'] = measure(query, QUERIES * repeats)
+    return results
+
+
+def trajectory_workloads(output_dir, fetches, rng):
+    """
+    Parameters
+    ----------
+    output_dir : string
+        Directory holding a trajectory output, in either layout.
+    fetches : int
+        Number of lookups.
+    rng
+        Random number generator.
+
+    Returns
+    -------
+        A dict of workload name to result of `measure()`.
+    """
+    with OutputReader(output_dir, cache_size=0) as reader:
+        ids = reader.meta[reader.key_field()][:reader.rows]
+        order = rng.choice(ids, fetches)
+        if 'spectra_packed' in reader.fh:
+            packed = reader.fh['spectra_packed']
+            offsets = reader.fh['spectra_offsets'][()]
+
+            def lookup(id):
+                row = reader.locate(id)[0]
+                return packed[offsets[row]:offsets[row + 1]]
+        else:
+            lookup = reader.spectrum
+        evict(output_dir)
+        return {
+            'lookup (cold)': measure(lookup, order[:max(1, fetches // 10)],
+                                     before=lambda id: evict(output_dir)),
+            'lookup (warm)': measure(lookup, order),
+        }
+
+
+def report(workload, layout, result):
+    times, requested, read = result
+    p50, p90, p99 = np.percentile(np.array(times) * 1000, (50, 90, 99))
+    print(f'{workload:14} {layout:11} {len(times):5d} {p50:10.3f} '
+          f'{p90:10.3f} {p99:10.3f} {requested / 2**20:10.2f} '
+          f'{read / 2**20:10.2f}')
+
+
+def run(work_dir, args):
+    """
+    Generate any missing outputs in `work_dir` and run every workload
+    on each layout.
+    """
+    rng = np.random.default_rng(args.seed)
+    print(f'{"workload":14} {"layout":11} {"n":>5} {"p50 ms":>10} '
+          f'{"p90 ms":>10} {"p99 ms":>10} {"MiB req":>10} {"MiB disk":>10}')
+    for layout in args.layouts:
+        output_dir = os.path.join(work_dir, layout)
+        if layout in VECTOR_LAYOUTS:
+            if not os.path.isdir(output_dir):
+                make_vector_output(output_dir, args.ids, args.shots,
+                                   args.channels, seed=args.seed,
+                                   **VECTOR_LAYOUTS[layout])
+            results = vector_workloads(output_dir, args.repeats,
+                                       args.fetches, rng)
+        else:
+            if not os.path.isdir(output_dir):
+                make_trajectory_output(output_dir, args.trajectories,
+                                       args.points, seed=args.seed,
+                                       **TRAJECTORY_LAYOUTS[layout])
+            results = trajectory_workloads(output_dir, args.fetches, rng)
+        for workload, result in results.items():
+            report(workload, layout, result)
+
+
+if __name__ == '__main__':
+    layouts = list(VECTOR_LAYOUTS) + list(TRAJECTORY_LAYOUTS)
+    ap = ArgumentParser(description='Measure DEVAS Web’s read patterns on '
+                                    'synthetic outputs in several layouts.')
+    ap.add_argument('--layouts', nargs='+', choices=layouts, default=layouts,
+                    help='Layouts to measure (default: all).')
+    ap.add_argument('--work-dir',
+                    help='Keep the generated outputs here and reuse them '
+                         'on later runs; by default they are deleted.')
+    ap.add_argument('--ids', type=int, default=200,
+                    help='IDs in the vector outputs.')
+    ap.add_argument('--shots', type=int, default=50,
+                    help='Rows per ID in the vector outputs.')
+    ap.add_argument('--channels', type=int, default=6144,
+                    help='Channels in the vector outputs.')
+    ap.add_argument('--trajectories', type=int, default=5000,
+                    help='Spectra in the trajectory outputs.')
+    ap.add_argument('--points', type=int, default=1000,
+                    help='Typical points per trajectory spectrum.')
+    ap.add_argument('--repeats', type=int, default=5,
+                    help='Full loads, and rounds of filter queries.')
+    ap.add_argument('--fetches', type=int, default=1000,
+                    help='Single-ID fetches or lookups (a tenth of them '
+                         'cold).')
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    if args.work_dir:
+        run(args.work_dir, args)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(tmp, args)
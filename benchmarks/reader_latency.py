@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.reader import OutputReader  # noqa: E402
+from synthetic import make_vector_output  # noqa: E402
+
+
+def percentiles(times):
+    """
+    Parameters
+    ----------
+    times : list
+        Latencies in seconds.
+
+    Returns
+    -------
+        A string of the 50th, 90th and 99th percentiles in ms.
+    """
+    p50, p90, p99 = np.percentile(np.array(times) * 1000, (50, 90, 99))
+    return f'p50 {p50:8.3f}  p90 {p90:8.3f}  p99 {p99:8.3f} ms'
+
+
+def run(output_dir, fetches, cache_sizes, skew, seed=0):
+    """
+    Times fetching random IDs from an output, first uniformly and then
+    with a Zipf-like skew towards a few popular IDs, for each cache
+    size.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory holding the output.
+    fetches : int
+        Number of fetches per measurement.
+    cache_sizes : list
+        Reader cache sizes in MiB.
+    skew : float
+        Exponent of the skewed ID popularity.
+    seed : int
+        Random seed.
+    """
+    rng = np.random.default_rng(seed)
+    tic = perf_counter()
+    with OutputReader(output_dir, cache_size=0) as reader:
+        opened = perf_counter() - tic
+        ids = np.array(list(dict.fromkeys(
+            reader.meta[reader.key_field()][:reader.rows].tolist())))
+        print(f'{len(ids)} IDs in {reader.rows} rows; '
+              f'opened in {opened * 1000:.1f} ms')
+    weights = 1 / np.arange(1, len(ids) + 1) ** skew
+    patterns = {
+        'uniform': rng.choice(ids, fetches),
+        'skewed': rng.choice(ids, fetches, p=weights / weights.sum()),
+    }
+    for cache_size in cache_sizes:
+        for name, order in patterns.items():
+            with OutputReader(output_dir, cache_size=cache_size) as reader:
+                times = []
+                for id in order:
+                    tic = perf_counter()
+                    reader.fetch(id)
+                    times.append(perf_counter() - tic)
+                cache = reader.cache
+                lookups = cache.hits + cache.misses
+                hits = cache.hits / lookups if lookups else 0
+            print(f'cache {cache_size:6g} MiB  {name:8}  '
+                  f'{percentiles(times)}  hits {hits:6.1%}')
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Measure the latency of fetching '
+                                    'spectra by ID with OutputReader.')
+    ap.add_argument('output_dir', nargs='?',
+                    help='Output to read; by default, a synthetic LIBS-like '
+                         'output is generated in a temporary directory.')
+    ap.add_argument('--ids', type=int, default=2000,
+                    help='IDs in the synthetic output.')
+    ap.add_argument('--shots', type=int, default=50,
+                    help='Rows per ID in the synthetic output.')
+    ap.add_argument('--channels', type=int, default=6144,
+                    help='Channels in the synthetic output.')
+    ap.add_argument('--fetches', type=int, default=2000,
+                    help='Fetches per measurement.')
+    ap.add_argument('--cache', type=float, nargs='+', default=[0, 64, 512],
+                    metavar='MB', help='Reader cache sizes to compare.')
+    ap.add_argument('--skew', type=float, default=1.1,
+                    help='Zipf exponent of the skewed access pattern.')
+    args = ap.parse_args()
+
+    if args.output_dir:
+        run(args.output_dir, args.fetches, args.cache, args.skew)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            make_vector_output(tmp, args.ids, args.shots, args.channels)
+            run(tmp, args.fetches, args.cache, args.skew)
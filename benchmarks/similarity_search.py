@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.reader import OutputReader  # noqa: E402
+from processors.similarity import similarity_config  # noqa: E402
+from processors.similarity import unit_rows, update_similarity  # noqa: E402
+from processors.state import PATH_DEFAULTS, hdf5_options  # noqa: E402
+from synthetic import make_vector_output  # noqa: E402
+
+
+def peaks(rng, count, channels, lines=40):
+    """
+    Returns
+    -------
+        `count` LIBS-like spectra of narrow emission lines at random
+        channels over a sloping continuum.
+    """
+    x = np.arange(channels)
+    spectra = np.empty((count, channels))
+    for row in spectra:
+        centres = rng.integers(0, channels, lines)
+        heights = rng.exponential(1, lines)
+        row[:] = 0.2 * (1 - x / channels)
+        for centre, height in zip(centres, heights):
+            lo, hi = max(centre - 12, 0), min(centre + 13, channels)
+            row[lo:hi] += height * np.exp(-0.5 * ((x[lo:hi] - centre) / 3)
+                                          ** 2)
+    return spectra
+
+
+def fill_clustered(output_dir, shots, dims, seed):
+    """
+    Replaces the random spectra of a synthetic output with noisy shots
+    of one spectrum per ID, so that each ID’s shots are each other’s
+    nearest neighbours, and indexes them.
+    """
+    rng = np.random.default_rng(seed)
+    prefix = PATH_DEFAULTS['output_prefix']
+    filepath = os.path.join(output_dir, prefix + '.%03d.hdf5')
+    with h5py.File(filepath, 'a', libver='latest',
+                   **hdf5_options(filepath, 'family')) as fh:
+        dset = fh['spectra']
+        rows, channels = dset.shape
+        for start in range(0, rows, shots * 50):
+            stop = min(start + shots * 50, rows)
+            templates = peaks(rng, (stop - start) // shots, channels)
+            data = np.repeat(templates, shots, axis=0)
+            data *= rng.normal(1, 0.1, (len(data), 1))
+            data += rng.normal(0, 0.02, data.shape)
+            dset[start:stop] = data
+        update_similarity(fh, similarity_config({'dims': dims}), rows)
+
+
+def percentiles(times):
+    p50, p90 = np.percentile(np.array(times) * 1000, (50, 90))
+    return f'p50 {p50:9.3f}  p90 {p90:9.3f} ms'
+
+
+def run(output_dir, queries, k, candidates, seed=0):
+    """
+    Times top-k cosine similarity queries by a scan of the whole
+    spectra matrix, held in memory as DEVAS Web does, and through the
+    similarity index with several numbers of candidates, and reports
+    how many of the scan’s top k each finds.
+    """
+    rng = np.random.default_rng(seed)
+    with OutputReader(output_dir, cache_size=0) as reader:
+        tic = perf_counter()
+        stored = reader.spectra()
+        matrix = unit_rows(stored)
+        print(f'{reader.rows} rows of {matrix.shape[1]} channels; '
+              f'loaded and normalized in {perf_counter() - tic:.2f} s; '
+              f'index of {reader.vectors.shape[1]} dimensions')
+        picks = rng.integers(0, reader.rows, queries)
+        noise = rng.normal(0, 0.02, (queries, matrix.shape[1]))
+        spectra = stored[picks] + noise
+        times, truth = [], []
+        for spectrum in spectra:
+            tic = perf_counter()
+            scores = matrix @ unit_rows(spectrum[None])[0]
+            truth.append(np.argpartition(-scores, k - 1)[:k])
+            times.append(perf_counter() - tic)
+        print(f'{"scan":>16}  {percentiles(times)}')
+        for count in candidates:
+            times, found = [], 0
+            for spectrum, best in zip(spectra, truth):
+                tic = perf_counter()
+                rows = reader.similar(spectrum, k, count)[1]
+                times.append(perf_counter() - tic)
+                found += len(np.intersect1d(rows, best))
+            print(f'{count:6d} candidates  {percentiles(times)}  '
+                  f'recall {found / (k * queries):6.1%}')
+
+
+if __name__ == '__main__':
+    ap = ArgumentParser(description='Compare top-k spectral matching '
+                                    'through the similarity index with a '
+                                    'scan of the spectra matrix.')
+    ap.add_argument('--ids', type=int, default=500,
+                    help='IDs in the synthetic output.')
+    ap.add_argument('--shots', type=int, default=20,
+                    help='Rows per ID in the synthetic output.')
+    ap.add_argument('--channels', type=int, default=6144,
+                    help='Channels in the synthetic output.')
+    ap.add_argument('--dims', type=int, default=64,
+                    help='Dimensions of the similarity index.')
+    ap.add_argument('--queries', type=int, default=200)
+    ap.add_argument('-k', type=int, default=10,
+                    help='Matches per query.')
+    ap.add_argument('--candidates', type=int, nargs='+',
+                    default=[10, 40, 200],
+                    help='Rows ranked exactly per query.')
+    ap.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_vector_output(tmp, args.ids, args.shots, args.channels,
+                           seed=args.seed)
+        fill_clustered(tmp, args.shots, args.dims, args.seed)
+        run(tmp, args.queries, args.k, args.candidates, args.seed)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.compact import CHUNK_BYTES  # noqa: E402
+from processors.index import create_index  # noqa: E402
+from processors.state import PATH_DEFAULTS, hdf5_options  # noqa: E402
+
+
+def make_vector_output(output_dir, ids=2000, shots=50, channels=6144,
+                       driver='family', member_size=None, chunks=True,
+                       compression=None, seed=0):
+    """
+    Writes a synthetic LIBS-like output the way `_VectorProcessor`
+    does: one row per shot (plus a mean spectrum) in a growable
+    `/spectra`, with `/committed`, the ID index, and a metadata file.
+    Other layouts of `/spectra` can be chosen for comparison.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory to write to; created if needed.
+    ids : int
+        Number of spectra files (IDs).
+    shots : int
+        Rows per ID.
+    channels : int
+        Values per row.
+    driver : string
+        'family' or None.
+    member_size : float
+        Family member size in MiB.
+    chunks
+        True for h5py’s automatic chunks, as `write_data()` uses;
+        'rows' for chunks of about 1 MiB of whole rows, as compaction
+        writes; None for a contiguous, fixed-size dataset.
+    compression : string
+        HDF5 filter for chunked layouts, such as 'lzf' or 'gzip'.
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+        The metadata, as a dict of column name to array.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    prefix = PATH_DEFAULTS['output_prefix']
+    suffix = '.hdf5' if driver is None else '.%03d.hdf5'
+    filepath = os.path.join(output_dir, prefix + suffix)
+    names = np.array([f'sample{i % 97:02d}_{i:06d}' for i in range(ids)])
+    meta = {
+        'Name': np.repeat(names, shots),
+        'Number': np.tile(np.arange(shots), ids),
+        'Sample': np.repeat(np.array([f'S{i % 97}' for i in range(ids)]),
+                            shots),
+        'Carousel': np.repeat(rng.integers(1, 8, ids), shots),
+        'DistToTarget': np.repeat(rng.uniform(1.5, 7, ids), shots),
+        'Projects': np.repeat(rng.choice(['MARS', 'MHC', 'BORATE'], ids),
+                              shots).astype(object),
+    }
+    for element in ('SiO2', 'TiO2', 'Al2O3', 'FeOT', 'MgO', 'CaO'):
+        meta[f'e_{element}'] = np.repeat(rng.uniform(0, 60, ids), shots)
+    batch = max(1, 500 // shots) * shots
+    rows = ids * shots
+    with h5py.File(filepath, 'w', libver='latest',
+                   **hdf5_options(filepath, driver, member_size)) as fh:
+        if chunks is None:
+            dset = fh.create_dataset('spectra', shape=(rows, channels),
+                                     dtype=float)
+        else:
+            if chunks == 'rows':
+                chunks = (max(1, CHUNK_BYTES // (channels * 8)), channels)
+            dset = fh.create_dataset('spectra', shape=(0, channels),
+                                     dtype=float, chunks=chunks,
+                                     compression=compression,
+                                     maxshape=(None, channels))
+        for start in range(0, rows, batch):
+            stop = min(start + batch, rows)
+            if dset.maxshape[0] is None:
+                dset.resize(stop, axis=0)
+            dset[start:stop] = rng.random((stop - start, channels))
+        fh.create_dataset('committed', data=rows)
+        create_index(fh, 'Name', meta['Name'])
+    np.savez(os.path.join(output_dir, prefix + '_meta.npz'), **meta)
+    return meta
+
+
+def make_trajectory_output(output_dir, ids=2000, points=1000, packed=False,
+                           seed=0):
+    """
+    Writes a synthetic Raman-like output the way `_TrajectoryProcessor`
+    does: one `/spectra/<id>` dataset of (x, y) pairs per spectrum.
+    Alternatively, all spectra can be packed end to end in
+    `/spectra_packed`, with `/spectra_offsets[i]` the first point of the
+    spectrum in metadata row i, for comparison.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory to write to; created if needed.
+    ids : int
+        Number of spectra.
+    points : int
+        Typical number of points per spectrum.
+    packed : bool
+        Whether to pack the spectra into one dataset.
+    seed : int
+        Random seed.
+
+    Returns
+    -------
+        The metadata, as a dict of column name to array.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    prefix = PATH_DEFAULTS['output_prefix']
+    meta = {
+        'spectrum_number': np.array([f'R{i:06d}' for i in range(ids)]),
+        'sample': np.array([f'S{i % 97}' for i in range(ids)]),
+        'laser': rng.choice([532, 785, 1064], ids),
+    }
+    filepath = os.path.join(output_dir, prefix + '.hdf5')
+    spectra = []
+    for id in meta['spectrum_number']:
+        n = int(points * rng.uniform(0.5, 1.5))
+        x = np.sort(rng.uniform(100, 2000, n))
+        spectra.append(np.column_stack((x, rng.random(n))))
+    with h5py.File(filepath, 'w', libver='latest') as fh:
+        if packed:
+            offsets = np.cumsum([0] + [len(s) for s in spectra])
+            fh.create_dataset('spectra_packed', data=np.vstack(spectra),
+                              chunks=True)
+            fh.create_dataset('spectra_offsets', data=offsets)
+        else:
+            for id, spectrum in zip(meta['spectrum_number'], spectra):
+                fh.create_dataset(f'/spectra/{id}', data=spectrum)
+        fh.create_dataset('committed', data=ids)
+        create_index(fh, 'spectrum_number', meta['spectrum_number'])
+    np.savez(os.path.join(output_dir, prefix + '_meta.npz'), **meta)
+    return meta
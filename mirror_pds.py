@@ -2,15 +2,31 @@
 
 import logging
 import os
+import processors
+import queue
+import threading
 import yaml
 from argparse import ArgumentParser
 from datetime import datetime
 from process_all import GLOBAL_CONFIG, logging_setup
+from processors.mirror import Mirror
+from processors.state import resolve_paths
+from time import monotonic
 from urllib.parse import urlunsplit
 
 
-# TODO: this should be moved into processors/_base.py.
-def download(dataset):
+def download(dataset, importer=None):
+    """
+    Download the masterfile and data files of an MSL dataset.
+
+    Parameters
+    ----------
+    dataset : dict
+        Dataset configuration with a `download` section.
+    importer : MSLProcessor
+        If given, each data file is processed as soon as it arrives
+        instead of waiting for `process_all.py`.
+    """
     if "download" not in dataset:
         return
     d = dataset["download"]
@@ -24,17 +40,29 @@ def download(dataset):
     logging.info(f'Running {dataset["name"]} dataset; starting download')
     start_time = datetime.now()
     backup_stamp = start_time.isoformat(timespec="seconds")
-    os.system(f'mv {meta_path} {meta_path}.{os.getpid()}.{backup_stamp}')
-
-    # If overwrite is needed, turn xfer:clobber on (see lftp docs).
-    lftp_commands = [
-        f'"get1 document/{meta_file} -o {meta_path}"',
-        f'"mirror -c -I cl5_*ccs_*.csv --no-empty-dirs data {data_dir}"',
-    ]
-    for lftp_command in lftp_commands:
-        executable = f'/usr/bin/lftp -e {lftp_command} {remote}'
-        logging.debug(executable)
-        os.system(executable)
+    # Manifests live beside the state file, outside the data directory.
+    mirror = Mirror(remote, workers=d.get("workers", 8),
+                    state_dir=resolve_paths(dataset)["output"])
+
+    # The previous masterfile is kept only if a new one was downloaded.
+    mirror.fetch_file(f'document/{meta_file}', meta_path,
+                      backup_suffix=f'.{os.getpid()}.{backup_stamp}')
+    pattern = d.get("pattern", "cl5_*ccs_*.csv")
+    if "index" in d:
+        index = dict(d["index"])
+        index_path = index.pop("path")
+        local_index = os.path.join(base_dir, os.path.basename(index_path))
+
+        def fetch(on_complete=None):
+            mirror.sync_index(index_path, local_index, "data", data_dir,
+                              pattern, on_complete, **index)
+    else:
+        def fetch(on_complete=None):
+            mirror.mirror("data", data_dir, pattern, on_complete)
+    if importer is None:
+        fetch()
+    else:
+        pipeline(fetch, importer, linger=d.get("linger", 10))
 
     time_diff = (datetime.now() - start_time).total_seconds()
     logging.info(f'Download finished after {time_diff} sec')
@@ -42,15 +70,72 @@ def download(dataset):
     return
 
 
+def pipeline(fetch, importer, linger=10):
+    """
+    Download data files in a background thread while processing the
+    files it completes, in batches of up to `importer.batch_size`
+    files or whatever has arrived `linger` seconds after the first.
+
+    Parameters
+    ----------
+    fetch : function
+        Downloads the data files, calling its `on_complete` argument
+        with the path of each new or updated file.
+    importer : MSLProcessor
+        Processor for the dataset, with its masterfile already current.
+    linger : float
+        Maximum seconds to wait for a batch to fill.
+    """
+    arrived = queue.Queue()
+    finished = threading.Event()
+    errors = []
+
+    def run_mirror():
+        try:
+            fetch(on_complete=arrived.put)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            finished.set()
+
+    thread = threading.Thread(target=run_mirror, name='mirror')
+    thread.start()
+    importer.ensure_metadata()
+    try:
+        while not (finished.is_set() and arrived.empty()):
+            try:
+                batch = [arrived.get(timeout=1)]
+            except queue.Empty:
+                continue
+            deadline = monotonic() + linger
+            while len(batch) < importer.batch_size:
+                try:
+                    batch.append(arrived.get(
+                        timeout=max(0, deadline - monotonic())))
+                except queue.Empty:
+                    break
+            importer.ingest(batch)
+        thread.join()
+        if errors:
+            raise errors[0]
+        # Catch up on files downloaded by earlier, interrupted runs.
+        importer.main()
+    finally:
+        importer.close()
+
+
 if __name__ == '__main__':
     script_dir = os.path.dirname(__file__)
     ap = ArgumentParser()
     ap.add_argument('--config', type=open,
                     default=os.path.join(script_dir, 'config.yml'),
                     help='YAML file with configuration options.')
+    ap.add_argument('--process', action='store_true',
+                    help='Process each file as soon as it is downloaded.')
     args = ap.parse_args()
     config = yaml.safe_load(args.config)
     config.setdefault('chunk_size', 500)
+    config.setdefault('catalog', None)
 
     logging_setup(config['logging'])
 
@@ -59,4 +144,9 @@ if __name__ == '__main__':
     for dataset in datasets:
         for attr in GLOBAL_CONFIG:
             dataset[attr] = config[attr]
-        download(dataset)
+        importer = None
+        if args.process and 'download' in dataset:
+            batch_size = dataset['download'].get('batch_size', 100)
+            importer = processors.MSLProcessor(**dataset, keep_open=True,
+                                               batch_size=batch_size)
+        download(dataset, importer)
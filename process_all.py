@@ -2,15 +2,15 @@
 
 import logging
 import os
+import processors
 import sys
 import yaml
 from argparse import ArgumentParser
-from processors import LIBSProcessor
-from processors import MossbauerImporter
-from processors import RamanImporter
-from processors import MSLProcessor
+from processors.masterfiles import MasterfileRegistry
+from processors.state import file_fingerprint, input_fingerprint, \
+    load_state, resolve_paths, save_state
 
-GLOBAL_CONFIG = ['root_dir', 'chunk_size']
+GLOBAL_CONFIG = ['root_dir', 'chunk_size', 'catalog']
 
 
 def logging_setup(log_cfg):
@@ -32,25 +32,109 @@ def logging_setup(log_cfg):
     logging.basicConfig(**log_cfg)
 
 
+def is_unchanged(dataset, fingerprint):
+    """
+    Checks whether a dataset’s inputs and output are exactly as they
+    were after its last run.
+
+    Parameters
+    ----------
+    dataset : dict
+        Dataset configuration.
+    fingerprint : string
+        Current result of `input_fingerprint(dataset)`.
+
+    Returns
+    -------
+        True if there is nothing to do for the dataset.
+    """
+    paths = resolve_paths(dataset)
+    saved = load_state(paths['state']).get('inputs')
+    return saved == {
+        'fingerprint': fingerprint,
+        'meta_output': file_fingerprint(paths['meta_output']),
+    }
+
+
+def save_fingerprint(dataset, fingerprint):
+    """
+    Records a dataset’s inputs and output after a successful run.
+
+    Parameters
+    ----------
+    dataset : dict
+        Dataset configuration.
+    fingerprint : string
+        Result of `input_fingerprint(dataset)` from before the run.
+    """
+    paths = resolve_paths(dataset)
+    if not os.path.isdir(paths['output']):
+        return
+    state = load_state(paths['state'])
+    state['inputs'] = {
+        'fingerprint': fingerprint,
+        'meta_output': file_fingerprint(paths['meta_output']),
+    }
+    save_state(paths['state'], state)
+
+
 if __name__ == '__main__':
     script_dir = os.path.dirname(__file__)
     ap = ArgumentParser()
     ap.add_argument('--config', type=open,
                     default=os.path.join(script_dir, 'config.yml'),
                     help='YAML file with configuration options.')
+    ap.add_argument('--refresh-metadata', action='store_true',
+                    help='Update existing output from changed masterfiles.')
+    ap.add_argument('--force', action='store_true',
+                    help='Check every dataset even if its inputs have not '
+                         'changed since the last run.')
+    ap.add_argument('--watch', action='store_true',
+                    help='Keep running and process new files as they '
+                         'arrive.')
+    ap.add_argument('--rebuild', action='store_true',
+                    help='Rebuild each dataset’s output from scratch in '
+                         'parallel shards.')
+    ap.add_argument('--coordinate', action='store_true',
+                    help='Queue each dataset’s new files for --work '
+                         'processes on any host, and merge their results.')
+    ap.add_argument('--work', action='store_true',
+                    help='Process files queued by --coordinate until there '
+                         'are none left.')
+    ap.add_argument('--workers', type=int,
+                    help='Number of processes for --rebuild (default: '
+                         'number of CPUs).')
+    ap.add_argument('--compact', action='store_true',
+                    help='Rewrite each dataset’s spectra output without '
+                         'unused space.')
+    ap.add_argument('--member-size', type=float, metavar='MB',
+                    help='Family member size in MiB for --compact.')
+    ap.add_argument('--export', metavar='DIR',
+                    help='After processing, write the output added since '
+                         'the last export to DIR/<dataset>/ for '
+                         'apply_delta.py.')
     args = ap.parse_args()
     config = yaml.safe_load(args.config)
     config.setdefault('chunk_size', 500)
+    config.setdefault('catalog', None)
 
     logging_setup(config['logging'])
 
     processor = {
-        'LIBS': LIBSProcessor,
-        'Mossbauer': MossbauerImporter,
-        'Raman': RamanImporter,
-        'MSL': MSLProcessor,
+        'LIBS': 'LIBSProcessor',
+        'Mossbauer': 'MossbauerImporter',
+        'Raman': 'RamanImporter',
+        'MSL': 'MSLProcessor',
     }
 
+    watch_config = config.get('watch') or {}
+    if args.coordinate or args.work:
+        from processors.distribute import queue_config
+        queue_options = queue_config(config.get('queue'))
+        jobs = []
+    # Datasets with the same masterfile parse it once per run.
+    masterfiles = MasterfileRegistry()
+    importers = []
     for dataset in config['datasets']:
         if 'name' not in dataset:
             logging.error('Dataset missing name; skipping')
@@ -58,7 +142,64 @@ if __name__ == '__main__':
         if 'type' not in dataset:
             logging.error(f'Dataset {dataset.name} missing type; skipping')
             continue
-        global_config = ['root_dir', 'chunk_size']
-        for attr in global_config:
+        for attr in GLOBAL_CONFIG:
             dataset[attr] = config[attr]
-        processor[dataset['type']](**dataset).main()
+        if args.watch:
+            dataset['batch_size'] = watch_config.get('batch_size', 50)
+            importer_class = getattr(processors, processor[dataset['type']])
+            importer = importer_class(**dataset, masterfiles=masterfiles)
+            # HDF5 locks a file open for writing against every other
+            # reader, so only SWMR output stays open between batches.
+            importer.keep_open = importer.writes_swmr()
+            importers.append(importer)
+            continue
+        if args.work:
+            importer_class = getattr(processors, processor[dataset['type']])
+            jobs.append((importer_class(**dataset), dataset))
+            continue
+        fingerprint = input_fingerprint(dataset)
+        unchanged = not (args.force or args.rebuild) and \
+            is_unchanged(dataset, fingerprint)
+        if unchanged:
+            logging.info(f'No changes for {dataset["name"]}, nothing to do')
+            if not (args.export or args.compact):
+                continue
+        importer = getattr(processors, processor[dataset['type']])(
+            **dataset, masterfiles=masterfiles)
+        if args.rebuild:
+            from processors.rebuild import rebuild
+            rebuild(importer, dataset, workers=args.workers)
+            save_fingerprint(dataset, fingerprint)
+        elif args.coordinate and not unchanged:
+            from processors.distribute import coordinate
+            if args.refresh_metadata:
+                importer.refresh_metadata()
+            coordinate(importer, dataset,
+                       unit_size=queue_options['unit_size'],
+                       lease=queue_options['lease'],
+                       poll=queue_options['poll'])
+            save_fingerprint(dataset, fingerprint)
+        elif not unchanged:
+            if args.refresh_metadata:
+                importer.refresh_metadata()
+            importer.main()
+            save_fingerprint(dataset, fingerprint)
+        if args.compact:
+            from processors.compact import compact
+            compact(importer, member_size=args.member_size)
+        if args.export:
+            from processors.delta import export_delta
+            export_delta(importer,
+                         os.path.join(args.export, importer.safe_name))
+
+    if args.work:
+        from processors.distribute import work
+        work(jobs, lease=queue_options['lease'], poll=queue_options['poll'],
+             idle=queue_options['idle'])
+
+    if args.watch:
+        from processors.watch import watch
+        watch(importers,
+              settle=watch_config.get('settle', 10),
+              polling=watch_config.get('polling', False),
+              interval=watch_config.get('interval', 60))
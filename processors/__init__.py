@@ -1,6 +1,18 @@
 #!/usr/bin/env python3
 
-from .libs import LIBSProcessor
-from .mossbauer import MossbauerImporter
-from .raman import RamanImporter
-from .msl import MSLProcessor
+from importlib import import_module
+
+# Processors are imported on first use, so that a run with nothing to do
+# does not pay for importing h5py, numpy, and openpyxl.
+_PROCESSORS = {
+    'LIBSProcessor': '.libs',
+    'MossbauerImporter': '.mossbauer',
+    'RamanImporter': '.raman',
+    'MSLProcessor': '.msl',
+}
+
+
+def __getattr__(name):
+    if name in _PROCESSORS:
+        return getattr(import_module(_PROCESSORS[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 
+import glob
 import h5py
 import logging
 import numpy as np
 import re
 import os
+from .aggregate import aggregate_config, aggregate_path, update_aggregate
+from .cache import SpectrumCache
+from .catalog import update_catalog
+from .duplicates import HASH_FIELD, MODES, content_hash, hash_index, \
+    vector_hashes
+from .index import INDEX_GROUP, create_index, update_index
+from .journal import clear_consistency_flags
+from .preprocess import preprocess_config, preprocessed_path, \
+    update_preprocessed
+from .pyramid import PYRAMID_GROUP, create_pyramid, update_pyramid, \
+    write_trajectory_pyramid
+from .resample import resample_config, resampled_path, update_resampled
+from .similarity import create_similarity, similarity_config, \
+    update_similarity
+from .state import PATH_DEFAULTS, file_fingerprint, hdf5_options, \
+    load_state, resolve_paths, save_state
 from time import time, strftime
 
 
@@ -16,6 +33,7 @@ class _BaseProcessor(object):
     - `get_id(filename)`: returns ID or None.
     - `parse_metadata()`: returns parsed metadata structure.
     - `process_spectra(datafile)`: return spectra, meta.
+    - `refresh_meta(meta)`: return masterfile-derived metadata columns.
     - `write_data(output_pattern, all_spectra, all_meta)`
 
     Requires implementations of these members:
@@ -37,23 +55,97 @@ class _BaseProcessor(object):
             'averaged': False,
             'logger': logging.getLogger(),
             'log_dir': 'nightly-logs',
-            'output_dir': 'to-DEVAS',
-            'output_prefix': 'prepro_no_blr',
             'channels_file': 'prepro_channels.npy',
+            'cache_dir': None,
+            'keep_open': False,
+            'swmr': False,
+            'member_size': None,
+            'preprocess': None,
+            'pyramid': None,
+            'resample': None,
+            'similarity': None,
+            'aggregate': None,
+            'duplicates': None,
+            'catalog': None,
+            'masterfiles': None,
+            **PATH_DEFAULTS,
         }
         for key, value in defaults.items():
             if not hasattr(self, key):
                 setattr(self, key, value)
         self.construct_paths()
+        self.spectrum_cache = None
+        if self.paths['cache']:
+            self.spectrum_cache = SpectrumCache(
+                self.paths['cache'], type(self).__name__,
+                {'channels': self.channels})
+        self.metadata_fingerprint = None
+        self.processed_ids = None
+        self.content_hashes = None
+        self.skipped_duplicates = {}
+        self.output_handles = {}
+        if self.swmr and not self.writes_swmr():
+            self.logger.warning(f'{self.name} output cannot be written in '
+                                f'SWMR mode; only /committed is published')
+        if self.pyramid:
+            self.pyramid = sorted(set(int(factor) for factor in self.pyramid))
+            if self.pyramid[0] < 2:
+                raise ValueError('Decimation factors must be at least 2')
+        if self.preprocess is not None:
+            if self.is_trajectory():
+                self.logger.warning(f'{self.name} spectra do not share '
+                                    f'channels; not preprocessing them')
+                self.preprocess = None
+            else:
+                self.preprocess = preprocess_config(self.preprocess,
+                                                    self.channels)
+        if self.resample is not None:
+            if self.is_trajectory():
+                self.resample = resample_config(self.resample)
+            else:
+                self.logger.warning(f'{self.name} spectra already share '
+                                    f'channels; not resampling them')
+                self.resample = None
+        if self.similarity:
+            if self.is_trajectory() and not self.resample:
+                self.logger.warning(f'{self.name} spectra can only be '
+                                    f'indexed for similarity when '
+                                    f'resampled; not indexing them')
+                self.similarity = None
+            else:
+                self.similarity = similarity_config(self.similarity)
+        if self.aggregate:
+            if self.is_trajectory():
+                self.logger.warning(f'{self.name} spectra do not share '
+                                    f'channels; not aggregating them')
+                self.aggregate = None
+            else:
+                self.aggregate = aggregate_config(self.aggregate)
+        if self.catalog:
+            self.catalog = os.path.join(getattr(self, 'root_dir', ''),
+                                        self.catalog)
+        if self.duplicates not in (None,) + MODES:
+            raise ValueError(f'Unknown duplicates mode {self.duplicates}')
+        if self.duplicates == 'link' and not self.is_trajectory():
+            self.logger.warning(f'{self.name} rows cannot be linked; '
+                                f'skipping duplicate files instead')
+            self.duplicates = 'skip'
 
     def main(self):
         """
         Drive the processing of spectra from input data.
         """
         self.logger.info(f'Starting processing for {self.name}')
+        self.recover()
+        self.catch_up()
+        if self.masterfile_changed():
+            # Reload it even if there is nothing new to process, as in
+            # watch mode, so it no longer counts as changed.
+            self.ensure_metadata()
         # Check output for spectra we have already processed
         processed_ids = set(self.get_processed_ids())
         self.logger.info(f'Found {len(processed_ids)} IDs in existing output')
+        processed_ids.update(self.get_skipped_ids())
         # Scan input data for all possible spectra to process
         input_data = self.get_input_data()
         if not input_data:
@@ -68,24 +160,164 @@ class _BaseProcessor(object):
             self.logger.info('No new IDs, nothing to do')
             return
         # Process the spectra
-        self.metadata = self.parse_metadata()
+        self.ensure_metadata()
         self.process_all(unprocessed)
+        if not processed_ids:
+            # Fresh output is consistent with the current masterfile.
+            self.save_masterfile_fingerprint()
+        # Let `ingest()` reread the output, which now has more IDs.
+        self.processed_ids = None
         self.logger.info(f'Finished processing for {self.name}')
 
+    def close(self):
+        """
+        Close any output files held open by `keep_open`.
+        """
+        for fh in self.output_handles.values():
+            fh.close()
+        self.output_handles = {}
+
+    def close_output(self, fh):
+        """
+        Finish writing a batch to a file from `open_output()`.
+
+        Parameters
+        ----------
+        fh
+            The open HDF5 file.
+        """
+        if self.keep_open:
+            fh.flush()
+        else:
+            fh.close()
+
+    def commit_batch(self, all_spectra, all_meta):
+        """
+        Append a processed batch to the spectra and metadata output as
+        one transaction.
+
+        The batch’s row range and metadata are journaled before the
+        spectra, their index entries, and their decimated levels and
+        similarity index entries are written, and the journal is
+        updated once they are.
+        Replacing the metadata file commits the batch, after which the
+        journal is removed. `recover()` uses the journal to finish or
+        undo a batch that was interrupted. With `preprocess`, the
+        committed batch is then preprocessed into its own output (see
+        `preprocess.py`), and with `resample`, resampled into its own
+        output (see `resample.py`), which is then indexed for similarity
+        instead of the main output; with `aggregate`, it is folded into
+        the per-sample statistics (see `aggregate.py`), and with
+        `catalog`, its IDs are added to the shared catalog (see
+        `catalog.py`). Each catches up by itself if interrupted.
+
+        Parameters
+        ----------
+        all_spectra
+            As received from `restructure_spectra()`.
+        all_meta : dict
+            As received from `restructure_meta()`.
+        """
+        existing = self.read_metadata()
+        start = 0 if existing is None else len(existing[self.pkey_field])
+        stop = start + len(all_meta[self.pkey_field])
+        journal = {'start': start, 'stop': stop, 'phase': 'pending'}
+        if self.is_trajectory():
+            journal['ids'] = [str(id) for id in all_meta[self.pkey_field]]
+        pending = self.paths['journal_meta']
+        tmp_path = f'{pending}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **all_meta)
+        os.replace(tmp_path, pending)
+        save_state(self.paths['journal'], journal)
+        self.write_data(self.output_path(), all_spectra, all_meta)
+        self.write_index(start, all_meta[self.pkey_field])
+        if self.pyramid:
+            self.write_pyramid(start, all_spectra, all_meta)
+        if self.similarity and not self.is_trajectory():
+            self.write_similarity(start, all_spectra)
+        journal['phase'] = 'written'
+        save_state(self.paths['journal'], journal)
+        meta = self.write_metadata(all_meta, existing)
+        self.publish_committed(stop)
+        os.remove(self.paths['journal'])
+        os.remove(pending)
+        # The updaters share the metadata just written instead of each
+        # loading it again.
+        if self.preprocess:
+            update_preprocessed(self, all_spectra, start, meta)
+        if self.resample:
+            update_resampled(self, all_spectra, start, meta)
+        if self.aggregate:
+            update_aggregate(self, all_spectra, start, meta)
+        if self.catalog:
+            update_catalog(self, start, meta)
+
+    def catch_up(self):
+        """
+        Bring everything derived from the committed output up to date
+        with it and with the current options, as after an interruption,
+        a rebuild, or output written before an option was set.
+        """
+        if self.duplicates:
+            self.fill_hashes()
+        if self.pyramid:
+            self.fill_pyramid()
+        if self.similarity and not self.is_trajectory() and \
+                self.count_rows():
+            self.write_similarity(self.count_rows(), None)
+        if self.preprocess:
+            update_preprocessed(self)
+        if self.resample:
+            update_resampled(self)
+        if self.aggregate:
+            update_aggregate(self)
+        if self.catalog:
+            update_catalog(self)
+
+    def check_duplicate(self, datafile, spectra, meta):
+        """
+        Look a parsed file’s spectra up in the content hash index of
+        the output and of the files already in this batch, and record
+        their hash in a `content_hash` metadata column.
+
+        A file whose spectra are already stored under another ID is
+        skipped, and remembered so it is not parsed again; with
+        `duplicates: link`, trajectory output instead stores it as a
+        hard link to the stored spectrum (see `write_data()`). A file
+        whose spectra are already stored under its own ID, as when a
+        directory was copied, is always skipped.
+
+        Parameters
+        ----------
+        datafile
+            Tuple (ID, file’s full path) of the file.
+        spectra
+            As received from `process_file()`.
+        meta : dict
+            As received from `process_file()`; gains `content_hash`.
+
+        Returns
+        -------
+            True if the file should be left out of the batch.
+        """
+        digest = content_hash(spectra)
+        pkeys = meta[self.pkey_field]
+        if isinstance(pkeys, (list, np.ndarray)):
+            pkey = pkeys[0]
+            meta[HASH_FIELD] = np.full(len(pkeys), digest)
+        else:
+            pkey = pkeys
+            meta[HASH_FIELD] = digest
+        pkey = pkey.decode() if isinstance(pkey, bytes) else str(pkey)
+        return self.match_content(datafile, pkey, digest)
+
     def construct_paths(self):
         """
         Identify input and output directories based on config.
         """
-        root = getattr(self, 'root_dir', '')
-        base = os.path.join(root, getattr(self, 'base_dir', ''))
-        meta = getattr(self, 'meta_file')
-        if isinstance(meta, str):
-            meta = [meta]
-        meta = [os.path.join(base, f) for f in meta]
-        data = getattr(self, 'data_dir', '')
-        if isinstance(data, str):
-            data = [data]
-        data = [os.path.join(base, d) for d in data]
+        paths = resolve_paths(vars(self))
+        base = paths['base']
         logdir = os.path.join(base, getattr(self, 'log_dir', ''))
         if not os.path.exists(logdir):
             os.makedirs(logdir, mode=0o755)
@@ -93,19 +325,106 @@ class _BaseProcessor(object):
         if hasattr(self, 'log_suffix') and self.log_suffix:
             logfile += '-' + self.log_suffix
         logpath = os.path.join(logdir, logfile + '.log')
-        output = os.path.join(base, getattr(self, 'output_dir', ''))
+        output = paths['output']
         if not os.path.exists(output):
             os.makedirs(output, mode=0o755)
         channels = os.path.join(output, self.channels_file)
+        cache = None
+        if self.cache_dir:
+            cache = os.path.join(base, self.cache_dir)
         self.paths = {
           'base': base,
-          'metadata': meta,
-          'data': data,
+          'metadata': paths['metadata'],
+          'data': paths['data'],
           'log': logpath,
           'output': output,
           'channels': channels,
+          'meta_output': paths['meta_output'],
+          'state': paths['state'],
+          'cache': cache,
+          'journal': os.path.join(output, self.output_prefix + '_journal.json'),
+          'journal_meta': os.path.join(output,
+                                       self.output_prefix + '_journal.npz'),
         }
 
+    def count_rows(self):
+        """
+        Returns
+        -------
+            The number of rows in the metadata output.
+        """
+        filepath = self.paths['meta_output']
+        if not os.path.exists(filepath):
+            return 0
+        with np.load(filepath, allow_pickle=True) as existing:
+            return len(existing[self.pkey_field])
+
+    def ensure_metadata(self):
+        """
+        Parse the masterfile unless it is already loaded and has not
+        changed since.
+
+        Returns
+        -------
+            True if the masterfile was (re)loaded.
+        """
+        fingerprint = self.get_masterfile_fingerprint()
+        if fingerprint == self.metadata_fingerprint:
+            return False
+        if self.masterfiles is None:
+            metadata = self.parse_metadata()
+        else:
+            # Shared with other datasets of the run (see `masterfiles.py`)
+            metadata = self.masterfiles.get(self.masterfile_key(),
+                                            fingerprint, self.parse_metadata,
+                                            self.logger)
+        self.adopt_metadata(metadata)
+        self.metadata_fingerprint = fingerprint
+        return True
+
+    # This is extended by processors that keep the masterfile elsewhere:
+    def adopt_metadata(self, metadata):
+        """
+        Keep a parsed masterfile for processing.
+
+        Parameters
+        ----------
+        metadata
+            As returned by `parse_metadata()`, possibly for another
+            dataset with the same masterfile; not to be modified.
+        """
+        self.metadata = metadata
+
+    def masterfile_key(self):
+        """
+        Identifies the parse of this dataset’s masterfiles, for sharing
+        it with other datasets.
+
+        Returns
+        -------
+            A tuple of the processor class, primary key field and
+            masterfile paths.
+        """
+        return (type(self).__name__, self.pkey_field,
+                tuple(os.path.abspath(path)
+                      for path in self.paths['metadata']))
+
+    def ensure_index(self, fh):
+        """
+        Create the ID index of an output file that has none, from the
+        committed metadata.
+
+        Parameters
+        ----------
+        fh
+            The open output file.
+        """
+        if INDEX_GROUP in fh:
+            return
+        meta = self.read_metadata()
+        ids = [] if meta is None else meta[self.pkey_field]
+        create_index(fh, self.pkey_field, ids)
+
     def filter_input_data(self, input_data, processed_ids):
         """
         Remove previously seen files from `input_data`.
@@ -135,6 +454,21 @@ class _BaseProcessor(object):
                 unprocessed[dirname].append(file)
         return unprocessed
 
+    def fill_hashes(self):
+        """
+        Add the `content_hash` column to metadata output written before
+        `duplicates` was configured, hashing each ID’s stored spectra
+        the same way as newly parsed ones.
+        """
+        meta = self.read_metadata()
+        if meta is None or HASH_FIELD in meta:
+            return
+        meta[HASH_FIELD] = self.stored_hashes(meta)
+        self.save_metadata(meta)
+        self.content_hashes = None
+        self.logger.info(f'Hashed the spectra of {len(meta[HASH_FIELD])} '
+                         f'rows of existing output')
+
     def get_child_logger(self):
         """
         Create a child logger with the root logger’s formatter.
@@ -170,20 +504,10 @@ class _BaseProcessor(object):
             data[base] = []
             for root, _, filenames in os.walk(input_dir):
                 for filename in filenames:
-                    if not filename.lower().endswith(self.file_ext.lower()):
-                        continue
-                    fid = self.get_id(filename)
-                    if fid is None:
-                        continue
-                    if self.is_raman():
-                        full_filename = os.path.join(root, filename)
-                        # As code in process spectra in raman
-                        is_underscored = self.is_underscored(full_filename)
-                        if is_underscored:
-                            fid = fid + "_" + is_underscored
-                    else:
-                        full_filename = os.path.join(root, filename)
-                    data[base].append((fid, full_filename))
+                    full_filename = os.path.join(root, filename)
+                    entry = self.input_entry(input_dir, full_filename)
+                    if entry is not None:
+                        data[base].append(entry[1])
 
         return data
 
@@ -197,8 +521,7 @@ class _BaseProcessor(object):
         -------
             List of the spectra present in previous output.
         """
-        filename = self.output_prefix + '_meta.npz'
-        filepath = os.path.join(self.paths['output'], filename)
+        filepath = self.paths['meta_output']
         self.logger.debug(f'Checking for previous output file {filepath}')
         if not os.path.isfile(filepath):
             return []
@@ -206,6 +529,117 @@ class _BaseProcessor(object):
         ids = meta[self.pkey_field]
         return [x.decode() if isinstance(x, bytes) else x for x in ids]
 
+    def get_skipped_ids(self):
+        """
+        Finds the IDs of files skipped as duplicates in previous runs
+        (see `check_duplicate()`), so they are not parsed again.
+
+        Returns
+        -------
+            List of skipped IDs, empty without `duplicates`.
+        """
+        if not self.duplicates:
+            return []
+        return list(load_state(self.paths['state']).get('duplicates', {}))
+
+    def get_masterfile_fingerprint(self):
+        """
+        Identifies the current version of each masterfile.
+
+        Returns
+        -------
+            A dict of masterfile path to `state.file_fingerprint()`.
+        """
+        return {path: file_fingerprint(path)
+                for path in self.paths['metadata']}
+
+    def ingest(self, filepaths):
+        """
+        Process specific files that have just arrived, for watch mode.
+        Files that are not valid input or were already processed are
+        ignored. The processed IDs and parsed masterfile are kept
+        between calls.
+
+        Parameters
+        ----------
+        filepaths : list
+            Full paths of new or updated files.
+
+        Returns
+        -------
+            The number of files that were passed on for processing.
+        """
+        if self.processed_ids is None:
+            self.recover()
+            self.catch_up()
+            self.processed_ids = set(self.get_processed_ids())
+            self.processed_ids.update(self.get_skipped_ids())
+        input_data = {}
+        for filepath in filepaths:
+            for input_dir in self.paths['data']:
+                if not is_within(filepath, input_dir):
+                    continue
+                entry = self.input_entry(input_dir, filepath)
+                if entry is not None:
+                    input_data.setdefault(entry[0], []).append(entry[1])
+                break
+        unprocessed = self.filter_input_data(input_data, self.processed_ids)
+        if not unprocessed:
+            return 0
+        self.ensure_metadata()
+        self.process_all(unprocessed)
+        files = [file for val in unprocessed.values() for file in val]
+        # Files that failed are not retried until the masterfile changes.
+        self.processed_ids.update(fid for fid, _ in files)
+        return len(files)
+
+    def input_entry(self, input_dir, filepath):
+        """
+        Check whether one file is input for this processor. Overriden
+        in LIBSProcessor.
+
+        Parameters
+        ----------
+        input_dir
+            The data directory containing the file.
+        filepath
+            The full path of the file.
+
+        Returns
+        -------
+            A tuple (key, (ID, filepath)) where key is the same as in
+            `get_input_data()`, or None if the file is not input.
+        """
+        filename = os.path.basename(filepath)
+        if not filename.lower().endswith(self.file_ext.lower()):
+            return None
+        fid = self.get_id(filename)
+        if fid is None:
+            return None
+        if self.is_raman():
+            # As code in process spectra in raman
+            is_underscored = self.is_underscored(filepath)
+            if is_underscored:
+                fid = fid + "_" + is_underscored
+        return os.path.basename(input_dir), (fid, filepath)
+
+    # This is overridden by MSLProcessor:
+    def input_id(self, pkey):
+        """
+        Find the ID of the input file a primary key value came from, as
+        returned by `get_processed_ids()`.
+
+        Parameters
+        ----------
+        pkey : string
+            A primary key value.
+
+        Returns
+        -------
+            The ID as in `get_input_data()`; by default, `pkey` itself.
+        """
+        return pkey
+
     def is_trajectory(self):
         """
         By default, not trajectory. Overriden in TrajectoryProcessor
@@ -217,6 +651,18 @@ class _BaseProcessor(object):
         """
         return False
 
+    def writes_swmr(self):
+        """
+        Whether the output is written in SWMR mode (see `start_swmr()`),
+        so readers can open it while it is held open for writing.
+
+        Returns
+        -------
+            True with `swmr`, for vector output without a driver.
+        """
+        return bool(self.swmr) and not self.is_trajectory() and \
+            self.driver is None
+
     def is_raman(self):
         """
         Return a boolean that indicated it is not a Raman processor.
@@ -228,6 +674,45 @@ class _BaseProcessor(object):
         """
         return False
 
+    def load_cached(self, parse, filepath):
+        """
+        Parse a spectra file, going through the parsed-spectrum cache
+        if `cache_dir` is configured.
+
+        Parameters
+        ----------
+        parse : function
+            Takes the file path and returns an array, or a tuple of an
+            array followed by JSON-serializable values. Any other
+            result (such as an error message) is returned uncached.
+        filepath
+            The full path of a spectra file.
+
+        Returns
+        -------
+            The result of `parse(filepath)`, possibly from the cache.
+        """
+        if self.spectrum_cache is None:
+            return parse(filepath)
+        cached = self.spectrum_cache.get(filepath)
+        if cached is not None:
+            return cached
+        result = parse(filepath)
+        self.spectrum_cache.put(filepath, result)
+        return result
+
+    def masterfile_changed(self):
+        """
+        Check whether a loaded masterfile has changed on disk.
+
+        Returns
+        -------
+            True if the masterfile was parsed and has changed since.
+        """
+        if self.metadata_fingerprint is None:
+            return False
+        return self.get_masterfile_fingerprint() != self.metadata_fingerprint
+
     def make_batches(self, unprocessed):
         """
         The structure is similar to the output of `get_input_data()`,
@@ -266,6 +751,78 @@ class _BaseProcessor(object):
                 to_process[label] = batch
         return to_process
 
+    def match_content(self, datafile, pkey, digest):
+        """
+        Decide whether a file is left out as a duplicate by its content
+        hash, as `check_duplicate()` describes, and register the hash
+        if it is new.
+
+        Parameters
+        ----------
+        datafile
+            Tuple (ID, description for the log, like the file’s path).
+        pkey : string
+            The file’s primary key.
+        digest : string
+            Content hash of the file’s spectra.
+
+        Returns
+        -------
+            True if the file should be left out.
+        """
+        if self.content_hashes is None:
+            self.content_hashes = hash_index(self.read_metadata(),
+                                             self.pkey_field)
+        original = self.content_hashes.get(digest)
+        if original is None:
+            self.content_hashes[digest] = pkey
+            return False
+        if original == pkey:
+            self.logger.info(f'Skipping {datafile[1]}: {pkey} is already '
+                             f'stored with the same spectra')
+        elif self.duplicates == 'link':
+            self.logger.info(f'Linking {datafile[1]} to {original}, which '
+                             f'has the same spectra')
+            return False
+        else:
+            self.logger.info(f'Skipping {datafile[1]}: same spectra as '
+                             f'{original}')
+        self.skipped_duplicates[str(datafile[0])] = original
+        return True
+
+    def open_output(self, filepath):
+        """
+        Open an HDF5 output file for appending. With `keep_open`, the
+        file stays open between batches until `close()`.
+
+        Parameters
+        ----------
+        filepath : string
+            Output filename (pattern, for the family driver).
+
+        Returns
+        -------
+            The open HDF5 file.
+        """
+        if filepath in self.output_handles:
+            return self.output_handles[filepath]
+        fh = h5py.File(filepath, 'a', libver='latest',
+                       **hdf5_options(filepath, self.driver, self.member_size))
+        self.start_swmr(fh)
+        if self.keep_open:
+            self.output_handles[filepath] = fh
+        return fh
+
+    def output_path(self):
+        """
+        Returns
+        -------
+            The spectra output filename (pattern, for the family driver).
+        """
+        output_suffix = '.hdf5' if self.driver is None else '.%03d.hdf5'
+        return os.path.join(self.paths['output'],
+                            self.output_prefix + output_suffix)
+
     def process_all(self, unprocessed):
         """
         Drive the processing of files in reasonably-sized batches.
@@ -302,18 +859,20 @@ class _BaseProcessor(object):
             spectra, meta = self.process_file(datafile)
             if spectra is None or meta is None:
                 continue
+            elif self.duplicates and \
+                    self.check_duplicate(datafile, spectra, meta):
+                continue
             else:
                 all_spectra.append(spectra)
                 all_meta.append(meta)
-        if not all_spectra:
+        if all_spectra:
+            all_meta = self.restructure_meta(all_meta)
+            all_spectra = self.restructure_spectra(all_spectra, all_meta)
+            self.commit_batch(all_spectra, all_meta)
+        else:
             self.logger.debug('No spectra found in batch')
-            return
-        all_meta = self.restructure_meta(all_meta)
-        output_suffix = '.hdf5' if self.driver is None else '.%03d.hdf5'
-        output_pattern = self.output_prefix + output_suffix
-        output_filepath = os.path.join(self.paths['output'], output_pattern)
-        self.write_data(output_filepath, all_spectra, all_meta)
-        self.write_metadata(all_meta)
+        if self.skipped_duplicates:
+            self.save_skipped_ids()
 
     # This is extended by _VectorProcessor:
     def process_file(self, datafile):
@@ -336,6 +895,213 @@ class _BaseProcessor(object):
             return None, None
         return processed
 
+    def publish_committed(self, rows):
+        """
+        Record how many rows of the output are committed in its
+        `/committed` dataset and flush it. Readers should ignore any
+        rows past this count, which may still be being written.
+
+        Parameters
+        ----------
+        rows : int
+            Rows in the committed metadata output.
+        """
+        fh = self.open_output(self.output_path())
+        if '/committed' not in fh:
+            fh.create_dataset('committed', data=rows)
+        else:
+            fh['/committed'][()] = rows
+        self.close_output(fh)
+
+    def recover(self):
+        """
+        Make the output consistent again after a run was killed.
+
+        Clears the flags HDF5 leaves in an output file that was open for
+        writing, then finishes or undoes any batch left in the journal
+        by `commit_batch()`: if its spectra were completely written, its
+        metadata is committed (rolled forward); otherwise the spectra
+        it added are removed (rolled back), and its files will be
+        processed again.
+        """
+        first_files = [self.output_path()]
+        # Tail files of a sharded rebuild (see `rebuild.py`)
+        first_files += glob.glob(os.path.join(
+            self.paths['output'], 'shards',
+            f'{glob.escape(self.output_prefix)}_*_tail.*hdf5'))
+        if self.preprocess:
+            first_files.append(preprocessed_path(self))
+        if self.resample:
+            first_files.append(resampled_path(self))
+        if self.aggregate:
+            first_files.append(aggregate_path(self))
+        for first_file in first_files:
+            if self.driver == 'family':
+                first_file = first_file.replace('%03d', '000')
+            if os.path.exists(first_file) and \
+                    clear_consistency_flags(first_file):
+                self.logger.warning(f'Cleared open-for-writing flags in '
+                                    f'{first_file} left by an interrupted run')
+        journal = load_state(self.paths['journal'])
+        if not journal:
+            return
+        start, stop = journal['start'], journal['stop']
+        rows = self.count_rows()
+        if rows == stop:
+            self.logger.info(f'Interrupted batch of rows {start} to {stop} '
+                             f'was already committed')
+        elif rows != start:
+            raise RuntimeError(f'Journal {self.paths["journal"]} is for rows '
+                               f'{start} to {stop} but the output has {rows}')
+        elif journal['phase'] == 'written':
+            self.logger.warning(f'Rolling forward interrupted batch of rows '
+                                f'{start} to {stop}')
+            with np.load(self.paths['journal_meta'],
+                         allow_pickle=True) as pending:
+                self.write_metadata({k: pending[k] for k in pending.files})
+        else:
+            self.logger.warning(f'Rolling back interrupted batch of rows '
+                                f'{start} to {stop}')
+            self.rollback_data(journal)
+            self.write_index(start, [])
+        self.publish_committed(self.count_rows())
+        os.remove(self.paths['journal'])
+        if os.path.exists(self.paths['journal_meta']):
+            os.remove(self.paths['journal_meta'])
+
+    def start_swmr(self, fh):
+        """
+        With `swmr`, switch a vector output file to single-writer/
+        multiple-reader mode once it has `/spectra`, so readers see each
+        flushed batch without blocking (see `reader.py`). No objects can
+        be created afterwards, so `/committed`, the index, and any
+        decimated levels and similarity index are created first; a tail
+        file needs none.
+        Trajectory output creates a dataset per spectrum, and HDF5’s
+        family driver does not support SWMR, so both only publish
+        `/committed`.
+
+        Parameters
+        ----------
+        fh
+            An open output file.
+        """
+        if not self.writes_swmr() or fh.swmr_mode or '/spectra' not in fh:
+            return
+        if 'spectra_tail' in fh.attrs or \
+                'spectra_tail_offset' not in fh.attrs:
+            if '/committed' not in fh:
+                fh.create_dataset('committed', data=self.count_rows())
+            self.ensure_index(fh)
+            if self.pyramid:
+                create_pyramid(fh, self.pyramid, self.channels)
+            if self.similarity:
+                create_similarity(fh, self.similarity, self.channels)
+        try:
+            fh.swmr_mode = True
+        except RuntimeError as e:
+            # Files created before `libver='latest'` was used cannot.
+            self.logger.warning(f'Cannot use SWMR for {fh.filename}: {e}')
+            self.swmr = False
+            # Others could not open it while it is held open.
+            self.keep_open = False
+
+    def refresh_metadata(self):
+        """
+        Regenerate the masterfile-derived metadata of existing output
+        if the masterfile has changed since the output was last
+        consistent with it. Spectra files are not read again: IDs
+        and per-file header fields come from the existing output.
+        """
+        self.recover()
+        state = load_state(self.paths['state'])
+        if state.get('masterfiles') == self.get_masterfile_fingerprint():
+            self.logger.info('Masterfile unchanged, no metadata to refresh')
+            return
+        meta = self.read_metadata()
+        if meta is None:
+            self.logger.info('No existing output, no metadata to refresh')
+            return
+        self.logger.info(f'Refreshing metadata for {self.name}')
+        self.ensure_metadata()
+        refreshed = self.refresh_meta(meta)
+        n_rows = len(meta[self.pkey_field])
+        changed = np.zeros(n_rows, dtype=bool)
+        columns = []
+        for key, values in refreshed.items():
+            if values is None:
+                if key in meta:
+                    del meta[key]
+                    columns.append(key)
+                continue
+            if key in meta:
+                rows = changed_rows(meta[key], values)
+            else:
+                rows = np.ones(n_rows, dtype=bool)
+            if rows.any():
+                meta[key] = values
+                changed |= rows
+                columns.append(key)
+        if columns:
+            self.logger.info(f'Updated {changed.sum()} of {n_rows} rows '
+                             f'in columns {", ".join(sorted(columns))}')
+            self.save_metadata(meta)
+        else:
+            self.logger.info('Masterfile changes do not affect output')
+        self.save_masterfile_fingerprint()
+
+    def refresh_rows(self, meta, key_field, lookup):
+        """
+        Helper for `refresh_meta()` implementations: looks up each
+        distinct value of one metadata column and spreads the
+        resulting fields over every row with that value.
+
+        Parameters
+        ----------
+        meta : dict
+            Existing metadata, as from `read_metadata()`.
+        key_field : string
+            Column of `meta` to pass to `lookup`.
+        lookup : function
+            Takes one key and returns a dict of field values, or None
+            to leave that key’s rows unchanged.
+
+        Returns
+        -------
+            A dict of column name to array with one value per row.
+        """
+        keys = meta[key_field]
+        refreshed = {}
+        for key in np.unique(keys):
+            fields = lookup(key)
+            if fields is None:
+                continue
+            rows, = np.where(keys == key)
+            for field, value in fields.items():
+                if field not in refreshed:
+                    if field in meta:
+                        refreshed[field] = meta[field].astype(object)
+                    else:
+                        refreshed[field] = np.full(len(keys), None,
+                                                   dtype=object)
+                refreshed[field][rows] = value
+        return {k: np.array(v.tolist()) for k, v in refreshed.items()}
+
+    def read_metadata(self):
+        """
+        Load the metadata from existing output.
+
+        Returns
+        -------
+            A dict of column name to array, or None if there is no
+            existing output.
+        """
+        filepath = self.paths['meta_output']
+        if not os.path.exists(filepath):
+            return None
+        with np.load(filepath, allow_pickle=True) as existing:
+            return {k: existing[k] for k in existing.files}
+
     def restructure_meta(self, all_meta):
         """
         Takes the metadata form by process_spectra and rearranges it
@@ -357,7 +1123,44 @@ class _BaseProcessor(object):
         return dict((k, np.array([m[k] for m in all_meta]))
                     for k in all_meta[0].keys())
 
-    def write_metadata(self, all_meta):
+    # This is extended by _VectorProcessor:
+    def restructure_spectra(self, all_spectra, all_meta):
+        """
+        Combine the spectra of a batch’s files for `write_data()`. This
+        is also where columns computed from the whole batch of spectra
+        at once are added to the metadata.
+
+        Parameters
+        ----------
+        all_spectra : list
+            Spectra of each file in the batch.
+        all_meta : dict
+            As received from `restructure_meta()`; may be extended.
+
+        Returns
+        -------
+            The spectra to write.
+        """
+        return all_spectra
+
+    def write_index(self, start, ids):
+        """
+        Add a batch’s rows to the output’s ID index (see `index.py`), so
+        readers can find each ID’s rows without searching the metadata.
+
+        Parameters
+        ----------
+        start : int
+            Output row of the batch’s first row.
+        ids : array
+            Primary key of each row of the batch.
+        """
+        fh = self.open_output(self.output_path())
+        self.ensure_index(fh)
+        update_index(fh, ids, start)
+        self.close_output(fh)
+
+    def write_metadata(self, all_meta, existing=None):
         """
         Output the metadata into an npz file.
 
@@ -365,14 +1168,98 @@ class _BaseProcessor(object):
         ----------
         all_meta : dict
             As received from `restructure_meta()`.
+        existing : dict
+            The metadata output so far, if already read with
+            `read_metadata()`.
+
+        Returns
+        -------
+            The whole metadata output, as `read_metadata()` would now
+            return it.
         """
-        filename = self.output_prefix + '_meta.npz'
-        filepath = os.path.join(self.paths['output'], filename)
-        if os.path.exists(filepath):
-            existing = np.load(filepath, allow_pickle=True)
+        if existing is None:
+            existing = self.read_metadata()
+        if existing is not None:
             for k, v in list(all_meta.items()):
                 all_meta[k] = np.concatenate((existing[k], v))
-        np.savez(filepath, **all_meta)
+        self.save_metadata(all_meta)
+        return all_meta
+
+    def save_metadata(self, meta):
+        """
+        Replace the npz metadata output atomically.
+
+        Parameters
+        ----------
+        meta : dict
+            Column name to array for every row of output.
+        """
+        filepath = self.paths['meta_output']
+        tmp_path = f'{filepath}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **meta)
+        os.replace(tmp_path, filepath)
+
+    def save_skipped_ids(self):
+        """
+        Record the files skipped as duplicates since the last call, and
+        the IDs whose spectra they duplicate, in the state file.
+        """
+        state = load_state(self.paths['state'])
+        state.setdefault('duplicates', {}).update(self.skipped_duplicates)
+        save_state(self.paths['state'], state)
+        self.skipped_duplicates = {}
+
+    def save_masterfile_fingerprint(self):
+        """
+        Record that the output is consistent with the current
+        masterfile, for `refresh_metadata()`.
+        """
+        state = load_state(self.paths['state'])
+        state['masterfiles'] = self.get_masterfile_fingerprint()
+        save_state(self.paths['state'], state)
+
+
+def is_within(filepath, directory):
+    """
+    Check whether a path is inside a directory.
+
+    Parameters
+    ----------
+    filepath, directory
+        Paths to compare.
+
+    Returns
+    -------
+        True if `filepath` is `directory` or below it.
+    """
+    filepath = os.path.abspath(filepath)
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([filepath, directory]) == directory
+
+
+def changed_rows(old, new):
+    """
+    Compare two metadata columns row by row.
+
+    Parameters
+    ----------
+    old, new
+        Arrays of the same length.
+
+    Returns
+    -------
+        A boolean array, True where the values differ. NaNs are
+        considered equal to each other.
+    """
+    if old.shape != new.shape:
+        return np.ones(len(new), dtype=bool)
+    same = np.asarray(old == new)
+    if same.shape != new.shape:
+        return np.ones(len(new), dtype=bool)
+    if old.dtype.kind == 'f' and new.dtype.kind == 'f':
+        same |= np.isnan(old) & np.isnan(new)
+    return ~same
 
 
 class _VectorProcessor(_BaseProcessor):
@@ -420,13 +1307,13 @@ class _VectorProcessor(_BaseProcessor):
         filepath : string
             Target filename to write to.
         all_spectra
-            Data to write.
+            Data to write, as a 2-D array from `restructure_spectra()`.
         all_meta
             Metadata about spectra. Unused in Vector output but we
             need it in the API for Trajectory output.
         """
-        spectra = np.vstack(all_spectra)
-        fh = h5py.File(filepath, 'a', driver=self.driver, libver='latest')
+        spectra = all_spectra
+        fh = self.open_spectra(filepath)
         if '/spectra' in fh:
             dset = fh['/spectra']
             n = dset.shape[0]
@@ -435,7 +1322,134 @@ class _VectorProcessor(_BaseProcessor):
         else:
             fh.create_dataset('spectra', chunks=True, data=spectra,
                               maxshape=(None, self.channels))
-        fh.close()
+        self.start_swmr(fh)
+        self.close_output(fh)
+
+    def restructure_spectra(self, all_spectra, all_meta):
+        """
+        Override _BaseProcessor to stack the batch into one matrix.
+
+        Parameters
+        ----------
+        all_spectra : list
+            Spectra of each file in the batch.
+        all_meta : dict
+            As received from `restructure_meta()`.
+
+        Returns
+        -------
+            A 2-D array of one spectrum per row.
+        """
+        return np.vstack(all_spectra)
+
+    def rollback_data(self, journal):
+        """
+        Remove spectra written by an uncommitted batch.
+
+        Parameters
+        ----------
+        journal : dict
+            The batch’s journal entry from `commit_batch()`.
+        """
+        fh = self.open_spectra(self.output_path())
+        start = journal['start'] - fh.attrs.get('spectra_tail_offset', 0)
+        if '/spectra' in fh and fh['/spectra'].shape[0] > start:
+            fh['/spectra'].resize(start, axis=0)
+        self.close_output(fh)
+        if self.pyramid:
+            self.write_pyramid(journal['start'], None, None)
+        if self.similarity:
+            self.write_similarity(journal['start'], None)
+
+    def write_pyramid(self, start, all_spectra, all_meta):
+        """
+        Write decimated levels of a batch’s spectra (see `pyramid.py`)
+        to the output file as `/pyramid/<factor>` datasets, one row per
+        spectrum, catching up with any rows that have none.
+
+        Parameters
+        ----------
+        start : int
+            Output row of the batch’s first row.
+        all_spectra
+            The batch’s spectra as a 2-D array, or None to only drop
+            levels of rows from `start` on.
+        all_meta
+            Metadata about spectra. Unused in Vector output.
+        """
+        fh = self.open_output(self.output_path())
+        update_pyramid(fh, self.pyramid, start, all_spectra)
+        self.close_output(fh)
+
+    def fill_pyramid(self):
+        """
+        Write decimated levels of committed rows that have none, as in
+        output written before `pyramid` was configured.
+        """
+        meta = self.read_metadata()
+        if meta is not None:
+            self.write_pyramid(len(meta[self.pkey_field]), None, None)
+
+    def stored_hashes(self, meta):
+        """
+        Hash the committed spectra of each ID for `fill_hashes()`.
+
+        Parameters
+        ----------
+        meta : dict
+            The metadata output.
+
+        Returns
+        -------
+            An array of the content hash of every row.
+        """
+        ids = meta[self.pkey_field]
+        fh = self.open_output(self.output_path())
+        hashes = vector_hashes(fh['spectra'], ids, len(ids))
+        self.close_output(fh)
+        return hashes
+
+    def write_similarity(self, start, all_spectra):
+        """
+        Add a batch’s spectra to the similarity index in the output file
+        (see `similarity.py`), catching up with any rows that are not in
+        it.
+
+        Parameters
+        ----------
+        start : int
+            Output row of the batch’s first row.
+        all_spectra
+            The batch’s spectra as a 2-D array, or None to only drop
+            index entries of rows from `start` on.
+        """
+        fh = self.open_output(self.output_path())
+        update_similarity(fh, self.similarity, start, all_spectra)
+        self.close_output(fh)
+
+    def open_spectra(self, filepath):
+        """
+        Open the file that new spectra are appended to. This is the
+        output file itself, unless a sharded rebuild made `/spectra` a
+        virtual dataset, in which case it is the rebuild’s tail file.
+
+        Parameters
+        ----------
+        filepath : string
+            Output filename (pattern, for the family driver).
+
+        Returns
+        -------
+            The open HDF5 file, to be closed with `close_output()`. For
+            a tail file, its `spectra_tail_offset` attribute is the row
+            of the output where the tail starts.
+        """
+        fh = self.open_output(filepath)
+        tail = fh.attrs.get('spectra_tail')
+        if tail is None:
+            return fh
+        self.close_output(fh)
+        return self.open_output(os.path.join(self.paths['output'], tail))
 
 
 class _TrajectoryProcessor(_BaseProcessor):
@@ -467,11 +1481,99 @@ class _TrajectoryProcessor(_BaseProcessor):
             Metadata about spectra.
         """
         ids = all_meta[self.pkey_field]
-        fh = h5py.File(filepath, 'a', driver=self.driver, libver='latest')
-        for id, spectrum in zip(ids, all_spectra):
+        hashes = all_meta.get(HASH_FIELD, [None] * len(ids))
+        fh = self.open_output(filepath)
+        for id, spectrum, digest in zip(ids, all_spectra, hashes):
             path = f'/spectra/{id}'
             if path in fh:
                 self.logger.warning(f'Overwriting previous entry in {path}')
                 del fh[path]
-            fh.create_dataset(path, data=spectrum)
-        fh.close()
+            original = None
+            if self.duplicates == 'link':
+                original = f'/spectra/{self.content_hashes.get(digest)}'
+            if original not in (None, path) and original in fh:
+                # A hard link: the duplicate takes no space of its own.
+                fh[path] = fh[original]
+            else:
+                fh.create_dataset(path, data=spectrum)
+        self.close_output(fh)
+
+    def rollback_data(self, journal):
+        """
+        Remove spectra written by an uncommitted batch, except those
+        of IDs that were already in the committed output.
+
+        Parameters
+        ----------
+        journal : dict
+            The batch’s journal entry from `commit_batch()`.
+        """
+        committed = set(self.get_processed_ids())
+        fh = self.open_output(self.output_path())
+        for id in journal['ids']:
+            if id in committed:
+                continue
+            paths = [f'/spectra/{id}']
+            paths += [f'/{PYRAMID_GROUP}/{factor}/{id}'
+                      for factor in self.pyramid or []]
+            for path in paths:
+                if path in fh:
+                    del fh[path]
+        self.close_output(fh)
+
+    def write_pyramid(self, start, all_spectra, all_meta):
+        """
+        Write decimated levels of a batch’s spectra (see `pyramid.py`)
+        to the output file as `/pyramid/<factor>/<id>` datasets.
+
+        Parameters
+        ----------
+        start : int
+            Output row of the batch’s first row. Unused in Trajectory
+            output.
+        all_spectra
+            Data to write.
+        all_meta
+            Metadata about spectra.
+        """
+        fh = self.open_output(self.output_path())
+        write_trajectory_pyramid(fh, self.pyramid, all_meta[self.pkey_field],
+                                 all_spectra)
+        self.close_output(fh)
+
+    def fill_pyramid(self):
+        """
+        Write decimated levels of committed spectra that have none, as
+        in output written before `pyramid` was configured.
+        """
+        meta = self.read_metadata()
+        if meta is None:
+            return
+        fh = self.open_output(self.output_path())
+        missing = [id for id in meta[self.pkey_field]
+                   if any(f'/{PYRAMID_GROUP}/{factor}/{id}' not in fh
+                          for factor in self.pyramid)]
+        if missing:
+            self.logger.info(f'Decimating {len(missing)} spectra')
+        write_trajectory_pyramid(fh, self.pyramid, missing,
+                                 (fh[f'/spectra/{id}'][()] for id in missing))
+        self.close_output(fh)
+
+    def stored_hashes(self, meta):
+        """
+        Hash the committed spectrum of each ID for `fill_hashes()`.
+
+        Parameters
+        ----------
+        meta : dict
+            The metadata output.
+
+        Returns
+        -------
+            An array of the content hash of every row.
+        """
+        fh = self.open_output(self.output_path())
+        hashes = np.array([content_hash(fh[f'/spectra/{id}'][()])
+                           for id in meta[self.pkey_field]])
+        self.close_output(fh)
+        return hashes
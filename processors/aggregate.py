@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import h5py
+import json
+import numpy as np
+import os
+from .state import hdf5_options
+
+DEFAULTS = {
+    'field': None,
+    'output_prefix': 'samples',
+}
+BLOCK_BYTES = 64 * 2**20
+
+
+def aggregate_config(config):
+    """
+    Checks a dataset’s `aggregate` configuration.
+
+    Parameters
+    ----------
+    config
+        The configured options, or True for the defaults. Without a
+        `field`, the dataset type’s `sample_field` is used.
+
+    Returns
+    -------
+        The options with defaults filled in.
+    """
+    return {**DEFAULTS, **(config if isinstance(config, dict) else {})}
+
+
+def aggregate_path(importer):
+    """
+    Returns
+    -------
+        The per-sample aggregate output filename of a dataset.
+    """
+    return os.path.join(importer.paths['output'],
+                        importer.aggregate['output_prefix'] + '.hdf5')
+
+
+def sample_keys(values):
+    """
+    Returns
+    -------
+        Sample field values as an array of strings, decoding bytes.
+    """
+    return np.array([v.decode() if isinstance(v, bytes) else str(v)
+                     for v in values], dtype=object)
+
+
+def shot_rows(ids, shots):
+    """
+    Picks the rows of individual shots. A row with shot number 0 is
+    the mean of its ID’s other rows, unless it is the ID’s only row, as
+    in averaged output.
+
+    Parameters
+    ----------
+    ids : array
+        Primary key of every row.
+    shots : array
+        Shot number of every row, or None if the dataset has none.
+
+    Returns
+    -------
+        A boolean array, True for rows to aggregate.
+    """
+    if shots is None:
+        return np.ones(len(ids), dtype=bool)
+    _, inverse, counts = np.unique(ids, return_inverse=True,
+                                   return_counts=True)
+    return (np.asarray(shots) != 0) | (counts[inverse] == 1)
+
+
+def group_stats(spectra, samples):
+    """
+    Computes the count, mean and (population) variance of the spectra
+    of each sample in a block, with one pass of `np.add.reduceat` over
+    the rows sorted by sample for the sums and another for the squared
+    deviations.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    samples : array
+        Sample of each row.
+
+    Returns
+    -------
+        The distinct samples in sorted order, and their counts, means
+        and variances.
+    """
+    keys, inverse = np.unique(samples, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    counts = np.bincount(inverse, minlength=len(keys))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    data = np.asarray(spectra, dtype=float)[order]
+    means = np.add.reduceat(data, starts, axis=0) / counts[:, None]
+    data -= np.repeat(means, counts, axis=0)
+    np.square(data, out=data)
+    variances = np.add.reduceat(data, starts, axis=0) / counts[:, None]
+    return keys, counts, means, variances
+
+
+def merge(fh, keys, counts, means, variances):
+    """
+    Folds the statistics of a block into the aggregate file by Chan
+    et al.’s pairwise update, reading and rewriting only the rows of
+    the samples in the block. New samples are appended.
+    """
+    known = {key: row for row, key in
+             enumerate(fh['keys'].asstr()[()])}
+    new = np.array([key not in known for key in keys])
+    if new.any():
+        first = fh['keys'].shape[0]
+        for name in ('keys', 'count', 'mean', 'variance'):
+            fh[name].resize(first + new.sum(), axis=0)
+        fh['keys'][first:] = keys[new].astype(str).tolist()
+        fh['count'][first:] = counts[new]
+        fh['mean'][first:] = means[new]
+        fh['variance'][first:] = variances[new]
+    if new.all():
+        return
+    rows = np.array([known[key] for key in keys[~new]])
+    order = np.argsort(rows)
+    rows = rows[order]
+    n_b = counts[~new][order][:, None].astype(float)
+    mean_b = means[~new][order]
+    m2_b = variances[~new][order] * n_b
+    n_a = fh['count'][rows][:, None].astype(float)
+    mean_a = fh['mean'][rows]
+    m2_a = fh['variance'][rows] * n_a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    fh['mean'][rows] = mean_a + delta * (n_b / n)
+    fh['variance'][rows] = (m2_a + m2_b + delta**2 * (n_a * n_b / n)) / n
+    fh['count'][rows] = n[:, 0].astype(np.int64)
+
+
+def update_aggregate(importer, spectra=None, start=None, meta=None):
+    """
+    Brings a vector dataset’s per-sample aggregate output up to date
+    with its main output. It holds, for every distinct value of the
+    sample field, the number of shots (`/count`), their mean
+    (`/mean`) and their population variance (`/variance`) on every
+    channel, with the samples in `/keys`; the mean rows of a file’s
+    shots are left out, so each shot counts once.
+
+    The statistics are updated incrementally: the rows committed to the
+    main output since the last update are grouped by sample and folded
+    in, touching only the rows of their samples. Usually these are the
+    batch just committed, whose spectra are passed in; otherwise, as
+    after an interruption, a rebuild or a change of options, the
+    missing rows are read back from the main output in large blocks.
+    Folding a block in cannot be undone, so if the main output has
+    lost rows, or an update was interrupted, all rows are aggregated
+    again.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    spectra : array
+        The spectra of the batch just committed, if any.
+    start : int
+        Output row of the batch’s first row.
+    meta : dict
+        The main output’s metadata, if already loaded, as after
+        `commit_batch()` writes it.
+
+    Returns
+    -------
+        The number of rows aggregated.
+    """
+    if meta is None:
+        meta = importer.read_metadata()
+    if meta is None:
+        return 0
+    config = dict(importer.aggregate)
+    config['field'] = config['field'] or getattr(importer, 'sample_field',
+                                                 None)
+    ids = meta[importer.pkey_field]
+    rows = len(ids)
+    if config['field'] not in meta:
+        importer.logger.warning(f'{importer.name} metadata has no sample '
+                                f'field {config["field"]}; not aggregating')
+        return 0
+    settings = json.dumps(config, sort_keys=True)
+    path = aggregate_path(importer)
+    with h5py.File(path, 'a', libver='latest',
+                   **hdf5_options(path, None)) as fh:
+        done = int(fh['committed'][()]) if 'committed' in fh else 0
+        if done > rows or 'pending' in fh.attrs or \
+                fh.attrs.get('aggregate', settings) != settings:
+            importer.logger.info(f'Aggregating all of {importer.name} again')
+            done = 0
+        if done == rows:
+            return 0
+        if done == 0:
+            for name in ('keys', 'count', 'mean', 'variance', 'committed'):
+                if name in fh:
+                    del fh[name]
+            channels = importer.channels
+            fh.create_dataset('keys', shape=(0,), dtype=h5py.string_dtype(),
+                              chunks=True, maxshape=(None,))
+            fh.create_dataset('count', shape=(0,), dtype=np.int64,
+                              chunks=True, maxshape=(None,))
+            for name in ('mean', 'variance'):
+                fh.create_dataset(name, shape=(0, channels), dtype=float,
+                                  chunks=True, maxshape=(None, channels))
+        fh.attrs['aggregate'] = settings
+        fh.attrs['pending'] = [done, rows]
+        fh.flush()
+        samples = sample_keys(meta[config['field']])
+        keep = shot_rows(ids, meta.get(getattr(importer, 'shot_field',
+                                               None)))
+
+        def fold(first, data):
+            mask = keep[first:first + len(data)]
+            if mask.any():
+                merge(fh, *group_stats(np.asarray(data)[mask],
+                                       samples[first:first + len(data)][mask]))
+
+        if spectra is not None and start == done and \
+                start + len(spectra) == rows:
+            fold(start, spectra)
+        else:
+            source = importer.open_output(importer.output_path())
+            try:
+                src = source['/spectra']
+                step = max(1, BLOCK_BYTES // (src.shape[1] * 8))
+                for first in range(done, rows, step):
+                    fold(first, src[first:min(first + step, rows)])
+            finally:
+                importer.close_output(source)
+        if 'committed' in fh:
+            fh['committed'][()] = rows
+        else:
+            fh.create_dataset('committed', data=rows)
+        del fh.attrs['pending']
+    importer.logger.debug(f'Aggregated rows {done} to {rows}')
+    return rows - done
+
+
+def read_sample(path, sample):
+    """
+    Reads one sample’s statistics from an aggregate output.
+
+    Parameters
+    ----------
+    path : string
+        The aggregate output filename.
+    sample
+        The value of the sample field.
+
+    Returns
+    -------
+        A tuple of the number of shots and the arrays of their mean and
+        population variance, or None if the sample has no shots.
+    """
+    with h5py.File(path, 'r') as fh:
+        keys = fh['keys'].asstr()[()]
+        match = np.flatnonzero(keys == sample_keys([sample])[0])
+        if not len(match):
+            return None
+        row = int(match[0])
+        return (int(fh['count'][row]), fh['mean'][row],
+                fh['variance'][row])
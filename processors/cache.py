@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import numpy as np
+import os
+
+
+class SpectrumCache(object):
+    """
+    Binary cache of parsed spectra files.
+
+    Each entry is keyed by the source file’s path, size, and
+    modification time, and by the parameters it was parsed with, so
+    editing or replacing a file, or changing how it is parsed,
+    invalidates its entry. The parsed array is stored as `<key>.npy`
+    and read back memory-mapped; any other parse results (such as
+    header metadata) are stored alongside it as `<key>.json`.
+
+    Entries that can no longer be used are only removed by `prune()`;
+    the whole cache directory can also be deleted at any time.
+    """
+
+    def __init__(self, cache_dir, namespace, parameters=None):
+        """
+        Parameters
+        ----------
+        cache_dir
+            Directory to hold the cache; created if needed.
+        namespace
+            Distinguishes entries for the same file parsed in different
+            ways, usually the processor’s class name.
+        parameters : dict
+            JSON-serializable options the parse depends on, such as the
+            number of channels.
+        """
+        self.cache_dir = cache_dir
+        self.namespace = namespace
+        self.parameters = json.dumps(parameters, sort_keys=True)
+
+    def entry_path(self, filepath):
+        """
+        Finds where the cache entry for a file is stored.
+
+        Parameters
+        ----------
+        filepath
+            The full path of a spectra file.
+
+        Returns
+        -------
+            Path of the entry without extension, or None if the file
+            does not exist.
+        """
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        key = '\0'.join((self.namespace, self.parameters,
+                         os.path.abspath(filepath), str(stat.st_size),
+                         str(stat.st_mtime_ns)))
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, filepath):
+        """
+        Reads a cached parse result.
+
+        Parameters
+        ----------
+        filepath
+            The full path of a spectra file.
+
+        Returns
+        -------
+            The value originally passed to `put()`, with the array
+            memory-mapped, or None if there is no entry.
+        """
+        entry = self.entry_path(filepath)
+        if entry is None or not os.path.exists(entry + '.json'):
+            return None
+        with open(entry + '.json') as f:
+            info = json.load(f)
+        array = np.load(entry + '.npy', mmap_mode='r')
+        if info['extra'] is None:
+            return array
+        return (array, *info['extra'])
+
+    def put(self, filepath, result):
+        """
+        Stores a parse result. Results that are not an array, or a tuple
+        of an array followed by JSON-serializable values, are ignored.
+
+        Parameters
+        ----------
+        filepath
+            The full path of a spectra file.
+        result
+            The return value of the parser.
+        """
+        if isinstance(result, np.ndarray):
+            array, extra = result, None
+        elif isinstance(result, tuple) and result and \
+                isinstance(result[0], np.ndarray):
+            array, extra = result[0], list(result[1:])
+        else:
+            return
+        entry = self.entry_path(filepath)
+        if entry is None:
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_suffix = f'.{os.getpid()}.tmp'
+        with open(entry + '.npy' + tmp_suffix, 'wb') as f:
+            np.save(f, array)
+        os.replace(entry + '.npy' + tmp_suffix, entry + '.npy')
+        # The JSON file is written last and marks the entry complete.
+        with open(entry + '.json' + tmp_suffix, 'w') as f:
+            json.dump({'path': filepath, 'namespace': self.namespace,
+                       'extra': extra}, f)
+        os.replace(entry + '.json' + tmp_suffix, entry + '.json')
+
+    def prune(self):
+        """
+        Removes the entries of this namespace that can no longer be
+        used: those of files that were changed or removed since, or
+        parsed with other parameters. Entries written before the
+        namespace was recorded are removed too. Incomplete entries are
+        left alone, as they may still be being written.
+
+        Returns
+        -------
+            The number of entries removed.
+        """
+        removed = 0
+        if not os.path.isdir(self.cache_dir):
+            return removed
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                entry = os.path.join(dirpath, filename[:-len('.json')])
+                try:
+                    with open(entry + '.json') as f:
+                        info = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if info.get('namespace', self.namespace) != self.namespace \
+                        or self.entry_path(info['path']) == entry:
+                    continue
+                # The JSON file goes first, so the entry is never read
+                # without its array.
+                for suffix in ('.json', '.npy'):
+                    try:
+                        os.remove(entry + suffix)
+                    except FileNotFoundError:
+                        pass
+                removed += 1
+        return removed
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+import json
+import numpy as np
+import os
+import sqlite3
+from .state import file_fingerprint
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (
+    dataset TEXT PRIMARY KEY,
+    type TEXT,
+    output TEXT,
+    meta_output TEXT,
+    rows INTEGER,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS spectra (
+    dataset TEXT NOT NULL,
+    id TEXT NOT NULL,
+    sample TEXT,
+    path TEXT,
+    row INTEGER,
+    count INTEGER,
+    metadata TEXT,
+    PRIMARY KEY (dataset, id)
+);
+CREATE INDEX IF NOT EXISTS spectra_sample ON spectra (sample);
+CREATE INDEX IF NOT EXISTS spectra_id ON spectra (id);
+'''
+UPSERT = '''
+INSERT INTO spectra (dataset, id, sample, path, row, count, metadata)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (dataset, id) DO UPDATE SET
+    sample = excluded.sample, path = excluded.path, row = excluded.row,
+    count = excluded.count, metadata = excluded.metadata
+'''
+
+
+def connect(path):
+    """
+    Opens the catalog database, creating its tables if needed.
+
+    Parameters
+    ----------
+    path : string
+        The SQLite database filename.
+
+    Returns
+    -------
+        An open `sqlite3.Connection`.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def plain(value):
+    """
+    Returns
+    -------
+        A metadata value as a JSON-serializable Python value, with
+        bytes decoded and NaN as None.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode(errors='replace')
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def catalog_entries(importer, meta, first, rows):
+    """
+    Builds the catalog rows for a range of metadata rows, one per ID:
+    where its spectra are in the output, and its sample and first
+    metadata row. The rows of an ID in vector output are consecutive.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    meta : dict
+        The metadata output.
+    first, rows : int
+        The range of metadata rows.
+
+    Returns
+    -------
+        A list of tuples in the order of `UPSERT`’s values.
+    """
+    ids = meta[importer.pkey_field][first:rows]
+    if importer.is_trajectory():
+        starts = np.arange(len(ids))
+    else:
+        starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    counts = np.diff(np.r_[starts, len(ids)])
+    field = getattr(importer, 'sample_field', None)
+    columns = list(meta)
+    entries = []
+    for start, count in zip(starts.tolist(), counts.tolist()):
+        row = first + start
+        id = str(plain(ids[start]))
+        values = {k: plain(meta[k][row]) for k in columns}
+        sample = values.get(field)
+        path = f'/spectra/{id}' if importer.is_trajectory() else '/spectra'
+        entries.append((importer.name, id,
+                        None if sample is None else str(sample), path, row,
+                        count, json.dumps(values, default=str)))
+    return entries
+
+
+def update_catalog(importer, start=None, meta=None):
+    """
+    Brings a dataset’s entries in the shared catalog up to date with
+    its metadata output, in one SQLite transaction. The catalog has a
+    row per ID of every dataset in `spectra`, indexed by ID and by
+    sample, and a row per dataset in `datasets` with its output file
+    and the number of metadata rows cataloged.
+
+    Usually only the batch just committed is added, starting at
+    `start`. Otherwise, as after an interruption, only the missing
+    rows are added if rows were only appended; if the metadata was
+    changed in place, as by `--refresh-metadata`, or rows were removed,
+    the dataset is cataloged again.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    start : int
+        Metadata row of the first row of the batch just committed.
+    meta : dict
+        The dataset’s metadata, if already loaded, as after
+        `commit_batch()` writes it.
+
+    Returns
+    -------
+        The number of metadata rows cataloged.
+    """
+    if meta is None:
+        meta = importer.read_metadata()
+    rows = 0 if meta is None else len(meta[importer.pkey_field])
+    fingerprint = json.dumps(file_fingerprint(importer.paths['meta_output']))
+    conn = connect(importer.catalog)
+    try:
+        with conn:
+            found = conn.execute(
+                'SELECT rows, fingerprint FROM datasets WHERE dataset = ?',
+                (importer.name,)).fetchone()
+            done, previous = found or (0, None)
+            if previous == fingerprint:
+                return 0
+            if start is not None and start == done:
+                first = start
+            elif done < rows:
+                first = done
+            else:
+                first = 0
+            if first == 0:
+                conn.execute('DELETE FROM spectra WHERE dataset = ?',
+                             (importer.name,))
+            if rows > first:
+                conn.executemany(UPSERT, catalog_entries(importer, meta,
+                                                         first, rows))
+            conn.execute(
+                'INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?)',
+                (importer.name, getattr(importer, 'type', None),
+                 os.path.abspath(importer.output_path()),
+                 os.path.abspath(importer.paths['meta_output']), rows,
+                 fingerprint))
+    finally:
+        conn.close()
+    importer.logger.debug(f'Cataloged rows {first} to {rows}')
+    return rows - first
+
+
+def forget_dataset(importer):
+    """
+    Removes a dataset from the catalog, so it is cataloged again in
+    full, as after its output was rebuilt in a different order.
+    """
+    conn = connect(importer.catalog)
+    try:
+        with conn:
+            for table in ('spectra', 'datasets'):
+                conn.execute(f'DELETE FROM {table} WHERE dataset = ?',
+                             (importer.name,))
+    finally:
+        conn.close()
+
+
+def find_spectra(path, sample=None, id=None):
+    """
+    Looks spectra up in the catalog by sample, ID, or both, across all
+    datasets.
+
+    Parameters
+    ----------
+    path : string
+        The catalog database filename.
+    sample : string
+        Value of a dataset’s sample field.
+    id : string
+        Value of a dataset’s primary key.
+
+    Returns
+    -------
+        A list of dicts with the `dataset`, `type`, `id`, `sample`,
+        `output` file, `path` in it and first `row` and `count` of rows
+        of each match, and its first metadata row as `metadata`.
+    """
+    where, params = [], []
+    for column, value in (('sample', sample), ('id', id)):
+        if value is not None:
+            where.append(f's.{column} = ?')
+            params.append(str(value))
+    query = ('SELECT s.dataset, d.type, s.id, s.sample, d.output, s.path, '
+             's.row, s.count, s.metadata FROM spectra s '
+             'JOIN datasets d ON d.dataset = s.dataset')
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    conn = connect(path)
+    try:
+        results = conn.execute(query + ' ORDER BY s.dataset, s.row',
+                               params).fetchall()
+    finally:
+        conn.close()
+    keys = ('dataset', 'type', 'id', 'sample', 'output', 'path', 'row',
+            'count', 'metadata')
+    matches = [dict(zip(keys, result)) for result in results]
+    for match in matches:
+        match['metadata'] = json.loads(match['metadata'])
+    return matches
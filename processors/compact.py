@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import fcntl
+import glob
+import h5py
+import numpy as np
+import os
+import shutil
+from .index import create_index
+from .pyramid import copy_pyramid
+from .rebuild import SHARD_DIR
+from .similarity import copy_similarity
+from .state import file_fingerprint, hdf5_options
+
+CHUNK_BYTES = 2**20
+BLOCK_BYTES = 64 * 2**20
+
+
+def compact(importer, member_size=None, block_bytes=BLOCK_BYTES):
+    """
+    Rewrite a dataset’s spectra output without the space left behind by
+    repeated resizes and overwritten entries.
+
+    Vector spectra are copied in blocks of about `block_bytes` into a
+    dataset with chunks of about 1 MiB of whole rows; trajectory spectra
+    are copied one by one, in metadata order, into a fresh group. The ID
+    index is recreated from the metadata, and any decimated levels and
+    similarity index are copied. Output stitched from shards by a
+    rebuild is materialized, after which the shards are deleted. The
+    copy is compared with the original before it replaces it.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    member_size : float
+        Family member size in MiB for the new output; by default the
+        dataset’s `member_size`, or h5py’s default.
+    block_bytes : int
+        Approximate memory to use for copying vector spectra.
+
+    Returns
+    -------
+        True if the output was replaced.
+    """
+    logger = importer.logger
+    importer.recover()
+    importer.close()
+    src_path = importer.output_path()
+    first_member = src_path.replace('%03d', '000')
+    if not os.path.exists(first_member):
+        logger.info(f'No output to compact for {importer.name}')
+        return False
+    member_size = member_size or importer.member_size
+    rows = importer.count_rows()
+    suffix = '.hdf5' if importer.driver is None else '.%03d.hdf5'
+    new_prefix = f'{importer.output_prefix}_compact_{os.getpid()}'
+    dst_path = os.path.join(importer.paths['output'], new_prefix + suffix)
+    meta = importer.read_metadata()
+    pkeys = [] if meta is None else meta[importer.pkey_field][:rows]
+    ids = None
+    if importer.is_trajectory():
+        ids = [str(id) for id in pkeys]
+    before = output_size(src_path)
+    try:
+        with h5py.File(src_path, 'r', libver='latest',
+                       **hdf5_options(src_path, importer.driver)) as src, \
+                h5py.File(dst_path, 'w', libver='latest',
+                          **hdf5_options(dst_path, importer.driver,
+                                         member_size)) as dst:
+            if ids is None:
+                copy_rows(src['spectra'], dst, rows, block_bytes)
+            else:
+                group = dst.create_group('spectra')
+                # Spectra linked by `duplicates: link` stay linked.
+                copied = {}
+                for id in ids:
+                    dset = src[f'spectra/{id}']
+                    if id in group:
+                        continue
+                    if dset.id in copied:
+                        group[id] = group[copied[dset.id]]
+                    else:
+                        src.copy(dset, group, id)
+                        copied[dset.id] = id
+            dst.create_dataset('committed', data=rows)
+            create_index(dst, importer.pkey_field, pkeys)
+            copy_pyramid(src, dst, rows, ids)
+            copy_similarity(src, dst, rows)
+        with h5py.File(src_path, 'r', libver='latest',
+                       **hdf5_options(src_path, importer.driver)) as src, \
+                h5py.File(dst_path, 'r', libver='latest',
+                          **hdf5_options(dst_path, importer.driver)) as dst:
+            verify(src, dst, rows, ids, block_bytes)
+        swap(src_path, dst_path)
+    except BaseException:
+        for path in glob.glob(os.path.join(importer.paths['output'],
+                                           glob.escape(new_prefix) + '.*')):
+            os.remove(path)
+        raise
+    shard_dir = os.path.join(importer.paths['output'], SHARD_DIR)
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    after = output_size(src_path)
+    logger.info(f'Compacted {importer.name} output from {before / 2**20:.1f} '
+                f'to {after / 2**20:.1f} MiB')
+    return True
+
+
+def copy_rows(spectra, dst, rows, block_bytes):
+    """
+    Stream committed rows of vector spectra into a new dataset.
+
+    Parameters
+    ----------
+    spectra
+        The source `/spectra` dataset.
+    dst
+        The new output file.
+    rows : int
+        Number of committed rows to copy.
+    block_bytes : int
+        Approximate size of each block read.
+    """
+    channels = spectra.shape[1]
+    row_bytes = channels * spectra.dtype.itemsize
+    chunk_rows = max(1, min(rows, CHUNK_BYTES // row_bytes))
+    block_rows = max(chunk_rows, block_bytes // row_bytes // chunk_rows *
+                     chunk_rows)
+    dset = dst.create_dataset('spectra', shape=(rows, channels),
+                              dtype=spectra.dtype, maxshape=(None, channels),
+                              chunks=(chunk_rows, channels))
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        dset[start:stop] = spectra[start:stop]
+
+
+def verify(src, dst, rows, ids, block_bytes):
+    """
+    Check that a compacted copy holds exactly the committed spectra.
+
+    Parameters
+    ----------
+    src, dst
+        The original and new output files.
+    rows : int
+        Number of committed rows.
+    ids : list
+        IDs of trajectory spectra, or None for vector spectra.
+    block_bytes : int
+        Approximate size of each block compared.
+
+    Raises
+    ------
+    ValueError
+        If any spectrum differs.
+    """
+    if ids is not None:
+        for id in ids:
+            a, b = src[f'spectra/{id}'], dst[f'spectra/{id}']
+            if a.dtype != b.dtype or \
+                    not np.array_equal(a[()], b[()], equal_nan=True):
+                raise ValueError(f'Compacted spectrum {id} differs')
+        return
+    a, b = src['spectra'], dst['spectra']
+    if b.shape[0] != rows or a.dtype != b.dtype:
+        raise ValueError('Compacted spectra have the wrong shape or type')
+    block_rows = max(1, block_bytes // (a.shape[1] * a.dtype.itemsize))
+    for start in range(0, rows, block_rows):
+        stop = min(start + block_rows, rows)
+        if not np.array_equal(a[start:stop], b[start:stop], equal_nan=True):
+            raise ValueError(f'Compacted rows {start} to {stop} differ')
+
+
+def swap(old_path, new_path):
+    """
+    Replace an output file (or family) with a new one.
+
+    A single file is replaced atomically. A family is replaced member by
+    member while holding HDF5’s lock on the old first member, ending
+    with the first member, so that readers that lock files see either
+    the old or the new output but never a mixture.
+
+    Parameters
+    ----------
+    old_path, new_path
+        Full paths of the output files (patterns, for families).
+
+    Raises
+    ------
+    OSError
+        If another process has the old output open.
+    """
+    if '%03d' not in old_path:
+        os.replace(new_path, old_path)
+        return
+    old = sorted(glob.glob(glob.escape(old_path).replace('%03d', '[0-9]*')))
+    new = sorted(glob.glob(glob.escape(new_path).replace('%03d', '[0-9]*')))
+    with open(old[0], 'rb') as f:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        for index in range(len(new), len(old)):
+            os.remove(old_path % index)
+        for index in reversed(range(len(new))):
+            os.replace(new_path % index, old_path % index)
+
+
+def output_size(filepath):
+    """
+    Parameters
+    ----------
+    filepath
+        Full path of an output file (pattern, for a family).
+
+    Returns
+    -------
+        Total size in bytes of the file or family members.
+    """
+    paths = glob.glob(glob.escape(filepath).replace('%03d', '[0-9]*'))
+    return sum(file_fingerprint(path)[0] for path in paths)
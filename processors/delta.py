@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import glob
+import h5py
+import hashlib
+import logging
+import numpy as np
+import os
+import shutil
+from .aggregate import aggregate_path, update_aggregate
+from .index import INDEX_GROUP, create_index, update_index
+from .preprocess import preprocessed_path, update_preprocessed
+from .pyramid import PYRAMID_GROUP, update_pyramid, write_trajectory_pyramid
+from .resample import resampled_path, update_resampled
+from .similarity import SIMILARITY_GROUP, update_similarity
+from .state import hdf5_options, load_state, save_state
+from time import strftime
+
+MANIFEST_FILE = 'manifest.json'
+SPECTRA_FILE = 'spectra.hdf5'
+META_FILE = 'meta.npz'
+CHANNELS_FILE = 'channels.npy'
+
+
+class DeltaTarget(object):
+    """
+    A copy of a dataset’s output that bundles are applied to, presented
+    like the processor that wrote the original, as described by a
+    bundle’s manifest, so that outputs derived from the spectra can be
+    brought up to date by the same functions (see `preprocess.py`,
+    `resample.py` and `aggregate.py`).
+    """
+
+    def __init__(self, manifest, output_dir, logger=None):
+        """
+        Parameters
+        ----------
+        manifest : dict
+            As written by `export_delta()`.
+        output_dir : string
+            Directory holding the copy of the output.
+        logger
+            Defaults to the root logger.
+        """
+        self.name = manifest['dataset']
+        self.logger = logger or logging.getLogger()
+        self.output_prefix = manifest['output_prefix']
+        self.driver = manifest['driver']
+        self.member_size = manifest.get('member_size')
+        self.pkey_field = manifest['pkey_field']
+        self.channels = manifest.get('channels')
+        self.pyramid = manifest.get('pyramid')
+        self.similarity = manifest.get('similarity')
+        self.preprocess = manifest.get('preprocess')
+        self.resample = manifest.get('resample')
+        self.aggregate = manifest.get('aggregate')
+        self.sample_field = manifest.get('sample_field')
+        self.shot_field = manifest.get('shot_field')
+        self.paths = {
+            'output': output_dir,
+            'meta_output': os.path.join(output_dir,
+                                        self.output_prefix + '_meta.npz'),
+        }
+
+    def output_path(self):
+        """
+        Returns
+        -------
+            The spectra output filename (pattern, for the family driver).
+        """
+        suffix = '.hdf5' if self.driver is None else '.%03d.hdf5'
+        return os.path.join(self.paths['output'], self.output_prefix + suffix)
+
+    def open_output(self, filepath):
+        """
+        Returns
+        -------
+            An output file, opened for appending.
+        """
+        return h5py.File(filepath, 'a', libver='latest',
+                         **hdf5_options(filepath, self.driver,
+                                        self.member_size))
+
+    def close_output(self, fh):
+        fh.close()
+
+    def read_metadata(self):
+        """
+        Returns
+        -------
+            A dict of column name to array, or None if there is no
+            metadata output.
+        """
+        if not os.path.exists(self.paths['meta_output']):
+            return None
+        with np.load(self.paths['meta_output'], allow_pickle=True) as npz:
+            return {k: npz[k] for k in npz.files}
+
+
+def meta_digest(meta, rows):
+    """
+    Summarizes the first rows of a metadata table, to detect whether
+    rows that were already exported have since been changed.
+
+    Parameters
+    ----------
+    meta : dict
+        Column name to array, as from `read_metadata()`.
+    rows : int
+        Number of rows to include.
+
+    Returns
+    -------
+        A hex digest string.
+    """
+    digest = hashlib.sha1()
+    for key in sorted(meta):
+        column = meta[key][:rows]
+        digest.update(f'{key}\0{column.dtype.str}\0'.encode())
+        if column.dtype.hasobject:
+            digest.update(repr(column.tolist()).encode())
+        else:
+            digest.update(np.ascontiguousarray(column).tobytes())
+    return digest.hexdigest()
+
+
+def export_delta(importer, bundle_dir):
+    """
+    Writes the spectra and metadata rows added to a dataset’s output
+    since its last export as a self-contained bundle for `apply_delta()`.
+
+    The number of rows already exported (the watermark) is kept in the
+    dataset’s state file. If earlier rows have changed since, as after
+    `refresh_metadata()`, the bundle carries the whole metadata table
+    but still only the new spectra. If the output has fewer rows than
+    the watermark, it was rebuilt and the bundle starts from scratch.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    bundle_dir : string
+        Directory holding this dataset’s bundles, one subdirectory per
+        export, named by sequence number.
+
+    Returns
+    -------
+        Path of the new bundle, or None if there was nothing to export.
+    """
+    logger = importer.logger
+    meta = importer.read_metadata()
+    if meta is None:
+        logger.info(f'No output to export for {importer.name}')
+        return None
+    state = load_state(importer.paths['state'])
+    previous = state.get('export', {})
+    stop = len(meta[importer.pkey_field])
+    start = previous.get('rows', 0)
+    if stop < start:
+        logger.warning(f'Output has {stop} rows but {start} were exported; '
+                       f'exporting it all again')
+        start = 0
+    full_meta = start == 0 or \
+        meta_digest(meta, start) != previous.get('meta_digest')
+    if start == stop and not full_meta:
+        logger.info(f'No new rows to export for {importer.name}')
+        return None
+    sequence = previous.get('sequence', 0) + 1
+    bundle = os.path.join(bundle_dir, f'{sequence:06d}')
+    tmp_bundle = f'{bundle}.{os.getpid()}.tmp'
+    os.makedirs(tmp_bundle)
+    try:
+        output = importer.open_output(importer.output_path())
+        try:
+            with h5py.File(os.path.join(tmp_bundle, SPECTRA_FILE), 'w') as fh:
+                if importer.is_trajectory():
+                    ids = meta[importer.pkey_field][start:stop]
+                    for id in ids:
+                        output.copy(output[f'/spectra/{id}'], fh,
+                                    f'/spectra/{id}')
+                else:
+                    fh.create_dataset('spectra',
+                                      data=output['/spectra'][start:stop])
+        finally:
+            importer.close_output(output)
+        rows = slice(0, stop) if full_meta else slice(start, stop)
+        with open(os.path.join(tmp_bundle, META_FILE), 'wb') as f:
+            np.savez(f, **{k: v[rows] for k, v in meta.items()})
+        if os.path.exists(importer.paths['channels']):
+            shutil.copy2(importer.paths['channels'],
+                         os.path.join(tmp_bundle, CHANNELS_FILE))
+        manifest = {
+            'dataset': importer.name,
+            'sequence': sequence,
+            'created': strftime('%Y-%m-%dT%H:%M:%S'),
+            'output_prefix': importer.output_prefix,
+            'driver': importer.driver,
+            'member_size': importer.member_size,
+            'trajectory': importer.is_trajectory(),
+            'pkey_field': importer.pkey_field,
+            'channels_file': importer.channels_file,
+            'pyramid': importer.pyramid,
+            # Trajectory output is indexed in its resampled output.
+            'similarity': importer.similarity,
+            'channels': importer.channels,
+            'preprocess': importer.preprocess,
+            'resample': importer.resample,
+            'aggregate': importer.aggregate,
+            'sample_field': getattr(importer, 'sample_field', None),
+            'shot_field': getattr(importer, 'shot_field', None),
+            'start': start,
+            'stop': stop,
+            'full_meta': full_meta,
+        }
+        save_state(os.path.join(tmp_bundle, MANIFEST_FILE), manifest)
+        os.replace(tmp_bundle, bundle)
+    except BaseException:
+        shutil.rmtree(tmp_bundle, ignore_errors=True)
+        raise
+    state = load_state(importer.paths['state'])
+    state['export'] = {
+        'sequence': sequence,
+        'rows': stop,
+        'meta_digest': meta_digest(meta, stop),
+    }
+    save_state(importer.paths['state'], state)
+    logger.info(f'Exported rows {start} to {stop} of {importer.name} '
+                f'to {bundle}')
+    return bundle
+
+
+def list_bundles(path):
+    """
+    Finds bundles to apply.
+
+    Parameters
+    ----------
+    path : string
+        A bundle, or a directory of bundles for one dataset.
+
+    Returns
+    -------
+        A list of bundle paths in sequence order.
+    """
+    if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+        return [path]
+    bundles = [os.path.join(path, name) for name in os.listdir(path)]
+    bundles = [b for b in bundles
+               if os.path.isfile(os.path.join(b, MANIFEST_FILE))]
+    return sorted(bundles,
+                  key=lambda b: load_state(os.path.join(b, MANIFEST_FILE))
+                  ['sequence'])
+
+
+def apply_delta(bundle, output_dir, logger=None):
+    """
+    Merges one bundle from `export_delta()` into a copy of the output.
+
+    Bundles must be applied in sequence; one that was already applied
+    is skipped. Spectra are written first, then the metadata file is
+    replaced and `/committed` set to its row count, so an interrupted
+    apply can simply be run again.
+    Decimated levels, the similarity index, the preprocessed and
+    resampled outputs and the per-sample statistics are not carried in
+    bundles but computed from the new spectra.
+
+    Parameters
+    ----------
+    bundle : string
+        Path of the bundle.
+    output_dir : string
+        Directory holding the copy of the dataset’s output.
+    logger
+        Defaults to the root logger.
+
+    Returns
+    -------
+        True if the bundle was applied, False if it was skipped.
+    """
+    logger = logger or logging.getLogger()
+    manifest = load_state(os.path.join(bundle, MANIFEST_FILE))
+    prefix = manifest['output_prefix']
+    state_path = os.path.join(output_dir, prefix + '_state.json')
+    state = load_state(state_path)
+    applied = state.get('delta', {}).get('sequence', 0)
+    if manifest['sequence'] <= applied:
+        logger.info(f'Skipping {bundle}, already applied')
+        return False
+    meta_path = os.path.join(output_dir, prefix + '_meta.npz')
+    existing = None
+    rows = 0
+    if os.path.exists(meta_path):
+        with np.load(meta_path, allow_pickle=True) as npz:
+            existing = {k: npz[k] for k in npz.files}
+        rows = len(existing[manifest['pkey_field']])
+    start, stop = manifest['start'], manifest['stop']
+    # Rows up to `stop` are from this bundle, if an earlier attempt to
+    # apply it was interrupted after the metadata was replaced.
+    if start != 0 and rows not in (start, stop):
+        raise ValueError(f'{bundle} starts at row {start} but {meta_path} '
+                         f'has {rows}; apply the earlier bundles first')
+    with np.load(os.path.join(bundle, META_FILE), allow_pickle=True) as npz:
+        delta_meta = {k: npz[k] for k in npz.files}
+    if not manifest['full_meta']:
+        delta_meta = {k: np.concatenate((existing[k][:start], v))
+                      for k, v in delta_meta.items()}
+    field = manifest['pkey_field']
+
+    os.makedirs(output_dir, exist_ok=True)
+    suffix = '.hdf5' if manifest['driver'] is None else '.%03d.hdf5'
+    spectra_path = os.path.join(output_dir, prefix + suffix)
+    levels = manifest.get('pyramid')
+    spectra = None
+    with h5py.File(os.path.join(bundle, SPECTRA_FILE), 'r') as src, \
+            h5py.File(spectra_path, 'a', libver='latest',
+                      **hdf5_options(spectra_path, manifest['driver'],
+                                     manifest.get('member_size'))) as dst:
+        for group in (PYRAMID_GROUP, SIMILARITY_GROUP):
+            if start == 0 and group in dst:
+                del dst[group]
+        if manifest['trajectory']:
+            if start == 0 and 'spectra' in dst:
+                del dst['spectra']
+            for id in src.get('spectra', {}):
+                path = f'/spectra/{id}'
+                if path in dst:
+                    del dst[path]
+                src.copy(src[path], dst, path)
+                if levels:
+                    write_trajectory_pyramid(dst, levels, [id],
+                                             [src[path][()]])
+            if manifest.get('resample'):
+                spectra = [src[f'/spectra/{id}'][()]
+                           for id in delta_meta[field][start:stop]]
+        else:
+            spectra = src['spectra'][()]
+            if 'spectra' in dst:
+                # Rows past `start` are left over from an interrupted apply.
+                dset = dst['spectra']
+                dset.resize(start + spectra.shape[0], axis=0)
+                dset[start:] = spectra
+            else:
+                dst.create_dataset('spectra', chunks=True, data=spectra,
+                                   maxshape=(None, spectra.shape[1]))
+            if levels:
+                update_pyramid(dst, levels, start, spectra)
+            if manifest.get('similarity'):
+                update_similarity(dst, manifest['similarity'], start,
+                                  spectra)
+        if start == 0 and INDEX_GROUP in dst:
+            del dst[INDEX_GROUP]
+        if INDEX_GROUP in dst:
+            update_index(dst, delta_meta[field][start:stop], start)
+        else:
+            create_index(dst, field, delta_meta[field][:stop])
+
+    channels = os.path.join(bundle, CHANNELS_FILE)
+    if os.path.exists(channels):
+        target = os.path.join(output_dir, manifest['channels_file'])
+        shutil.copy2(channels, f'{target}.{os.getpid()}.tmp')
+        os.replace(f'{target}.{os.getpid()}.tmp', target)
+
+    tmp_path = f'{meta_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **delta_meta)
+    os.replace(tmp_path, meta_path)
+    # Publish the new rows, as `publish_committed()` does after each batch
+    with h5py.File(spectra_path, 'a', libver='latest',
+                   **hdf5_options(spectra_path, manifest['driver'],
+                                  manifest.get('member_size'))) as dst:
+        if 'committed' in dst:
+            dst['committed'][()] = stop
+        else:
+            dst.create_dataset('committed', data=stop)
+    # Outputs derived from the spectra follow, as after `commit_batch()`.
+    target = DeltaTarget(manifest, output_dir, logger)
+    if target.preprocess:
+        if start == 0:
+            pattern = glob.escape(preprocessed_path(target))
+            for path in glob.glob(pattern.replace('%03d', '[0-9]*')):
+                os.remove(path)
+        update_preprocessed(target, spectra, start, delta_meta)
+    if target.resample:
+        if start == 0 and os.path.exists(resampled_path(target)):
+            os.remove(resampled_path(target))
+        update_resampled(target, spectra, start, delta_meta)
+    if target.aggregate:
+        # Rows folded in cannot be taken out again.
+        if start == 0 and os.path.exists(aggregate_path(target)):
+            os.remove(aggregate_path(target))
+        update_aggregate(target, spectra, start, delta_meta)
+    state['delta'] = {'sequence': manifest['sequence'], 'rows': stop}
+    save_state(state_path, state)
+    logger.info(f'Applied rows {start} to {stop} of {manifest["dataset"]} '
+                f'from {bundle}')
+    return True
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+
+import glob
+import h5py
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import socket
+import threading
+from contextlib import contextmanager
+from time import sleep, time
+from uuid import uuid4
+from .duplicates import HASH_FIELD
+from .masterfiles import MasterfileRegistry
+from .rebuild import build_shard, shard_config
+from .state import hdf5_options, load_state
+
+QUEUE_DIR = 'queue'
+DEFAULTS = {
+    'unit_size': None,
+    'lease': 300,
+    'poll': 5,
+    'idle': 600,
+}
+
+
+def queue_config(config):
+    """
+    Checks the `queue` configuration.
+
+    Parameters
+    ----------
+    config : dict
+        The configured options, or None for the defaults.
+
+    Returns
+    -------
+        The options with defaults filled in.
+    """
+    return {**DEFAULTS, **(config or {})}
+
+
+def owner():
+    """
+    Returns
+    -------
+        Identifies this process across hosts, as host:pid.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def write_record(filepath, record, exclusive=False):
+    """
+    Writes a small JSON file so that other hosts only ever see it
+    complete: it is written under a name of its own, then renamed into
+    place, or, if `exclusive`, hard-linked into place, which fails if
+    the file exists, even over NFS.
+
+    Parameters
+    ----------
+    filepath : string
+        The full path of the file.
+    record : dict
+        JSON-serializable contents.
+    exclusive : bool
+        Whether to leave an existing file alone.
+
+    Returns
+    -------
+        True unless `exclusive` and the file already existed.
+    """
+    tmp_path = f'{filepath}.{owner().replace(":", ".")}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    if not exclusive:
+        os.replace(tmp_path, filepath)
+        return True
+    try:
+        os.link(tmp_path, filepath)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp_path)
+
+
+def read_record(filepath):
+    """
+    Returns
+    -------
+        The contents of a file from `write_record()`, or None if it
+        does not exist.
+    """
+    try:
+        with open(filepath) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class WorkQueue(object):
+    """
+    A queue of work units kept as files in a directory, which may be on
+    a filesystem shared by several hosts. Each unit is a list of input
+    files in `<unit>.json`. A worker claims a unit by creating its
+    `<unit>.lease`, which expires unless renewed, and finishes it by
+    creating `<unit>.result`, which says whether it was done or failed.
+    A unit whose lease has expired, as when its worker died, is claimed
+    again by the next worker to look.
+
+    Only one result is ever recorded for a unit, so a worker that was
+    too slow to renew its lease and finishes after another has taken
+    the unit over only wastes its work. Lease expiry times are compared
+    across hosts, so their clocks must agree to well within `lease`.
+    """
+
+    def __init__(self, directory, lease=DEFAULTS['lease'], logger=None):
+        self.directory = directory
+        self.lease = lease
+        self.logger = logger or logging.getLogger()
+
+    def path(self, unit, kind):
+        """
+        Returns
+        -------
+            The full path of one of a unit’s files, such as its 'lease'.
+        """
+        return os.path.join(self.directory, f'{unit}.{kind}')
+
+    def units(self):
+        """
+        Returns
+        -------
+            The names of the queued units, in order.
+        """
+        pattern = os.path.join(glob.escape(self.directory), 'unit_*.json')
+        return sorted(os.path.basename(path)[:-len('.json')]
+                      for path in glob.glob(pattern))
+
+    def create(self, units):
+        """
+        Replaces the queue with new units, discarding anything left in
+        the directory.
+
+        Parameters
+        ----------
+        units : list
+            The files of each unit, as pairs of input directory name and
+            file tuple.
+
+        Returns
+        -------
+            The names of the units.
+        """
+        self.remove()
+        os.makedirs(self.directory, mode=0o755)
+        names = [f'unit_{i:05d}' for i in range(len(units))]
+        for name, files in zip(names, units):
+            write_record(self.path(name, 'json'), {'files': files})
+        return names
+
+    def files(self, unit):
+        """
+        Returns
+        -------
+            A unit’s files, as pairs of input directory name and file
+            tuple.
+        """
+        record = read_record(self.path(unit, 'json'))
+        return [(dirname, tuple(file)) for dirname, file in record['files']]
+
+    def result(self, unit):
+        """
+        Returns
+        -------
+            The result of a finished unit, with its `status`, or None if
+            it is not finished.
+        """
+        return read_record(self.path(unit, 'result'))
+
+    def pending(self):
+        """
+        Returns
+        -------
+            Whether any unit is unfinished, whether or not it is leased.
+        """
+        return any(self.result(unit) is None for unit in self.units())
+
+    def claim(self):
+        """
+        Claims the first unit that is neither finished nor leased.
+
+        Returns
+        -------
+            A tuple of the unit and the token identifying the lease, or
+            None if there is nothing to claim.
+        """
+        for unit in self.units():
+            try:
+                if self.result(unit) is not None:
+                    continue
+                token = self.acquire(unit)
+            except FileNotFoundError:
+                # The coordinator removed the queue.
+                return None
+            if token is not None:
+                return unit, token
+        return None
+
+    def acquire(self, unit):
+        """
+        Takes out the lease on a unit, taking it over if it expired.
+
+        Returns
+        -------
+            The lease token, or None if the unit is leased or finished.
+        """
+        lease = self.path(unit, 'lease')
+        record = {'owner': owner(), 'token': uuid4().hex,
+                  'expires': time() + self.lease}
+        if not write_record(lease, record, exclusive=True):
+            held = read_record(lease)
+            if held is None or held['expires'] > time():
+                return None
+            # Only one of several workers can move it aside.
+            stale = f'{lease}.{record["token"]}'
+            try:
+                os.rename(lease, stale)
+            except FileNotFoundError:
+                return None
+            moved = read_record(stale)
+            if moved != held:
+                # Renewed or taken over since: put it back.
+                try:
+                    os.link(stale, lease)
+                except FileExistsError:
+                    pass
+                os.remove(stale)
+                return None
+            os.remove(stale)
+            self.logger.warning(f'Taking over {unit} from {held["owner"]}, '
+                                f'whose lease expired')
+            record['expires'] = time() + self.lease
+            if not write_record(lease, record, exclusive=True):
+                return None
+        if self.result(unit) is not None:
+            # Finished just before the lease was taken out
+            self.release(unit, record['token'])
+            return None
+        return record['token']
+
+    def renew(self, unit, token):
+        """
+        Extends a lease that is still held.
+
+        Returns
+        -------
+            False if the lease was lost to another worker.
+        """
+        lease = self.path(unit, 'lease')
+        try:
+            held = read_record(lease)
+            if held is None or held['token'] != token:
+                return False
+            write_record(lease, dict(held, expires=time() + self.lease))
+        except FileNotFoundError:
+            return False
+        return True
+
+    @contextmanager
+    def renewing(self, unit, token):
+        """
+        Keeps renewing a lease from a background thread while the
+        unit is being processed.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease / 3):
+                if not self.renew(unit, token):
+                    self.logger.warning(f'Lost the lease on {unit}')
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, unit, token):
+        """
+        Gives up a lease, if it is still held.
+        """
+        lease = self.path(unit, 'lease')
+        held = read_record(lease)
+        if held is not None and held['token'] == token:
+            try:
+                os.remove(lease)
+            except FileNotFoundError:
+                pass
+
+    def finish(self, unit, token, status, record):
+        """
+        Records the result of a unit and gives up its lease.
+
+        Parameters
+        ----------
+        status : string
+            'done' or 'failed'.
+        record : dict
+            JSON-serializable result.
+
+        Returns
+        -------
+            False if another worker had already finished the unit.
+        """
+        try:
+            finished = write_record(self.path(unit, 'result'),
+                                    dict(record, status=status,
+                                         owner=owner(), token=token),
+                                    exclusive=True)
+            self.release(unit, token)
+        except FileNotFoundError:
+            # The coordinator removed the queue.
+            return False
+        return finished
+
+    def remove(self):
+        """
+        Deletes the queue, with any shards left in it.
+        """
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+
+def queue_dir(importer):
+    """
+    Returns
+    -------
+        The directory of a dataset’s work queue and shards.
+    """
+    return os.path.join(importer.paths['output'], QUEUE_DIR)
+
+
+def coordinate(importer, config, unit_size=None, lease=DEFAULTS['lease'],
+               poll=DEFAULTS['poll']):
+    """
+    Process a dataset’s new input files on any number of hosts.
+
+    The files `main()` would process are split, in order, into units of
+    `unit_size` files, queued in the `queue` subdirectory of the output
+    directory (see `WorkQueue`). Workers (see `work()`) on any host that
+    mounts the output claim the units and process each into its own
+    shard output in the same directory. As each unit is finished, in
+    order, its shard is merged into the output, batch by batch as by
+    `commit_batch()`, so the output is always consistent and everything
+    derived from it is kept up to date. Files whose content duplicates
+    a file of another unit are skipped (or linked) here.
+
+    If the coordinator is interrupted, running it again picks up the
+    same queue, merging only the IDs not yet in the output. The files
+    of units that failed are processed again by the next run.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    config : dict
+        The dataset configuration `importer` was created with.
+    unit_size : int
+        Files per unit; defaults to the dataset’s `batch_size`.
+    lease : float
+        Seconds a claimed unit stays leased without renewal.
+    poll : float
+        Seconds between checks for finished units.
+
+    Returns
+    -------
+        The number of rows added to the output.
+    """
+    logger = importer.logger
+    logger.info(f'Coordinating processing for {importer.name}')
+    importer.recover()
+    importer.catch_up()
+    queue = WorkQueue(queue_dir(importer), lease, logger)
+    processed_ids = set(importer.get_processed_ids())
+    logger.info(f'Found {len(processed_ids)} IDs in existing output')
+    fresh = not processed_ids
+    units = queue.units()
+    if units:
+        logger.info(f'Resuming the queue of {len(units)} units')
+    else:
+        input_data = importer.get_input_data()
+        unprocessed = importer.filter_input_data(
+            input_data, processed_ids | set(importer.get_skipped_ids()))
+        files = [(dirname, file) for dirname, val in unprocessed.items()
+                 for file in val]
+        if not files:
+            logger.info('No new IDs, nothing to do')
+            return 0
+        size = unit_size or importer.batch_size
+        units = queue.create([files[i:i + size]
+                              for i in range(0, len(files), size)])
+        logger.info(f'Queued {len(files)} files in {len(units)} units of '
+                    f'up to {size}')
+    rows = failed = 0
+    for unit in units:
+        result = queue.result(unit)
+        if result is None:
+            logger.debug(f'Waiting for {unit}')
+        while result is None:
+            sleep(poll)
+            result = queue.result(unit)
+        if result['status'] == 'done':
+            rows += merge_unit(importer, queue, result['prefix'],
+                               processed_ids)
+        else:
+            failed += 1
+            logger.error(f'{unit} failed on {result["owner"]}: '
+                         f'{result["error"]}')
+    if failed:
+        logger.warning(f'The files of {failed} failed units will be '
+                       f'processed again by the next run')
+    if fresh:
+        # Fresh output is consistent with the current masterfile.
+        importer.save_masterfile_fingerprint()
+    queue.remove()
+    importer.processed_ids = None
+    logger.info(f'Merged {rows} rows from {len(units)} units')
+    return rows
+
+
+def merge_unit(importer, queue, prefix, processed_ids):
+    """
+    Append a finished unit’s shard to the output, in batches of
+    `batch_size` IDs committed by `commit_batch()`. IDs already in the
+    output, as from an interrupted merge, are left out, and with
+    `duplicates`, so are files whose content is already stored under
+    another ID (see `_BaseProcessor.match_content()`).
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    queue : WorkQueue
+        The dataset’s queue, whose directory holds the shard.
+    prefix : string
+        Output prefix of the shard.
+    processed_ids : set
+        IDs in the output when merging started, as from
+        `get_processed_ids()`.
+
+    Returns
+    -------
+        The number of rows appended.
+    """
+    shard_meta = os.path.join(queue.directory, prefix + '_meta.npz')
+    if not os.path.exists(shard_meta):
+        return 0
+    with np.load(shard_meta, allow_pickle=True) as npz:
+        meta = {k: npz[k] for k in npz.files}
+    if importer.duplicates:
+        shard_state = os.path.join(queue.directory, prefix + '_state.json')
+        shard_skipped = load_state(shard_state).get('duplicates', {})
+        importer.skipped_duplicates.update(shard_skipped)
+    if not os.path.exists(importer.paths['channels']):
+        channels = os.path.join(queue.directory, importer.channels_file)
+        if os.path.exists(channels):
+            shutil.copy2(channels, importer.paths['channels'])
+    ids = meta[importer.pkey_field]
+    if not len(ids):
+        return 0
+    # Each ID’s rows are consecutive: one for trajectory output.
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    bounds = np.r_[starts, len(ids)]
+    keep = np.ones(len(ids), dtype=bool)
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        id = ids[start]
+        id = id.decode() if isinstance(id, bytes) else str(id)
+        input_id = importer.input_id(id)
+        if input_id in processed_ids or (importer.duplicates and
+                                         importer.match_content(
+                                             (input_id, id), id,
+                                             str(meta[HASH_FIELD][start]))):
+            keep[start:stop] = False
+    suffix = '.hdf5' if importer.driver is None else '.%03d.hdf5'
+    shard_path = os.path.join(queue.directory, prefix + suffix)
+    rows = 0
+    with h5py.File(shard_path, 'r',
+                   **hdf5_options(shard_path, importer.driver)) as fh:
+        for i in range(0, len(starts), importer.batch_size):
+            first = bounds[i]
+            last = bounds[min(i + importer.batch_size, len(starts))]
+            mask = keep[first:last]
+            if not mask.any():
+                continue
+            batch_meta = {k: v[first:last][mask] for k, v in meta.items()}
+            if importer.is_trajectory():
+                spectra = [fh[f'/spectra/{id}'][()]
+                           for id in batch_meta[importer.pkey_field]]
+            else:
+                spectra = fh['spectra'][first:last][mask]
+            importer.commit_batch(spectra, batch_meta)
+            rows += int(mask.sum())
+    if importer.skipped_duplicates:
+        importer.save_skipped_ids()
+    importer.logger.info(f'Merged {rows} rows of {prefix}')
+    return rows
+
+
+def work(jobs, lease=DEFAULTS['lease'], poll=DEFAULTS['poll'],
+         idle=DEFAULTS['idle']):
+    """
+    Worker process entry point: claims units from the queues of the
+    given datasets and processes each into a shard for the coordinator
+    to merge, until no queue has had unfinished units for `idle`
+    seconds. Workers wait while units are leased by others, to take
+    them over if their leases expire.
+
+    Parameters
+    ----------
+    jobs : list
+        Pairs of a processor for each dataset and the dataset
+        configuration it was created with.
+    lease : float
+        Seconds a claimed unit stays leased without renewal; it is
+        renewed every third of that while it is processed.
+    poll : float
+        Seconds between checks for new units.
+    idle : float
+        Seconds to wait for more units, or None to wait forever.
+    """
+    # Units of a dataset parse its masterfile once per worker.
+    masterfiles = MasterfileRegistry()
+    queues = [(importer, config, WorkQueue(queue_dir(importer), lease,
+                                           importer.logger))
+              for importer, config in jobs]
+    waiting = time()
+    while True:
+        for importer, config, queue in queues:
+            claimed = queue.claim()
+            if claimed is not None:
+                process_unit(importer, config, queue, *claimed, masterfiles)
+                waiting = time()
+                break
+        else:
+            if any(queue.pending() for _, _, queue in queues):
+                waiting = time()
+            elif idle is not None and time() - waiting > idle:
+                logging.info(f'No work for {idle} seconds; stopping')
+                return
+            sleep(poll)
+
+
+def process_unit(importer, config, queue, unit, token, masterfiles):
+    """
+    Process a claimed unit into its own shard output in the queue
+    directory, renewing its lease meanwhile, and record the result.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    config : dict
+        The dataset configuration `importer` was created with.
+    queue : WorkQueue
+        The dataset’s queue.
+    unit, token : string
+        As from `WorkQueue.claim()`.
+    masterfiles : MasterfileRegistry
+        Masterfiles parsed by this worker.
+    """
+    files = queue.files(unit)
+    prefix = f'{importer.output_prefix}_{unit}_{token[:8]}'
+    shard = shard_config(config, QUEUE_DIR, 'worker')
+    shard['masterfiles'] = masterfiles
+    importer.logger.info(f'Processing {unit} of {importer.name} '
+                         f'({len(files)} files)')
+    try:
+        with queue.renewing(unit, token):
+            rows = build_shard(type(importer).__name__, shard, prefix, files)
+    except Exception as e:
+        importer.logger.exception(f'Failed to process {unit}')
+        queue.finish(unit, token, 'failed', {'error': repr(e)})
+        return
+    except BaseException:
+        queue.release(unit, token)
+        raise
+    if not queue.finish(unit, token, 'done', {'prefix': prefix,
+                                              'rows': rows}):
+        importer.logger.warning(f'{unit} was finished by another worker; '
+                                f'discarding {prefix}')
+        for path in glob.glob(os.path.join(glob.escape(queue.directory),
+                                           glob.escape(prefix) + '[._]*')):
+            os.remove(path)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+import hashlib
+import numpy as np
+
+HASH_FIELD = 'content_hash'
+MODES = ('skip', 'link')
+BLOCK_BYTES = 64 * 2**20
+
+
+def content_hash(spectra):
+    """
+    Hashes the parsed spectra of a file. Values are quantized to
+    float32 first, so the same spectra hash alike whether they were
+    just parsed or read back from the output, and the shape is
+    included, so a trajectory cannot match a vector of the same
+    values.
+
+    Parameters
+    ----------
+    spectra : array
+        The spectra of one file, as from `process_file()`.
+
+    Returns
+    -------
+        A 32-character hex digest.
+    """
+    data = np.ascontiguousarray(spectra, dtype=np.float32)
+    digest = hashlib.blake2b(repr(data.shape).encode(), digest_size=16)
+    digest.update(data.tobytes())
+    return digest.hexdigest()
+
+
+def hash_index(meta, pkey_field):
+    """
+    Maps each content hash in the metadata output to the first ID that
+    has it.
+
+    Parameters
+    ----------
+    meta : dict
+        Metadata output with a `content_hash` column, or None.
+    pkey_field : string
+        Primary key column.
+
+    Returns
+    -------
+        A dict of hash to ID.
+    """
+    if meta is None or HASH_FIELD not in meta:
+        return {}
+    hashes, first = np.unique(meta[HASH_FIELD], return_index=True)
+    ids = meta[pkey_field][first]
+    return {str(h): id.decode() if isinstance(id, bytes) else str(id)
+            for h, id in zip(hashes, ids) if h}
+
+
+def vector_hashes(spectra, ids, rows):
+    """
+    Hashes each ID’s run of rows in vector output, as when the output
+    was written before `duplicates` was configured. The rows are read
+    in large blocks that end between runs.
+
+    Parameters
+    ----------
+    spectra
+        The output’s `/spectra` dataset.
+    ids : array
+        Primary key of every row.
+    rows : int
+        Number of committed rows.
+
+    Returns
+    -------
+        An array with the hash of every row’s run.
+    """
+    hashes = np.empty(rows, dtype='U32')
+    bounds = np.flatnonzero(np.r_[True, ids[1:rows] != ids[:rows - 1],
+                                  True])
+    step = max(1, BLOCK_BYTES // (spectra.shape[1] * spectra.dtype.itemsize))
+    i = 0
+    while i < len(bounds) - 1:
+        # Whole runs, at least one, totalling about `step` rows
+        j = max(i + 1, int(np.searchsorted(bounds, bounds[i] + step,
+                                           side='right')) - 1)
+        block = spectra[bounds[i]:bounds[j]]
+        for a, b in zip(bounds[i:j], bounds[i + 1:j + 1]):
+            hashes[a:b] = content_hash(block[a - bounds[i]:b - bounds[i]])
+        i = j
+    return hashes
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import hashlib
+import numpy as np
+
+INDEX_GROUP = 'index'
+COLUMNS = ('key', 'start', 'count')
+
+
+def id_key(id):
+    """
+    Hashes a spectrum ID for the output’s index. Numbers are stored
+    rather than the IDs themselves because SWMR output cannot hold
+    variable-length strings; a reader confirms a match against the
+    metadata row it points to.
+
+    Parameters
+    ----------
+    id
+        A primary key value, as in the metadata.
+
+    Returns
+    -------
+        A 64-bit unsigned int.
+    """
+    return int.from_bytes(hashlib.sha1(str(id).encode()).digest()[:8],
+                          'little')
+
+
+def index_entries(ids, offset=0):
+    """
+    Groups consecutive rows with the same ID, such as the shots of one
+    LIBS or MSL file.
+
+    Parameters
+    ----------
+    ids : array
+        Primary key of each row.
+    offset : int
+        Output row of the first ID.
+
+    Returns
+    -------
+        Arrays of ID key, first row and number of rows for each group.
+    """
+    ids = np.asarray(ids).astype(str)
+    if not len(ids):
+        return (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=np.int64))
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    counts = np.diff(np.r_[starts, len(ids)])
+    keys = np.array([id_key(id) for id in ids[starts]], dtype=np.uint64)
+    return keys, starts + offset, counts
+
+
+def create_index(fh, field, ids):
+    """
+    Creates the index of an output file: `/index/key`, `/index/start`
+    and `/index/count` hold, for each group of rows from
+    `index_entries()`, the hashed ID, first row and number of rows.
+
+    Parameters
+    ----------
+    fh
+        The open output file, not yet in SWMR mode.
+    field : string
+        Name of the primary key column, recorded in the group’s `field`
+        attribute.
+    ids : array
+        Primary key of each row already in the output.
+    """
+    group = fh.create_group(INDEX_GROUP)
+    group.attrs['field'] = field
+    for name, data in zip(COLUMNS, index_entries(ids)):
+        group.create_dataset(name, data=data, chunks=(4096,),
+                             maxshape=(None,))
+
+
+def update_index(fh, ids, offset):
+    """
+    Index rows appended to an output file. Entries for rows at or past
+    `offset`, left over from an interrupted batch, are replaced.
+
+    Parameters
+    ----------
+    fh
+        The open output file, with an index from `create_index()`.
+    ids : array
+        Primary key of each new row; empty to only drop entries.
+    offset : int
+        Output row of the first ID.
+    """
+    group = fh[INDEX_GROUP]
+    size = group['start'].shape[0]
+    if size and group['start'][size - 1] >= offset:
+        size = int(np.searchsorted(group['start'][()], offset))
+    entries = index_entries(ids, offset)
+    for name, data in zip(COLUMNS, entries):
+        dset = group[name]
+        dset.resize(size + len(data), axis=0)
+        dset[size:] = data
+
+
+def read_index(group, start, rows):
+    """
+    Reads index entries of committed rows.
+
+    Parameters
+    ----------
+    group
+        The output’s `/index` group.
+    start : int
+        First entry to read.
+    rows : int
+        Number of committed rows; entries past them are ignored.
+
+    Returns
+    -------
+        A dict of ID key to (first row, number of rows), and the index
+        of the entry after the last one read.
+    """
+    # The columns are resized one by one, so may briefly differ.
+    size = min(group[name].shape[0] for name in COLUMNS)
+    starts = group['start'][start:size]
+    counts = group['count'][start:size]
+    stop = start + int(np.searchsorted(starts + counts, rows, side='right'))
+    keys = group['key'][start:stop].tolist()
+    entries = zip(starts[:stop - start].tolist(),
+                  counts[:stop - start].tolist())
+    return dict(zip(keys, entries)), stop
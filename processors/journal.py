@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import fcntl
+import os
+import struct
+
+HDF5_SIGNATURE = b'\x89HDF\r\n\x1a\n'
+MASK = 0xffffffff
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & MASK
+
+
+def lookup3(data, initval=0):
+    """
+    Bob Jenkins’s lookup3 hash, which HDF5 uses to checksum its
+    metadata.
+
+    Parameters
+    ----------
+    data : bytes
+        The bytes to hash.
+    initval : int
+        Seed value.
+
+    Returns
+    -------
+        The 32-bit hash as an int.
+    """
+    a = b = c = (0xdeadbeef + len(data) + initval) & MASK
+    if not data:
+        return c
+    tail = len(data) % 12 or 12
+    body, last = data[:-tail], data[-tail:].ljust(12, b'\0')
+    for i in range(0, len(body), 12):
+        x, y, z = struct.unpack_from('<3I', body, i)
+        a, b, c = (a + x) & MASK, (b + y) & MASK, (c + z) & MASK
+        a = ((a - c) & MASK) ^ _rot(c, 4)
+        c = (c + b) & MASK
+        b = ((b - a) & MASK) ^ _rot(a, 6)
+        a = (a + c) & MASK
+        c = ((c - b) & MASK) ^ _rot(b, 8)
+        b = (b + a) & MASK
+        a = ((a - c) & MASK) ^ _rot(c, 16)
+        c = (c + b) & MASK
+        b = ((b - a) & MASK) ^ _rot(a, 19)
+        a = (a + c) & MASK
+        c = ((c - b) & MASK) ^ _rot(b, 4)
+        b = (b + a) & MASK
+    x, y, z = struct.unpack('<3I', last)
+    a, b, c = (a + x) & MASK, (b + y) & MASK, (c + z) & MASK
+    c = ((c ^ b) - _rot(b, 14)) & MASK
+    a = ((a ^ c) - _rot(c, 11)) & MASK
+    b = ((b ^ a) - _rot(a, 25)) & MASK
+    c = ((c ^ b) - _rot(b, 16)) & MASK
+    a = ((a ^ c) - _rot(c, 4)) & MASK
+    b = ((b ^ a) - _rot(a, 14)) & MASK
+    c = ((c ^ b) - _rot(b, 24)) & MASK
+    return c
+
+
+def clear_consistency_flags(filepath):
+    """
+    Clears the “file is open for writing” flags that HDF5 leaves in the
+    superblock of a file created with `libver='latest'` when the writer
+    is killed, which otherwise make the file impossible to open. This
+    is what the HDF5 `h5clear -s` tool does.
+
+    Nothing is changed if another process holds HDF5’s lock on the
+    file, since then the flags are genuine.
+
+    Parameters
+    ----------
+    filepath : string
+        An HDF5 file, or the first member of a family.
+
+    Returns
+    -------
+        True if flags were cleared.
+    """
+    with open(filepath, 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        try:
+            # The superblock may follow a user block of 512 * 2^n bytes.
+            size = os.fstat(f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                f.seek(offset)
+                header = f.read(12)
+                if header[:8] == HDF5_SIGNATURE:
+                    break
+                offset = 512 if offset == 0 else offset * 2
+            else:
+                return False
+            version, offset_size, _, flags = header[8:12]
+            if version < 2 or not flags:
+                return False
+            f.seek(offset)
+            superblock = bytearray(f.read(12 + 4 * offset_size))
+            superblock[11] = 0
+            checksum = struct.pack('<I', lookup3(bytes(superblock)))
+            f.seek(offset + 11)
+            f.write(b'\0')
+            f.seek(offset + len(superblock))
+            f.write(checksum)
+            return True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
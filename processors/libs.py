@@ -4,6 +4,9 @@ import numpy as np
 import os.path
 from . import utils
 from ._base import _VectorProcessor
+from .state import load_state, save_state
+
+BLOCK_BYTES = 64 * 2**20
 
 
 class LIBSProcessor(_VectorProcessor):
@@ -20,6 +23,8 @@ class LIBSProcessor(_VectorProcessor):
     - driver: family by default
     - file_ext: '_spect.csv' by default
     - pkey_field: 'Name' by default
+    - sample_field, shot_field: 'Sample' and 'Number' by default, for
+      `aggregate` and the catalog
 
     """
     def __init__(self, **kwargs):
@@ -27,6 +32,7 @@ class LIBSProcessor(_VectorProcessor):
         self.logger = self.get_child_logger()
         self.wavelengths = None
         self.si_constants = None
+        self.line_windows = None
         required = ['channels']
         for attr in required:
             if not hasattr(self, attr):
@@ -35,10 +41,20 @@ class LIBSProcessor(_VectorProcessor):
             'driver': 'family',
             'file_ext': '_spect.csv',
             'pkey_field': 'Name',
+            'sample_field': 'Sample',
+            'shot_field': 'Number',
+            'lines': None,
         }
         for key, value in defaults.items():
             if not hasattr(self, key):
                 setattr(self, key, value)
+        if self.lines:
+            self.lines = {str(name): [float(lo), float(hi)]
+                          for name, (lo, hi) in self.lines.items()}
+            for name, (lo, hi) in self.lines.items():
+                if not lo < hi:
+                    raise ValueError(f'Line window {name} must start '
+                                     f'before it ends')
 
     def calculate_si_ratio(self, spectra):
         den_lo, den_hi, num_lo, num_hi = self.si_constants
@@ -47,6 +63,108 @@ class LIBSProcessor(_VectorProcessor):
         np.maximum(si_ratio, 0, out=si_ratio)
         return si_ratio
 
+    def calculate_lines(self, spectra):
+        """
+        Measures each configured emission line in every spectrum of a
+        batch at once, within the line’s wavelength window: its height
+        (the highest channel) and its area (the sum of its channels,
+        each weighted by its width in nm). Heights come from a single
+        `np.fmax.reduceat` over the segments between window edges, and
+        areas from a single product with a (channels, lines) matrix of
+        channel widths, so overlapping windows cost nothing extra.
+
+        Parameters
+        ----------
+        spectra : array
+            2-D array of one spectrum per row.
+
+        Returns
+        -------
+            A dict of `peak_<line>` and `area_<line>` column names to
+            arrays. Lines outside the wavelength range are NaN.
+        """
+        if self.line_windows is None:
+            bounds = np.array([
+                [np.searchsorted(self.wavelengths, lo, side='left'),
+                 np.searchsorted(self.wavelengths, hi, side='right')]
+                for lo, hi in self.lines.values()])
+            edges = np.unique(bounds)
+            edges = edges[edges < len(self.wavelengths)]
+            widths = np.abs(np.gradient(self.wavelengths))
+            weights = np.zeros((len(self.wavelengths), len(bounds)))
+            for i, (lo, hi) in enumerate(bounds):
+                weights[lo:hi, i] = widths[lo:hi]
+            self.line_windows = (edges, np.searchsorted(edges, bounds),
+                                 weights)
+        edges, spans, weights = self.line_windows
+        if len(edges):
+            maxima = np.fmax.reduceat(spectra, edges, axis=1)
+        if np.isnan(spectra).any():
+            spectra = np.nan_to_num(spectra)
+        areas = spectra @ weights
+        columns = {}
+        for i, name in enumerate(self.lines):
+            first, last = spans[i]
+            if last > first:
+                columns[f'peak_{name}'] = np.fmax.reduce(
+                    maxima[:, first:last], axis=1)
+            else:
+                columns[f'peak_{name}'] = np.full(len(spectra), np.nan)
+                areas[:, i] = np.nan
+            columns[f'area_{name}'] = areas[:, i]
+        return columns
+
+    def catch_up(self):
+        """
+        Extends _BaseProcessor’s catch_up() to first measure the
+        configured emission lines in committed rows that were measured
+        with other windows, or not at all.
+        """
+        self.fill_lines()
+        super().catch_up()
+
+    def fill_lines(self):
+        """
+        Recomputes the emission line columns of the metadata output
+        from the committed spectra, read back in large blocks, when
+        `lines` has changed since they were computed. Columns of lines
+        no longer configured are dropped.
+        """
+        state = load_state(self.paths['state'])
+        previous = state.get('lines', {})
+        lines = self.lines or {}
+        if previous == lines:
+            return
+        meta = self.read_metadata()
+        if meta is not None:
+            if lines and self.wavelengths is None:
+                if not os.path.isfile(self.paths['channels']):
+                    self.logger.warning('No wavelengths to measure lines '
+                                        'in existing output')
+                    return
+                self.set_wavelengths(np.load(self.paths['channels'],
+                                             allow_pickle=True))
+            for name in previous:
+                meta.pop(f'peak_{name}', None)
+                meta.pop(f'area_{name}', None)
+            rows = len(meta[self.pkey_field])
+            if lines and rows:
+                fh = self.open_output(self.output_path())
+                source = fh['spectra']
+                step = max(1, BLOCK_BYTES // (source.shape[1] *
+                                              source.dtype.itemsize))
+                parts = [self.calculate_lines(source[first:first + step])
+                         for first in range(0, rows, step)]
+                self.close_output(fh)
+                for key in parts[0]:
+                    meta[key] = np.concatenate([p[key] for p in parts])
+            self.save_metadata(meta)
+            self.logger.info(f'Updated emission line columns of {rows} '
+                             f'rows')
+        state = load_state(self.paths['state'])
+        state['lines'] = lines
+        save_state(self.paths['state'], state)
+
     def get_id(self, filename):
         """
         Retrieves the id of a file using the general LIBS
@@ -77,14 +195,43 @@ class LIBSProcessor(_VectorProcessor):
         for dd in self.paths['data']:
             files = utils.find_spectrum_files(dd, self.file_ext)
             for file in files:
-                if not self.get_id(file):
+                entry = self.input_entry(dd, file)
+                if entry is None:
                     continue
-                path = utils.get_directory(file)
+                path, datafile = entry
                 if path not in data:
                     data[path] = []
-                data[path].append((self.get_id(file), file))
+                data[path].append(datafile)
         return data
 
+    def input_entry(self, input_dir, filepath):
+        """
+        Overrides input_entry in BaseProcessor to match the files found
+        by `utils.find_spectrum_files()`.
+
+        Parameters
+        ----------
+        input_dir
+            The data directory containing the file.
+        filepath
+            The full path of the file.
+
+        Returns
+        -------
+            A tuple (directory name, (ID, filepath)), or None.
+        """
+        parent = os.path.dirname(os.path.dirname(filepath))
+        if os.path.normpath(parent) != os.path.normpath(input_dir):
+            return None
+        if not filepath.endswith(self.file_ext):
+            return None
+        if '_TI_' in filepath.upper() or '_DARK_' in filepath.upper():
+            return None
+        fid = self.get_id(filepath)
+        if not fid:
+            return None
+        return utils.get_directory(filepath), (fid, filepath)
+
     def parse_metadata(self):
         """
         Output logger message, then runs utils.py's 
@@ -97,6 +244,49 @@ class LIBSProcessor(_VectorProcessor):
         self.logger.debug('Parsing metadata')
         return utils.parse_millennium_comps(self.paths['metadata'][0])
 
+    def lookup_sample(self, sample, name):
+        """
+        Finds the masterfile fields for one sample.
+
+        Parameters
+        ----------
+        sample
+            The sample name from a spectra file’s metadata.
+        name
+            The name of the file, for warnings.
+
+        Returns
+        -------
+            A dict of masterfile-derived meta fields to values, or None
+            if the sample is not in the masterfile.
+        """
+        all_samps, all_comps, all_noncomps = self.metadata
+        elements = sorted(all_comps.keys())
+        sample = sample.lower()
+        all_samps = [samp.lower() if samp else None for samp in all_samps]
+        projects = ''
+        try:
+            ind = all_samps.index(sample)
+        except Exception as e:
+            self.logger.warning(f'Failed to get comps for {name}: {e}')
+            return None
+        dopant = np.nan
+        if all_noncomps[3][ind]:
+            dopant = all_noncomps[3][ind]
+        if all_noncomps[4][ind]:
+            projects = all_noncomps[4][ind].upper()
+            projects = projects.translate({ord(c): None for c in ' ;'})
+        sample_meta = {
+            'Projects': projects,
+            'TASRockType': all_noncomps[0][ind],
+            'RandomNumber': int(all_noncomps[1][ind]),
+            'Matrix': all_noncomps[2][ind],
+            'ApproxDopantConc': float(dopant),
+        }
+        for elem in elements:
+            sample_meta[elem] = all_comps[elem][ind]
+        return sample_meta
+
     def prepare_meta(self, meta, shot_num, name):
         """
         Sets up each meta field and cleans values. 
@@ -114,31 +304,9 @@ class LIBSProcessor(_VectorProcessor):
         -------
             A dictionary of meta fields to meta values.
         """
-        all_samps, all_comps, all_noncomps = self.metadata
-        elements = sorted(all_comps.keys())
-        sample = meta['Sample'].lower()
-        all_samps = [samp.lower() if samp else None for samp in all_samps]
-        rock_type = ''
-        random_no = -1
-        matrix = ''
-        dopant = np.nan
-        projects = ''
-        try:
-            ind = all_samps.index(sample)
-        except Exception as e:
-            self.logger.warning(f'Failed to get comps for {name}: {e}')
+        sample_meta = self.lookup_sample(meta['Sample'], name)
+        if sample_meta is None:
             return None
-        else:
-            comps = [all_comps[elem][ind] for elem in elements]
-            rock_type = all_noncomps[0][ind]
-            random_no = int(all_noncomps[1][ind])
-            matrix = all_noncomps[2][ind]
-            dopant = np.nan 
-            if all_noncomps[3][ind]:
-                dopant = all_noncomps[3][ind]
-            if all_noncomps[4][ind]:
-                projects = all_noncomps[4][ind].upper()
-                projects = projects.translate({ord(c): None for c in ' ;'})
 
         numeric_meta = {
             'Carousel': {'cast': int, 'default': 0},
@@ -153,19 +321,18 @@ class LIBSProcessor(_VectorProcessor):
             else:
                 meta[key] = spec['default']
 
+        projects = sample_meta.pop('Projects')
         metas = np.broadcast_arrays(shot_num, meta['Carousel'],
                                     meta['Sample'], meta['Target'],
                                     meta['Location'], meta['Atmosphere'],
                                     meta['LaserAttenuation'],
                                     meta['DistToTarget'], meta['Date'],
-                                    projects, name, rock_type, random_no,
-                                    matrix, float(dopant), *comps)
+                                    projects, name, *sample_meta.values())
 
         meta_fields = [
             'Number', 'Carousel', 'Sample', 'Target', 'Location', 'Atmosphere',
             'LaserAttenuation', 'DistToTarget', 'Date', 'Projects', 'Name',
-            'TASRockType', 'RandomNumber', 'Matrix', 'ApproxDopantConc'
-        ] + elements
+        ] + list(sample_meta.keys())
 
         return dict(zip(meta_fields, metas))
 
@@ -184,10 +351,10 @@ class LIBSProcessor(_VectorProcessor):
         spectra
             A single file's spectra values.
         meta
-            A struct containing a single file's metadata values, 
-            including si_test value.
+            A struct containing a single file's metadata values.
         """
-        result = utils.load_spectra(datafile[1], self.channels)
+        result = self.load_cached(
+            lambda f: utils.load_spectra(f, self.channels), datafile[1])
         if not result:
             return
         if isinstance(result, str):
@@ -196,19 +363,76 @@ class LIBSProcessor(_VectorProcessor):
         spectra, meta, is_prepro = result
         if is_prepro:
             if self.wavelengths is None:
-                self.wavelengths = np.array(spectra[0], dtype=float)
-                self.si_constants = np.searchsorted(
-                    self.wavelengths,
-                    (288., 288.5, 633., 635.5))
+                self.set_wavelengths(spectra[0])
             spectra = spectra[1:]
         shot_num = [0]
         if not self.averaged:
             spectra = np.vstack((spectra.mean(0), spectra))
             shot_num = np.arange(spectra.shape[0])
         meta = self.prepare_meta(meta, shot_num, name=datafile[0])
-        meta['si_test'] = self.calculate_si_ratio(spectra)
         return spectra, meta
 
+    def refresh_meta(self, meta):
+        """
+        Looks up each sample of existing output in the masterfile.
+
+        Parameters
+        ----------
+        meta
+            Existing metadata, as from `read_metadata()`.
+
+        Returns
+        -------
+            A dict of masterfile-derived meta fields to arrays; element
+            columns no longer in the masterfile map to None.
+        """
+        names = dict(zip(meta['Sample'], meta['Name']))
+        refreshed = self.refresh_rows(
+            meta, 'Sample', lambda s: self.lookup_sample(s, names[s]))
+        for key in meta:
+            if key.startswith('e_') and key not in self.metadata[1]:
+                refreshed[key] = None
+        return refreshed
+
+    def restructure_spectra(self, all_spectra, all_meta):
+        """
+        Extends _VectorProcessor’s restructure_spectra() to compute the
+        si_test column, and any emission line columns, for the whole
+        batch at once.
+
+        Parameters
+        ----------
+        all_spectra : list
+            Spectra of each file in the batch.
+        all_meta : dict
+            As received from `restructure_meta()`; gains `si_test` and
+            the columns of `calculate_lines()`.
+
+        Returns
+        -------
+            A 2-D array of one spectrum per row.
+        """
+        spectra = super().restructure_spectra(all_spectra, all_meta)
+        all_meta['si_test'] = self.calculate_si_ratio(spectra)
+        if self.lines:
+            all_meta.update(self.calculate_lines(spectra))
+        return spectra
+
+    def set_wavelengths(self, wavelengths):
+        """
+        Keep the wavelength of each channel, with the channel ranges
+        used by `calculate_si_ratio()`.
+
+        Parameters
+        ----------
+        wavelengths : array
+            Wavelength of each channel, from a file or the saved
+            channels file.
+        """
+        self.wavelengths = np.array(wavelengths, dtype=float)
+        self.si_constants = np.searchsorted(self.wavelengths,
+                                            (288., 288.5, 633., 635.5))
+
     def write_data(self, filepath, all_spectra, all_meta):
         """
         Override of _VectorImporter’s write_data() to output wavelengths.
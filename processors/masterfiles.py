@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import logging
+
+
+class MasterfileRegistry(object):
+    """
+    Parsed masterfiles shared by the datasets of one run, so that
+    datasets with the same masterfile (such as ChemLIBS and SuperLIBS,
+    which both use Millennium_COMPS.xlsx) parse it only once. Only the
+    latest version of each masterfile is kept, so a masterfile that
+    changes in watch mode is parsed again.
+
+    The parsed data is handed to every dataset as is, and must be
+    treated as read-only. A registry pickles with its contents, so it
+    can be passed to worker processes as a snapshot (see `rebuild.py`).
+    """
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+
+    def get(self, key, fingerprint, parse, logger=None):
+        """
+        Returns a parsed masterfile, parsing it if it is not registered
+        or has changed.
+
+        Parameters
+        ----------
+        key : tuple
+            Identifies the parser and masterfile paths, as from
+            `_BaseProcessor.masterfile_key()`.
+        fingerprint : dict
+            Current version of the masterfiles, as from
+            `_BaseProcessor.get_masterfile_fingerprint()`.
+        parse : function
+            Parses the masterfiles; called with no arguments.
+        logger
+            For a message when a parsed masterfile is reused.
+
+        Returns
+        -------
+            The result of `parse()`, possibly from an earlier call.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == fingerprint:
+            (logger or logging.getLogger()).debug(
+                f'Reusing parsed masterfile {", ".join(key[2])}')
+            return entry[1]
+        metadata = parse()
+        self.entries[key] = (fingerprint, metadata)
+        return metadata
@@ -0,0 +1,617 @@
+#!/usr/bin/env python3
+
+import csv
+import errno
+import hashlib
+import logging
+import os
+import posixpath
+import shutil
+import threading
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from fnmatch import fnmatch, fnmatchcase
+from html.parser import HTMLParser
+from .state import load_state, save_state
+from time import time
+from urllib.parse import unquote, urljoin, urlsplit
+
+MANIFEST_FILE = '.mirror_manifest.json'
+CHUNK_SIZE = 1024 * 1024
+
+
+class _LinkParser(HTMLParser):
+    """
+    Collects the targets of links in a directory listing page.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+
+class Mirror(object):
+    """
+    Mirrors files from a web server’s directory listings, downloading
+    concurrently over a shared connection pool.
+
+    Downloads are conditional on the ETag or Last-Modified recorded in
+    a manifest (or the local file’s mtime), resume from a partial file
+    when one exists, and are written to a temporary name and renamed
+    into place only when complete.
+
+    As a convenience, a `file://` remote is read directly from the
+    filesystem. None of the HTTP handling is used then; tests stand in
+    for the server with `http.server` instead (see `tests/`).
+
+    With a `state_dir`, the manifests and partial files are kept there
+    instead of beside the mirrored files, so that a sync that changes
+    nothing leaves the data directories untouched (see
+    `state.input_fingerprint()`).
+    """
+
+    def __init__(self, remote, workers=8, retries=3, timeout=60,
+                 logger=None, state_dir=None):
+        """
+        Parameters
+        ----------
+        remote : string
+            Base URL; other paths are relative to it.
+        workers : int
+            Number of concurrent downloads.
+        retries : int
+            Number of retries for failed connections and server errors.
+        timeout : float
+            Seconds to wait for a connection or for data.
+        logger
+            Logger for progress; defaults to the root logger.
+        state_dir : string
+            Directory for manifests and partial files, outside the
+            mirrored directories.
+        """
+        self.remote = remote if remote.endswith('/') else remote + '/'
+        self.workers = workers
+        self.logger = logger or logging.getLogger()
+        retry = urllib3.Retry(total=retries, backoff_factor=1,
+                              status_forcelist=(500, 502, 503, 504))
+        self.http = urllib3.PoolManager(maxsize=workers, block=True,
+                                        retries=retry, timeout=timeout)
+        self.lock = threading.Lock()
+        parts = urlsplit(self.remote)
+        self.local_root = None
+        if parts.scheme == 'file':
+            self.local_root = unquote(parts.path)
+        self.state_dir = state_dir
+
+    def state_path(self, local_path, suffix):
+        """
+        Parameters
+        ----------
+        local_path : string
+            A mirrored file or directory.
+        suffix : string
+            Distinguishes the kind of file, such as '.part'.
+
+        Returns
+        -------
+            Where to keep a file about `local_path` in `state_dir`, named
+            after it and a digest of its full path.
+        """
+        local_path = os.path.abspath(local_path)
+        digest = hashlib.sha1(local_path.encode()).hexdigest()[:12]
+        name = f'{os.path.basename(local_path)}.{digest}{suffix}'
+        return os.path.join(self.state_dir, 'mirror', name)
+
+    def manifest_path(self, local_dir):
+        """
+        Returns
+        -------
+            The manifest filename for a local directory.
+        """
+        if self.state_dir is None:
+            return os.path.join(local_dir, MANIFEST_FILE)
+        return self.state_path(local_dir, '.json')
+
+    def part_path(self, local_path):
+        """
+        Returns
+        -------
+            Where a file is downloaded before it is complete.
+        """
+        if self.state_dir is None:
+            return local_path + '.part'
+        return self.state_path(local_path, '.part')
+
+    def load_manifest(self, local_dir):
+        """
+        Reads the manifest of a local directory, moving one kept in the
+        directory itself, from before `state_dir` was used, into place.
+
+        Returns
+        -------
+            A dict of relative path to manifest entry.
+        """
+        manifest_path = self.manifest_path(local_dir)
+        legacy = os.path.join(local_dir, MANIFEST_FILE)
+        if manifest_path != legacy and os.path.exists(legacy) and \
+                not os.path.exists(manifest_path):
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            shutil.move(legacy, manifest_path)
+        return load_state(manifest_path)
+
+    def save_manifest(self, local_dir, manifest):
+        """
+        Replaces the manifest of a local directory.
+        """
+        manifest_path = self.manifest_path(local_dir)
+        os.makedirs(os.path.dirname(manifest_path) or '.', exist_ok=True)
+        save_state(manifest_path, manifest)
+
+    def place(self, part_path, local_path):
+        """
+        Renames a complete download into place, copying it across if
+        `state_dir` is on another filesystem.
+        """
+        try:
+            os.replace(part_path, local_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            shutil.copy2(part_path, local_path + '.part')
+            os.replace(local_path + '.part', local_path)
+            os.remove(part_path)
+
+    def url(self, path):
+        """
+        Parameters
+        ----------
+        path : string
+            Path relative to the remote base.
+
+        Returns
+        -------
+            The full URL.
+        """
+        return urljoin(self.remote, path)
+
+    def list_dir(self, path):
+        """
+        Reads one remote directory listing.
+
+        Parameters
+        ----------
+        path : string
+            Directory path relative to the remote base, ending in '/'.
+
+        Returns
+        -------
+        dirs
+            Relative paths of subdirectories.
+        files
+            Relative paths of files.
+        """
+        if self.local_root is not None:
+            dirs, files = [], []
+            with os.scandir(os.path.join(self.local_root, path)) as it:
+                for item in it:
+                    if item.is_dir():
+                        dirs.append(path + item.name + '/')
+                    else:
+                        files.append(path + item.name)
+            return sorted(dirs), sorted(files)
+        url = self.url(path)
+        response = self.http.request('GET', url)
+        if response.status != 200:
+            raise IOError(f'HTTP {response.status} listing {url}')
+        parser = _LinkParser()
+        parser.feed(response.data.decode('utf-8', errors='replace'))
+        base = urlsplit(url).path
+        dirs, files = [], []
+        for href in parser.links:
+            target = urlsplit(urljoin(url, href))
+            if target.query or target.netloc != urlsplit(url).netloc:
+                continue
+            target_path = unquote(target.path)
+            if not target_path.startswith(base) or target_path == base:
+                continue
+            name = target_path[len(base):]
+            if '/' in name.rstrip('/'):
+                continue
+            if name.endswith('/'):
+                dirs.append(path + name)
+            else:
+                files.append(path + name)
+        return sorted(set(dirs)), sorted(set(files))
+
+    def list_tree(self, path, pattern='*'):
+        """
+        Lists remote files below a directory, reading the listings of
+        sibling directories concurrently.
+
+        Parameters
+        ----------
+        path : string
+            Directory path relative to the remote base.
+        pattern : string
+            Shell-style pattern that file names must match.
+
+        Returns
+        -------
+            Sorted relative paths of matching files.
+        """
+        pending = [path.rstrip('/') + '/']
+        found = []
+        with ThreadPoolExecutor(self.workers) as pool:
+            while pending:
+                listings = list(pool.map(self.list_dir, pending))
+                pending = []
+                for dirs, files in listings:
+                    pending.extend(dirs)
+                    found.extend(f for f in files
+                                 if fnmatch(posixpath.basename(f), pattern))
+        return sorted(found)
+
+    def fetch(self, path, local_path, entry=None, backup_suffix=None):
+        """
+        Downloads one file unless the local copy is current.
+
+        Parameters
+        ----------
+        path : string
+            File path relative to the remote base.
+        local_path : string
+            Where to store the file.
+        entry : dict
+            Manifest entry from the previous download, if any.
+        backup_suffix : string
+            If given, a changed file’s previous version is renamed to
+            `local_path + backup_suffix` instead of being replaced.
+
+        Returns
+        -------
+        status
+            One of 'new', 'updated', 'unchanged', or 'failed'.
+        entry
+            Updated manifest entry, or None if there is nothing new to
+            record.
+        """
+        if self.local_root is not None:
+            return self.fetch_local(path, local_path, entry, backup_suffix)
+        url = self.url(path)
+        entry = dict(entry or {})
+        exists = os.path.exists(local_path)
+        headers = {}
+        if exists:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            elif not entry:
+                mtime = os.path.getmtime(local_path)
+                headers['If-Modified-Since'] = formatdate(mtime, usegmt=True)
+        part_path = self.part_path(local_path)
+        if os.path.exists(part_path) and entry.get('partial_etag'):
+            # Only resume if the server can confirm it is the same file.
+            offset = os.path.getsize(part_path)
+            headers['Range'] = f'bytes={offset}-'
+            headers['If-Range'] = entry['partial_etag']
+        try:
+            response = self.http.request('GET', url, headers=headers,
+                                         preload_content=False)
+        except urllib3.exceptions.HTTPError as e:
+            self.logger.warning(f'Failed to download {url}: {e}')
+            return 'failed', None
+        try:
+            if response.status == 304:
+                return 'unchanged', entry
+            if response.status == 416:
+                # Stale partial file; start over next time.
+                os.remove(part_path)
+                return 'failed', None
+            if response.status not in (200, 206):
+                self.logger.warning(f'HTTP {response.status} for {url}')
+                return 'failed', None
+            os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+            os.makedirs(os.path.dirname(part_path) or '.', exist_ok=True)
+            mode = 'ab' if response.status == 206 else 'wb'
+            with open(part_path, mode) as f:
+                for chunk in response.stream(CHUNK_SIZE):
+                    f.write(chunk)
+        except (OSError, urllib3.exceptions.HTTPError) as e:
+            self.logger.warning(f'Interrupted download of {url}: {e}')
+            return 'failed', {**entry,
+                              'partial_etag': response.headers.get('ETag')}
+        finally:
+            response.release_conn()
+        expected = response.headers.get('Content-Length')
+        if expected is not None and response.status == 200 and \
+                os.path.getsize(part_path) != int(expected):
+            self.logger.warning(f'Incomplete download of {url}')
+            return 'failed', {**entry,
+                              'partial_etag': response.headers.get('ETag')}
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            mtime = parsedate_to_datetime(last_modified).timestamp()
+            os.utime(part_path, (mtime, mtime))
+        if exists and backup_suffix:
+            os.replace(local_path, local_path + backup_suffix)
+        self.place(part_path, local_path)
+        entry = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': last_modified,
+            'size': os.path.getsize(local_path),
+        }
+        return ('updated' if exists else 'new'), entry
+
+    def fetch_local(self, path, local_path, entry=None, backup_suffix=None):
+        """
+        Copies one file from a `file://` remote unless the local copy is
+        current. Takes the same parameters and returns the same values
+        as `fetch()`.
+        """
+        source = os.path.join(self.local_root, *path.split('/'))
+        entry = dict(entry or {})
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            self.logger.warning(f'Failed to copy {source}: {e}')
+            return 'failed', None
+        version = [stat.st_size, stat.st_mtime_ns]
+        exists = os.path.exists(local_path)
+        if exists and entry.get('source') == version:
+            return 'unchanged', entry
+        os.makedirs(os.path.dirname(local_path) or '.', exist_ok=True)
+        part_path = self.part_path(local_path)
+        os.makedirs(os.path.dirname(part_path) or '.', exist_ok=True)
+        shutil.copy2(source, part_path)
+        if exists and backup_suffix:
+            os.replace(local_path, local_path + backup_suffix)
+        self.place(part_path, local_path)
+        entry = {'source': version, 'size': stat.st_size}
+        return ('updated' if exists else 'new'), entry
+
+    def fetch_file(self, path, local_path, backup_suffix=None):
+        """
+        Downloads a single file such as a masterfile, keeping the
+        previous version if it changed.
+
+        Parameters
+        ----------
+        path : string
+            File path relative to the remote base.
+        local_path : string
+            Where to store the file.
+        backup_suffix : string
+            If given, a changed file’s previous version is renamed to
+            `local_path + backup_suffix` first.
+
+        Returns
+        -------
+            The status from `fetch()`.
+        """
+        local_dir = os.path.dirname(local_path)
+        manifest = self.load_manifest(local_dir)
+        key = os.path.basename(local_path)
+        status, entry = self.fetch(path, local_path, manifest.get(key),
+                                   backup_suffix)
+        self.logger.info(f'{status.capitalize()}: {path}')
+        if entry is not None and entry != manifest.get(key):
+            manifest[key] = entry
+            self.save_manifest(local_dir, manifest)
+        return status
+
+    def mirror(self, path, local_dir, pattern='*', on_complete=None):
+        """
+        Mirrors the matching files below a remote directory. Empty
+        directories are not created.
+
+        Parameters
+        ----------
+        path : string
+            Directory path relative to the remote base.
+        local_dir : string
+            Local directory corresponding to `path`.
+        pattern : string
+            Shell-style pattern that file names must match.
+        on_complete : function
+            Called with the local path of each new or updated file as
+            soon as it is in place (from a worker thread).
+
+        Returns
+        -------
+            A dict of status to number of files.
+        """
+        start = time()
+        remote_files = self.list_tree(path, pattern)
+        self.logger.info(f'Found {len(remote_files)} remote files '
+                         f'in {time() - start:0.1f} seconds')
+        prefix = path.rstrip('/') + '/'
+        relpaths = [f[len(prefix):] for f in remote_files]
+        return self.fetch_all(prefix, relpaths, local_dir, on_complete)
+
+    def fetch_all(self, prefix, relpaths, local_dir, on_complete=None,
+                  versions=None):
+        """
+        Downloads a list of files concurrently, tracking them in the
+        manifest of `local_dir`.
+
+        Parameters
+        ----------
+        prefix : string
+            Remote directory, relative to the base, ending in '/'.
+        relpaths : list
+            File paths relative to `prefix` and `local_dir`.
+        local_dir : string
+            Local directory corresponding to `prefix`.
+        on_complete : function
+            As in `mirror()`.
+        versions : dict
+            Version tokens from a remote index to record in the
+            manifest for each file that is fetched successfully.
+
+        Returns
+        -------
+            A dict of status to number of files.
+        """
+        manifest = self.load_manifest(local_dir)
+        counts = {'new': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+        start = time()
+        received = [0]
+        # Entries changed since the manifest was last saved
+        changed = [0]
+
+        def fetch_one(relpath):
+            local_path = os.path.join(local_dir, *relpath.split('/'))
+            status, entry = self.fetch(prefix + relpath, local_path,
+                                       manifest.get(relpath))
+            if versions and status != 'failed':
+                entry['index'] = versions[relpath]
+            with self.lock:
+                counts[status] += 1
+                if entry is not None and entry != manifest.get(relpath):
+                    manifest[relpath] = entry
+                    changed[0] += 1
+                if status in ('new', 'updated'):
+                    received[0] += entry['size']
+                done = sum(counts.values())
+                if done % 100 == 0:
+                    self.logger.info(f'Checked {done} of {len(relpaths)} '
+                                     f'files, {received[0] / 1e6:0.1f} MB')
+                    if changed[0]:
+                        self.save_manifest(local_dir, manifest)
+                        changed[0] = 0
+            if status in ('new', 'updated'):
+                self.logger.debug(f'{status.capitalize()}: {relpath}')
+                if on_complete:
+                    on_complete(local_path)
+
+        os.makedirs(local_dir, exist_ok=True)
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                for _ in pool.map(fetch_one, relpaths):
+                    pass
+        finally:
+            if changed[0]:
+                self.save_manifest(local_dir, manifest)
+        elapsed = time() - start
+        self.logger.info(f'Fetched {counts["new"]} new and '
+                         f'{counts["updated"]} updated files '
+                         f'({received[0] / 1e6:0.1f} MB) in {elapsed:0.1f} '
+                         f'seconds; {counts["unchanged"]} unchanged, '
+                         f'{counts["failed"]} failed')
+        return counts
+
+    def sync_index(self, index_path, local_index, prefix, local_dir,
+                   pattern='*', on_complete=None, **columns):
+        """
+        Mirrors the matching files listed in a remote index table
+        instead of crawling directory listings. Each index row’s
+        contents serve as the product’s version; only products whose
+        row is new or has changed since the last sync are requested.
+
+        Parameters
+        ----------
+        index_path : string
+            Index file path relative to the remote base.
+        local_index : string
+            Where to keep the local copy of the index.
+        prefix : string
+            Remote directory, relative to the base, that corresponds to
+            `local_dir`; index rows outside it are ignored.
+        local_dir : string
+            Local data directory.
+        pattern : string
+            Shell-style pattern that file names must match.
+        on_complete : function
+            As in `mirror()`.
+        columns
+            Passed to `read_index()`.
+
+        Returns
+        -------
+            A dict of status to number of files.
+        """
+        if self.fetch_file(index_path, local_index) == 'failed':
+            raise IOError(f'Cannot download index {index_path}')
+        prefix = prefix.rstrip('/') + '/'
+        products = {}
+        for path, version in read_index(local_index, pattern, **columns):
+            if path.lower().startswith(prefix.lower()):
+                products[path[len(prefix):]] = version
+        manifest = self.load_manifest(local_dir)
+        changed = {relpath: version for relpath, version in products.items()
+                   if manifest.get(relpath, {}).get('index') != version}
+        self.logger.info(f'Index lists {len(products)} products, '
+                         f'{len(changed)} new or changed')
+        return self.fetch_all(prefix, sorted(changed), local_dir,
+                              on_complete, versions=changed)
+
+
+def read_index(filepath, pattern='*', path_column=None, name_column=None,
+               lowercase=False):
+    """
+    Reads a PDS-style index table (comma-separated, optionally quoted)
+    listing one product file per row.
+
+    Unless configured, the file name column is the first field whose
+    base name matches `pattern`; if that field is not already a path,
+    it is joined to the nearest earlier field containing a '/'.
+
+    Parameters
+    ----------
+    filepath : string
+        Local copy of the index.
+    pattern : string
+        Shell-style pattern that file names must match, ignoring case.
+    path_column : int
+        Column of the directory path, if known.
+    name_column : int
+        Column of the file name, if known.
+    lowercase : bool
+        Whether to convert paths to lower case, for archives whose
+        index is upper case but whose files are not.
+
+    Yields
+    ------
+    path
+        Product path relative to the archive root.
+    version
+        A digest of the product’s index row.
+    """
+    pattern = pattern.lower()
+    with open(filepath, newline='', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            fields = [x.strip() for x in next(csv.reader([line]))]
+            if name_column is not None:
+                name_idx = name_column
+            else:
+                name_idx = next((i for i, x in enumerate(fields)
+                                 if fnmatchcase(posixpath.basename(x).lower(),
+                                                pattern)), None)
+                if name_idx is None:
+                    continue
+            if name_idx >= len(fields):
+                continue
+            name = fields[name_idx]
+            if not fnmatchcase(posixpath.basename(name).lower(), pattern):
+                continue
+            if path_column is not None:
+                name = posixpath.join(fields[path_column], name)
+            elif '/' not in name:
+                dirs = [x for x in fields[:name_idx] if '/' in x]
+                if dirs:
+                    name = posixpath.join(dirs[-1], name)
+            path = posixpath.normpath(name).lstrip('/')
+            if lowercase:
+                path = path.lower()
+            yield path, hashlib.sha1(line.encode()).hexdigest()
@@ -17,6 +17,7 @@ class MossbauerImporter(_TrajectoryProcessor):
     - driver: None by default
     - file_ext: '_.txt' by default
     - pkey_field: 'Sample #' by default
+    - sample_field: 'Sample Name' by default, for the catalog
     """
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
@@ -30,6 +31,7 @@ class MossbauerImporter(_TrajectoryProcessor):
             'driver': None,
             'file_ext': '.txt',
             'pkey_field': 'Sample #',
+            'sample_field': 'Sample Name',
             'skipped' : 0,
         }
         for key, value in defaults.items():
@@ -57,6 +59,14 @@ class MossbauerImporter(_TrajectoryProcessor):
         """
         return filename.split('.')[0]
 
+    def adopt_metadata(self, metadata):
+        """
+        Extends _BaseProcessor’s adopt_metadata() to keep the masterfile
+        as `self.meta` too.
+        """
+        super().adopt_metadata(metadata)
+        self.meta = metadata
+
     def parse_metadata(self):
         """
         Reads the masterfile. 
@@ -101,6 +111,34 @@ class MossbauerImporter(_TrajectoryProcessor):
         meta = {key: val[meta_idx] for key, val in metadata.items()}
         return meta
     
+    def refresh_meta(self, meta):
+        """
+        Looks up each sample of existing output in the masterfile.
+
+        Parameters
+        ----------
+        meta
+            Existing metadata, as from `read_metadata()`.
+
+        Returns
+        -------
+            A dict of masterfile fields to arrays, except the ID field.
+        """
+        pkeys = np.asarray(self.meta[self.pkey_field], dtype=str)
+
+        def lookup(sample):
+            meta_idx, = np.where(pkeys == sample)
+            if len(meta_idx) != 1:
+                self.logger.warning(f'Cannot refresh {sample} from masterfile')
+                return
+            meta_idx = meta_idx[0]
+            post = self.meta['Post?'][meta_idx]
+            if post is None or post.upper() != 'Y':
+                self.logger.warning(f'{sample} is no longer marked for posting')
+            return {key: val[meta_idx] for key, val in self.meta.items()
+                    if key != self.pkey_field}
+        return self.refresh_rows(meta, self.pkey_field, lookup)
+
     def load_mossbauer_spectra(self, datafile):
         """
         Gets spectra from a single file.
@@ -131,7 +169,7 @@ class MossbauerImporter(_TrajectoryProcessor):
         if len(spectra) != self.channels:
             self.logger.warning(f'Expected {self.channels} channels, got {len(spectra)} in {datafile}')
             return
-        return spectra
+        return np.asarray(spectra)
     
     def process_spectra(self, datafile):
         """
@@ -149,8 +187,8 @@ class MossbauerImporter(_TrajectoryProcessor):
         meta
             A dict of a single file's metadata.
         """
-        result = self.load_mossbauer_spectra(datafile[1])
-        if not result:
+        result = self.load_cached(self.load_mossbauer_spectra, datafile[1])
+        if result is None:
             return
         if isinstance(result, str):
             self.logger.warning(result)
@@ -18,6 +18,8 @@ class MSLProcessor(_VectorProcessor):
     - driver: None by default
     - file_ext: '.txt' by default
     - pkey_field: 'spectrum_number' by default
+    - sample_field, shot_field: 'names' (the target) and 'numbers' by
+      default, for `aggregate` and the catalog
 
     logger: for logging errors
     metadata: to ensure that metadata can be used through processor
@@ -35,6 +37,8 @@ class MSLProcessor(_VectorProcessor):
             'driver': 'family',
             'file_ext': '.csv',
             'pkey_field': 'ids',
+            'sample_field': 'names',
+            'shot_field': 'numbers',
         }
         for key, value in defaults.items():
             if not hasattr(self, key):
@@ -65,7 +69,22 @@ class MSLProcessor(_VectorProcessor):
             IDs that have already been run.
         """
         raw_ids = super().get_processed_ids()
-        return [id[7:] for id in raw_ids]
+        return [self.input_id(id) for id in raw_ids]
+
+    def input_id(self, pkey):
+        """
+        Overrides base input_id, as IDs are stored with a prefix.
+
+        Parameters
+        ----------
+        pkey : string
+            A primary key value.
+
+        Returns
+        -------
+            The ID of the file it came from.
+        """
+        return pkey[7:]
 
     def make_meta(self, datafile, include_mean_spectrum=False):
         """
@@ -91,16 +110,36 @@ class MSLProcessor(_VectorProcessor):
             shot_num = np.arange(meta_row.nbr_of_shots+1)
         else:
             shot_num = np.arange(1, meta_row.nbr_of_shots+1)
-        autofocus = meta_row.autofocus == 'Yes'
-        dist = float(meta_row.distance_m[0])
         edr_id = '%s_%d' % (meta_row.edr_type[0], meta_row.spacecraft_clock[0])
-        metas = np.broadcast_arrays(shot_num, edr_id, meta_row.target, autofocus,
-                                    dist, meta_row.laser_energy,
-                                    meta_row.sol, meta_row.temperature)
-        meta_names = ('numbers', 'ids', 'names', 'foci', 'distances', 'powers',
-                      'sols', 'raw_temps')
+        row_meta = self.masterfile_meta(meta_row)
+        metas = np.broadcast_arrays(shot_num, edr_id, *row_meta.values())
+        meta_names = ('numbers', 'ids') + tuple(row_meta.keys())
         return dict(zip(meta_names, metas))
 
+    def masterfile_meta(self, meta_row):
+        """
+        Extracts the per-observation fields from a masterfile row.
+
+        Parameters
+        ----------
+        meta_row
+            A one-row slice of the masterfile.
+
+        Returns
+        -------
+            A dict of meta categories to one-element arrays.
+        """
+        autofocus = meta_row.autofocus == 'Yes'
+        dist = float(meta_row.distance_m[0])
+        return {
+            'names': meta_row.target,
+            'foci': autofocus,
+            'distances': dist,
+            'powers': meta_row.laser_energy,
+            'sols': meta_row.sol,
+            'raw_temps': meta_row.temperature,
+        }
+
     def match_metadata(self, filename):
         """
         Checks to see if an ID exists (already) in metadata.
@@ -131,6 +170,31 @@ class MSLProcessor(_VectorProcessor):
             return
         return row_idx[0]
 
+    def refresh_meta(self, meta):
+        """
+        Looks up each observation of existing output in the masterfile
+        by its spacecraft clock.
+
+        Parameters
+        ----------
+        meta
+            Existing metadata, as from `read_metadata()`.
+
+        Returns
+        -------
+            A dict of masterfile-derived meta fields to arrays.
+        """
+        def lookup(edr_id):
+            clock = int(edr_id.rsplit('_', 1)[-1])
+            row_idx, = np.where(self.metadata.spacecraft_clock == clock)
+            if len(row_idx) != 1:
+                self.logger.warning(f'Cannot refresh {edr_id} from masterfile')
+                return
+            meta_row = self.metadata[row_idx[0]:row_idx[0]+1]
+            return {key: np.asarray(val).item()
+                    for key, val in self.masterfile_meta(meta_row).items()}
+        return self.refresh_rows(meta, 'ids', lookup)
+
     def parse_csv(self, filename):
         """
         Processes a single spectra file.
@@ -192,7 +256,7 @@ class MSLProcessor(_VectorProcessor):
             A struct containing a single file's metadata values,
             including si_test value.
         """
-        spectra = self.parse_csv(datafile[1])
+        spectra = self.load_cached(self.parse_csv, datafile[1])
         if (spectra.ndim == 1 and spectra.shape[0] != self.channels) or \
            (spectra.ndim == 2 and spectra.shape[1] != self.channels):
             self.logger.warning("Problem encountered with spectra.ndim or spectra.shape.")
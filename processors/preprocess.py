@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+import h5py
+import json
+import numpy as np
+import os
+import shutil
+from .index import INDEX_GROUP, create_index, update_index
+from .pyramid import PYRAMID_GROUP, update_pyramid
+from .similarity import SIMILARITY_GROUP, update_similarity
+from .state import hdf5_options
+
+DEFAULTS = {
+    'baseline': 'polyfit',
+    'order': 5,
+    'iterations': 100,
+    'window': 101,
+    'normalize': 'l1',
+    'segments': 1,
+    'output_prefix': 'prepro_blr',
+}
+BASELINES = ('polyfit', 'opening', None)
+NORMS = ('l1', 'l2', 'max', None)
+BLOCK_BYTES = 64 * 2**20
+
+
+def preprocess_config(config, channels):
+    """
+    Checks a dataset’s `preprocess` configuration.
+
+    Parameters
+    ----------
+    config : dict
+        The configured options.
+    channels : int
+        Values per spectrum.
+
+    Returns
+    -------
+        The options with defaults filled in.
+
+    Raises
+    ------
+    ValueError
+        If an option is invalid.
+    """
+    config = {**DEFAULTS, **(config or {})}
+    if config['baseline'] not in BASELINES:
+        raise ValueError(f'Unknown baseline method {config["baseline"]}')
+    if config['normalize'] not in NORMS:
+        raise ValueError(f'Unknown normalization {config["normalize"]}')
+    if channels % config['segments']:
+        raise ValueError(f'{channels} channels cannot be split into '
+                         f'{config["segments"]} segments')
+    return config
+
+
+def polyfit_baseline(spectra, order, iterations, tolerance=1e-6):
+    """
+    Fits a baseline under each spectrum by iterated polynomial fitting
+    (Lieber and Mahadevan-Jansen’s “modified polyfit”): each pass fits
+    a polynomial and then clips the spectrum to it, so peaks stop
+    pulling the fit up. All spectra share the channel grid, so each pass
+    is two matrix products for the whole batch.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    order : int
+        Degree of the polynomial.
+    iterations : int
+        Maximum number of passes.
+    tolerance : float
+        Stop once no fitted value changes by more than this fraction of
+        the largest absolute value.
+
+    Returns
+    -------
+        The baselines, with the same shape as `spectra`.
+    """
+    x = np.linspace(-1, 1, spectra.shape[1])
+    # Legendre polynomials are much better conditioned than powers of x.
+    basis = np.polynomial.legendre.legvander(x, order)
+    projection = np.linalg.pinv(basis)
+    clipped = spectra.T.copy()
+    limit = tolerance * max(np.abs(spectra).max(), np.finfo(float).tiny)
+    fit = None
+    for _ in range(iterations):
+        previous = fit
+        fit = basis @ (projection @ clipped)
+        np.minimum(clipped, fit, out=clipped)
+        if previous is not None and np.abs(fit - previous).max() <= limit:
+            break
+    return fit.T
+
+
+def running(spectra, window, op):
+    """
+    Applies `np.minimum` or `np.maximum` over a window centred on each
+    channel of every spectrum, repeating the end values at the edges.
+    Windows are combined by doubling, so this takes log2(window)
+    passes over the batch rather than `window`.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    window : int
+        Width of the window in channels.
+    op
+        `np.minimum` or `np.maximum`.
+
+    Returns
+    -------
+        An array with the same shape as `spectra`.
+    """
+    n = spectra.shape[1]
+    half = window // 2
+    result = np.pad(spectra, ((0, 0), (half, window - 1 - half)),
+                    mode='edge')
+    span = 1
+    while span * 2 <= window:
+        result = op(result[:, :-span], result[:, span:])
+        span *= 2
+    # Each value now covers `span` channels; two overlap to cover window.
+    return op(result[:, :n], result[:, window - span:window - span + n])
+
+
+def opening_baseline(spectra, window):
+    """
+    Estimates the baseline of each spectrum by morphological opening:
+    a running minimum followed by a running maximum, which removes
+    peaks narrower than the window.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    window : int
+        Width of the structuring element in channels.
+
+    Returns
+    -------
+        The baselines, with the same shape as `spectra`.
+    """
+    return running(running(spectra, window, np.minimum), window, np.maximum)
+
+
+def normalize(spectra, method):
+    """
+    Scales each spectrum in place.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D float array of one spectrum per row.
+    method : string
+        'l1' for unit sum of absolute values, 'l2' for unit Euclidean
+        norm, 'max' for a largest absolute value of 1, or None.
+    """
+    if method is None:
+        return
+    if method == 'l1':
+        scale = np.abs(spectra).sum(axis=1, keepdims=True)
+    elif method == 'l2':
+        scale = np.sqrt(np.square(spectra).sum(axis=1, keepdims=True))
+    else:
+        scale = np.abs(spectra).max(axis=1, keepdims=True)
+    scale[scale == 0] = 1
+    spectra /= scale
+
+
+def preprocess(spectra, config):
+    """
+    Removes the baseline of, and normalizes, a batch of spectra. With
+    `segments`, each spectrum is treated as that many equal spectra side
+    by side, such as the three spectrometers of ChemCam and SuperCam
+    LIBS.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    config : dict
+        Options, as from `preprocess_config()`.
+
+    Returns
+    -------
+        A new float array with the same shape.
+    """
+    rows, channels = spectra.shape
+    segments = config['segments']
+    data = np.array(spectra, dtype=float).reshape(rows * segments,
+                                                  channels // segments)
+    if config['baseline'] == 'polyfit':
+        data -= polyfit_baseline(data, config['order'],
+                                 config['iterations'])
+    elif config['baseline'] == 'opening':
+        data -= opening_baseline(data, config['window'])
+    normalize(data, config['normalize'])
+    return data.reshape(rows, channels)
+
+
+def preprocessed_path(importer):
+    """
+    Returns
+    -------
+        The preprocessed spectra output filename of a dataset (pattern,
+        for the family driver).
+    """
+    suffix = '.hdf5' if importer.driver is None else '.%03d.hdf5'
+    return os.path.join(importer.paths['output'],
+                        importer.preprocess['output_prefix'] + suffix)
+
+
+def update_preprocessed(importer, spectra=None, start=None, meta=None):
+    """
+    Brings a vector dataset’s preprocessed output up to date with its
+    main output, which it mirrors row for row under its own prefix.
+
+    The rows committed to the main output since the last update are
+    preprocessed and appended. Usually these are the batch just
+    committed, whose spectra are passed in; otherwise, as after an
+    interruption, a rebuild or a change of options, the missing rows
+    are read back from the main output in large blocks. Decimated
+    levels and the similarity index, if configured, are kept for the
+    preprocessed spectra too.
+    The metadata file is shared through a hard link.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    spectra : array
+        The spectra of the batch just committed, if any.
+    start : int
+        Output row of the batch’s first row.
+    meta : dict
+        The main output’s metadata, if already loaded, as after
+        `commit_batch()` writes it.
+
+    Returns
+    -------
+        The number of rows preprocessed.
+    """
+    if meta is None:
+        meta = importer.read_metadata()
+    if meta is None:
+        return 0
+    config = importer.preprocess
+    ids = meta[importer.pkey_field]
+    rows = len(ids)
+    settings = json.dumps(config, sort_keys=True)
+    path = preprocessed_path(importer)
+    with h5py.File(path, 'a', libver='latest',
+                   **hdf5_options(path, importer.driver,
+                                  importer.member_size)) as fh:
+        done = int(fh['committed'][()]) if 'committed' in fh else 0
+        if done and (done > rows or fh.attrs.get('preprocess') != settings):
+            importer.logger.info(f'Preprocessing all of {importer.name} '
+                                 f'again')
+            done = 0
+        if done < rows:
+            if 'spectra' not in fh:
+                fh.create_dataset('spectra', shape=(0, importer.channels),
+                                  dtype=float, chunks=True,
+                                  maxshape=(None, importer.channels))
+            dset = fh['spectra']
+            dset.resize(done, axis=0)
+            if spectra is not None and start == done and \
+                    start + len(spectra) == rows:
+                append(dset, preprocess(spectra, config))
+            else:
+                source = importer.open_output(importer.output_path())
+                try:
+                    src = source['/spectra']
+                    step = max(1, BLOCK_BYTES // (src.shape[1] * 8))
+                    for first in range(done, rows, step):
+                        last = min(first + step, rows)
+                        append(dset, preprocess(src[first:last], config))
+                finally:
+                    importer.close_output(source)
+            if done == 0:
+                for group in (INDEX_GROUP, PYRAMID_GROUP, SIMILARITY_GROUP):
+                    if group in fh:
+                        del fh[group]
+            if INDEX_GROUP not in fh:
+                create_index(fh, importer.pkey_field, ids[:done])
+            update_index(fh, ids[done:], done)
+            fh.attrs['preprocess'] = settings
+            if 'committed' in fh:
+                fh['committed'][()] = rows
+            else:
+                fh.create_dataset('committed', data=rows)
+            importer.logger.debug(f'Preprocessed rows {done} to {rows}')
+        if importer.pyramid and 'spectra' in fh:
+            update_pyramid(fh, importer.pyramid, rows)
+        if importer.similarity and 'spectra' in fh:
+            update_similarity(fh, importer.similarity, rows)
+    link_metadata(importer, config['output_prefix'])
+    return rows - done
+
+
+def append(dset, data):
+    """
+    Appends rows to a growable 2-D dataset.
+    """
+    n = dset.shape[0]
+    dset.resize(n + len(data), axis=0)
+    dset[n:] = data
+
+
+def link_metadata(importer, output_prefix):
+    """
+    Points the metadata file of a companion output, such as the
+    preprocessed output, at the main output’s, by a hard link where the
+    file system allows it.
+    """
+    source = importer.paths['meta_output']
+    target = os.path.join(importer.paths['output'],
+                          output_prefix + '_meta.npz')
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError:
+        shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, target)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+PYRAMID_GROUP = 'pyramid'
+BLOCK_BYTES = 64 * 2**20
+
+
+def decimate(spectra, factor):
+    """
+    Reduces each row of a spectra matrix to the minimum and maximum of
+    every `factor` channels, so that a plot of the result has the same
+    envelope as a plot of the full spectra. NaNs are ignored.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row, or a level from an earlier
+        call (3-D, with minima and maxima in the last axis).
+    factor : int
+        Number of channels (or bins) per bin.
+
+    Returns
+    -------
+        A 3-D array of shape (rows, bins, 2) of minima and maxima.
+    """
+    if spectra.ndim == 2:
+        spectra = np.stack((spectra, spectra), axis=2)
+    rows, channels = spectra.shape[:2]
+    bins = -(-channels // factor)
+    pad = bins * factor - channels
+    if pad:
+        # Repeating the last value does not change its bin’s extremes.
+        spectra = np.pad(spectra, ((0, 0), (0, pad), (0, 0)), mode='edge')
+    blocks = spectra.reshape(rows, bins, factor, 2)
+    return np.stack((np.fmin.reduce(blocks[..., 0], axis=2),
+                     np.fmax.reduce(blocks[..., 1], axis=2)), axis=2)
+
+
+def decimate_levels(spectra, levels):
+    """
+    Computes several levels with `decimate()`, each from the finest
+    earlier level whose factor divides its own.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+    levels : list
+        Decimation factors.
+
+    Returns
+    -------
+        A dict of factor to level.
+    """
+    results = {}
+    for factor in sorted(levels):
+        base, source = 1, spectra
+        for done, level in results.items():
+            if factor % done == 0:
+                base, source = done, level
+        results[factor] = decimate(source, factor // base)
+    return results
+
+
+def decimate_trajectory(trajectory, factor):
+    """
+    Reduces an (x, y) trajectory to the points with the lowest and
+    highest y in every `factor` points, in their original order, so
+    the result is itself a trajectory with the same envelope.
+
+    Parameters
+    ----------
+    trajectory : array
+        Array of shape (points, 2).
+    factor : int
+        Number of points per bin.
+
+    Returns
+    -------
+        An array of shape (2 * bins, 2).
+    """
+    n = len(trajectory)
+    bins = -(-n // factor)
+    y = np.pad(trajectory[:, 1], (0, bins * factor - n), mode='edge')
+    blocks = y.reshape(bins, factor)
+    offsets = np.arange(bins)[:, None] * factor
+    lowest = np.argmin(np.where(np.isnan(blocks), np.inf, blocks), axis=1)
+    highest = np.argmax(np.where(np.isnan(blocks), -np.inf, blocks), axis=1)
+    points = np.sort(np.stack((lowest, highest), axis=1) + offsets, axis=1)
+    return trajectory[np.minimum(points.ravel(), n - 1)]
+
+
+def create_pyramid(fh, levels, channels):
+    """
+    Creates the empty levels of a vector output file, as
+    `/pyramid/<factor>` datasets of shape (rows, bins, 2).
+
+    Parameters
+    ----------
+    fh
+        The open output file, not yet in SWMR mode.
+    levels : list
+        Decimation factors.
+    channels : int
+        Values per spectrum.
+    """
+    group = fh.require_group(PYRAMID_GROUP)
+    for factor in levels:
+        if str(factor) not in group:
+            bins = -(-channels // factor)
+            group.create_dataset(str(factor), shape=(0, bins, 2),
+                                 dtype=float, chunks=True,
+                                 maxshape=(None, bins, 2))
+
+
+def update_pyramid(fh, levels, start, spectra=None):
+    """
+    Brings the levels of a vector output file up to row `start`, then
+    appends the levels of new rows. Rows at or past `start` left over
+    from an interrupted batch are dropped; missing rows, as in output
+    written before the levels were configured or stitched by a
+    rebuild, are read back from `/spectra` in large blocks.
+
+    Parameters
+    ----------
+    fh
+        The open output file.
+    levels : list
+        Decimation factors.
+    start : int
+        Output row of the first new row.
+    spectra : array
+        2-D array of new rows, or None.
+    """
+    source = fh['spectra']
+    create_pyramid(fh, levels, source.shape[1])
+    group = fh[PYRAMID_GROUP]
+    done = min([group[str(f)].shape[0] for f in levels] + [start])
+    step = max(1, BLOCK_BYTES // (source.shape[1] * source.dtype.itemsize))
+    for first in range(done, start, step):
+        last = min(first + step, start)
+        write_levels(group, levels, first, source[first:last])
+    if spectra is None:
+        write_levels(group, levels, start, source[start:start])
+    else:
+        write_levels(group, levels, start, spectra)
+
+
+def write_levels(group, levels, first, spectra):
+    """
+    Writes the levels of rows starting at row `first`, truncating each
+    level there first.
+    """
+    for factor, level in decimate_levels(spectra, levels).items():
+        dset = group[str(factor)]
+        dset.resize(first + len(level), axis=0)
+        dset[first:] = level
+
+
+def write_trajectory_pyramid(fh, levels, ids, spectra):
+    """
+    Writes the levels of trajectory spectra, as `/pyramid/<factor>/<id>`
+    datasets, replacing any earlier ones.
+
+    Parameters
+    ----------
+    fh
+        The open output file.
+    levels : list
+        Decimation factors.
+    ids : list
+        Spectrum IDs.
+    spectra : list
+        Trajectory of each ID.
+    """
+    for id, spectrum in zip(ids, spectra):
+        for factor in levels:
+            path = f'/{PYRAMID_GROUP}/{factor}/{id}'
+            if path in fh:
+                del fh[path]
+            fh.create_dataset(path,
+                              data=decimate_trajectory(spectrum, factor))
+
+
+def copy_pyramid(src, dst, rows, ids=None):
+    """
+    Copies the levels of committed spectra to a new output file.
+
+    Parameters
+    ----------
+    src, dst
+        The original and new output files.
+    rows : int
+        Number of committed rows.
+    ids : list
+        IDs of trajectory spectra, or None for vector spectra.
+    """
+    if PYRAMID_GROUP not in src:
+        return
+    for factor, level in src[PYRAMID_GROUP].items():
+        path = f'/{PYRAMID_GROUP}/{factor}'
+        if ids is None:
+            data = level[:min(rows, level.shape[0])]
+            dst.create_dataset(path, data=data, chunks=True,
+                               maxshape=(None,) + data.shape[1:])
+            continue
+        group = dst.require_group(path)
+        for id in ids:
+            if id in level:
+                src.copy(level[id], group, id)
@@ -20,6 +20,7 @@ class RamanImporter(_TrajectoryProcessor):
     - driver: None by default
     - file_ext: '.txt' by default
     - pkey_field: 'spectrum_number' by default
+    - sample_field: 'sample' by default, for the catalog
 
     meta: a dictionary to hold metadata
     logger: for logging errors
@@ -37,6 +38,7 @@ class RamanImporter(_TrajectoryProcessor):
             'driver': None,
             'file_ext': '.txt',
             'pkey_field': 'spectrum_number',
+            'sample_field': 'sample',
             'output_prefix': 'raman',
         }
         for key, value in defaults.items():
@@ -95,6 +97,14 @@ class RamanImporter(_TrajectoryProcessor):
         """
         return True 
 
+    def adopt_metadata(self, metadata):
+        """
+        Extends _BaseProcessor’s adopt_metadata() to keep the masterfile
+        as `self.meta` too.
+        """
+        super().adopt_metadata(metadata)
+        self.meta = metadata
+
     def parse_metadata(self):
         """
         Gets metadata from Raman's rlogbook.
@@ -145,7 +155,8 @@ class RamanImporter(_TrajectoryProcessor):
             meta[self.pkey_field] = meta[self.pkey_field] + "_" + is_underscored
 
         #switched to datafile[1] for path
-        spectra = np.genfromtxt(datafile[1], delimiter=',')
+        spectra = self.load_cached(
+            lambda f: np.genfromtxt(f, delimiter=','), datafile[1])
         if spectra.ndim != 2 or spectra.shape[1] != 2:
             self.logger.warning('Spectra must be a trajectory')
             return
@@ -155,3 +166,29 @@ class RamanImporter(_TrajectoryProcessor):
             spectra = spectra[::-1]
         return spectra, meta
 
+    def refresh_meta(self, meta):
+        """
+        Looks up each spectrum of existing output in the logbook. IDs
+        that had an underscored suffix added are matched without it.
+
+        Parameters
+        ----------
+        meta
+            Existing metadata, as from `read_metadata()`.
+
+        Returns
+        -------
+            A dict of logbook fields to arrays, except the ID field.
+        """
+        pkeys = np.array(self.meta[self.pkey_field])
+
+        def lookup(spectrum_id):
+            meta_idx, = np.where(pkeys == spectrum_id)
+            if len(meta_idx) < 1 and '_' in spectrum_id:
+                meta_idx, = np.where(pkeys == spectrum_id.rsplit('_', 1)[0])
+            if len(meta_idx) < 1:
+                self.logger.warning(f'Cannot refresh {spectrum_id} from masterfile')
+                return
+            return {key: val[meta_idx[0]] for key, val in self.meta.items()
+                    if key != self.pkey_field}
+        return self.refresh_rows(meta, self.pkey_field, lookup)
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+
+import h5py
+import numpy as np
+import os
+import struct
+import zipfile
+from collections import OrderedDict
+from .index import INDEX_GROUP, id_key, read_index
+from .pyramid import PYRAMID_GROUP
+from .similarity import SIMILARITY_GROUP, nearest_rows, unit_rows
+from .state import PATH_DEFAULTS, file_fingerprint, hdf5_options
+
+BLOCK_BYTES = 2**18
+
+
+class OutputReader(object):
+    """
+    Reads a dataset’s output, including while a processor is still
+    appending to it.
+
+    Only committed rows are visible: those counted in the output’s
+    `/committed` dataset and present in the metadata file. Single-file
+    vector output written with `swmr` is opened in SWMR read mode
+    without file locking, so it can be read while the writer holds it
+    open; call `refresh()` to see batches committed since. Other output
+    cannot be written in SWMR mode, so it should be opened between
+    batches.
+
+    Each spectrum can be fetched by ID through the index the processor
+    keeps in the output (see `index.py`), without searching the
+    metadata. Metadata columns are only read when first used (see
+    `LazyMetadata`), and recently read spectra are kept in an LRU
+    cache: whole spectra for trajectory output, and blocks of about
+    256 KiB of rows for vector output. Decimated levels written with
+    the `pyramid` option (see `pyramid.py`) are read with `overview()`,
+    and spectra indexed with the `similarity` option are matched with
+    `similar()`.
+    """
+
+    def __init__(self, output_dir, output_prefix=None, driver=None,
+                 cache_size=64):
+        """
+        Parameters
+        ----------
+        output_dir : string
+            Directory holding the output.
+        output_prefix : string
+            As configured for the dataset.
+        driver : string
+            HDF5 driver used for the output, 'family' or None. A family
+            is also found without it.
+        cache_size : float
+            Size of the spectrum cache in MiB; 0 to disable it.
+        """
+        prefix = output_prefix or PATH_DEFAULTS['output_prefix']
+        self.filepath = os.path.join(output_dir, prefix + '.hdf5')
+        first_member = os.path.join(output_dir, prefix + '.000.hdf5')
+        if driver is None and not os.path.exists(self.filepath) and \
+                os.path.exists(first_member):
+            driver = 'family'
+        if driver is not None:
+            self.filepath = os.path.join(output_dir, prefix + '.%03d.hdf5')
+        self.meta_path = os.path.join(output_dir, prefix + '_meta.npz')
+        # HDF5’s family driver does not support SWMR.
+        self.fh = h5py.File(self.filepath, 'r', libver='latest',
+                            swmr=driver is None, locking=False,
+                            **hdf5_options(self.filepath, driver))
+        self.cache = LRUCache(int(cache_size * 2**20))
+        self.meta = {}
+        self.meta_fingerprint = None
+        self.rows = 0
+        self.index = {}
+        self.index_size = 0
+        self.field = None
+        self.dset = None
+        self.projection = None
+        self.vectors = np.zeros((0, 0), np.float32)
+        self.vector_rows = 0
+        self.similarity_settings = None
+        if not self.is_trajectory() and '/spectra' in self.fh:
+            self.dset = self.fh['/spectra']
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fh.close()
+        self.cache.clear()
+
+    def is_trajectory(self):
+        """
+        Returns
+        -------
+            True if `/spectra` is a group of one dataset per spectrum.
+        """
+        return isinstance(self.fh.get('spectra'), h5py.Group)
+
+    def refresh(self):
+        """
+        Catch up with batches committed since the output was opened or
+        last refreshed.
+
+        Returns
+        -------
+            The number of committed rows.
+        """
+        fingerprint = file_fingerprint(self.meta_path)
+        if fingerprint != self.meta_fingerprint:
+            self.meta = LazyMetadata(self.meta_path)
+            self.meta_fingerprint = fingerprint
+        rows = self.meta.rows
+        if '/committed' in self.fh:
+            committed = self.fh['/committed']
+            committed.refresh()
+            rows = min(rows, int(committed[()]))
+        if self.dset is not None:
+            self.dset.refresh()
+            rows = min(rows, self.dset.shape[0])
+        self.rows = rows
+        self.refresh_index()
+        self.refresh_similarity()
+        return rows
+
+    def refresh_index(self):
+        """
+        Read the index entries of rows committed since the last refresh.
+        """
+        group = self.fh.get(INDEX_GROUP)
+        if group is None:
+            return
+        self.field = group.attrs['field']
+        for name in group:
+            group[name].refresh()
+        if group['start'].shape[0] < self.index_size:
+            # Compaction or a rebuild replaced the output.
+            self.index, self.index_size = {}, 0
+            self.cache.clear()
+        entries, self.index_size = read_index(group, self.index_size,
+                                              self.rows)
+        if self.is_trajectory():
+            # A trajectory ID may have been processed again.
+            for key in entries:
+                self.cache.pop(key)
+        self.index.update(entries)
+
+    def refresh_similarity(self):
+        """
+        Read the similarity index entries of rows committed since the
+        last refresh into memory.
+        """
+        group = self.fh.get(SIMILARITY_GROUP)
+        if group is None:
+            return
+        dset = group['vectors']
+        dset.refresh()
+        settings = group.attrs['settings']
+        if settings != self.similarity_settings or \
+                dset.shape[0] < self.vector_rows:
+            # New options, compaction or a rebuild replaced the index.
+            self.projection = group['projection'][()]
+            self.vectors = np.zeros((0, dset.shape[1]), np.float32)
+            self.vector_rows = 0
+            self.similarity_settings = settings
+        stop = min(dset.shape[0], self.rows)
+        if stop <= self.vector_rows:
+            return
+        if stop > len(self.vectors):
+            # Grow by doubling, so following a writer stays linear.
+            vectors = np.zeros((max(stop, 2 * len(self.vectors)),
+                                dset.shape[1]), np.float32)
+            vectors[:self.vector_rows] = self.vectors[:self.vector_rows]
+            self.vectors = vectors
+        self.vectors[self.vector_rows:stop] = dset[self.vector_rows:stop]
+        self.vector_rows = stop
+
+    def metadata(self):
+        """
+        Returns
+        -------
+            A dict of column name to array of the committed rows.
+        """
+        return {k: v[:self.rows] for k, v in self.meta.items()}
+
+    def spectra(self, start=0, stop=None):
+        """
+        Read committed rows of vector output.
+
+        Parameters
+        ----------
+        start, stop : int
+            Row range, limited to the committed rows.
+
+        Returns
+        -------
+            A 2-D array, which is read-only if it came from the cache.
+        """
+        stop = self.rows if stop is None else min(stop, self.rows)
+        return self.read_rows(start, stop)
+
+    def read_rows(self, start, stop):
+        """
+        Read rows of vector output through the cache. Reads too large
+        for the cache go straight to the file.
+
+        Parameters
+        ----------
+        start, stop : int
+            Committed row range.
+
+        Returns
+        -------
+            A 2-D array, which is read-only if it came from the cache.
+        """
+        dset = self.dset
+        row_bytes = dset.shape[1] * dset.dtype.itemsize
+        if (stop - start) * row_bytes * 2 > self.cache.max_bytes:
+            return dset[start:stop]
+        block = max(1, BLOCK_BYTES // row_bytes)
+        if dset.chunks:
+            block = max(1, block // dset.chunks[0]) * dset.chunks[0]
+        parts = []
+        for first in range(start - start % block, stop, block):
+            last = min(first + block, self.rows)
+            data = self.cache.get(('rows', first))
+            if data is None or len(data) < last - first:
+                data = dset[first:last]
+                data.flags.writeable = False
+                self.cache.put(('rows', first), data)
+            parts.append(data[max(start - first, 0):stop - first])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts)
+
+    def spectrum(self, id):
+        """
+        Read one spectrum of trajectory output.
+
+        Parameters
+        ----------
+        id
+            The spectrum’s ID.
+
+        Returns
+        -------
+            The spectrum array, which is read-only.
+        """
+        key = id_key(id)
+        data = self.cache.get(key)
+        if data is None:
+            data = self.fh[f'/spectra/{id}'][()]
+            data.flags.writeable = False
+            self.cache.put(key, data)
+        return data
+
+    def key_field(self):
+        """
+        Returns
+        -------
+            The name of the metadata column the index is keyed on.
+
+        Raises
+        ------
+        ValueError
+            If the output has no index yet; one is created by the next
+            batch or by `process_all.py --compact`.
+        """
+        if self.field is None:
+            raise ValueError(f'{self.filepath} has no index')
+        return self.field
+
+    def locate(self, id):
+        """
+        Find the rows of one ID in the index.
+
+        Parameters
+        ----------
+        id
+            A value of the dataset’s primary key field.
+
+        Returns
+        -------
+            The first row and the number of rows.
+
+        Raises
+        ------
+        KeyError
+            If the ID is not in the committed output.
+        ValueError
+            If the output has no index (see `key_field()`).
+        """
+        field = self.key_field()
+        entry = self.index.get(id_key(id))
+        if entry is not None:
+            if str(self.meta[field][entry[0]]) == str(id):
+                return entry
+        raise KeyError(id)
+
+    def fetch(self, id):
+        """
+        Read the spectra and metadata of one ID, such as all shots of
+        one LIBS or MSL file, with one read of each.
+
+        Parameters
+        ----------
+        id
+            A value of the dataset’s primary key field.
+
+        Returns
+        -------
+            The spectra (a 2-D array of rows for vector output, or the
+            spectrum for trajectory output), and a dict of column name
+            to array of the metadata rows.
+        """
+        start, count = self.locate(id)
+        meta = {k: v[start:start + count] for k, v in self.meta.items()}
+        if self.is_trajectory():
+            return self.spectrum(id), meta
+        return self.read_rows(start, start + count), meta
+
+    def levels(self):
+        """
+        Returns
+        -------
+            The decimation factors of the output’s levels, in increasing
+            order.
+        """
+        group = self.fh.get(PYRAMID_GROUP)
+        return sorted(int(name) for name in group) if group else []
+
+    def overview(self, id, factor):
+        """
+        Read the decimated level of one ID’s spectra.
+
+        Parameters
+        ----------
+        id
+            A value of the dataset’s primary key field.
+        factor : int
+            Decimation factor, one of `levels()`.
+
+        Returns
+        -------
+            For vector output, an array of shape (rows, bins, 2) of the
+            minima and maxima of each bin; for trajectory output, the
+            decimated trajectory.
+        """
+        start, count = self.locate(id)
+        if self.is_trajectory():
+            return self.fh[f'/{PYRAMID_GROUP}/{factor}/{id}'][()]
+        return self.overview_rows(start, start + count, factor)
+
+    def overview_rows(self, start, stop, factor):
+        """
+        Read the decimated level of committed rows of vector output.
+
+        Parameters
+        ----------
+        start, stop : int
+            Row range, limited to the committed rows.
+        factor : int
+            Decimation factor, one of `levels()`.
+
+        Returns
+        -------
+            An array of shape (rows, bins, 2).
+        """
+        dset = self.fh[f'/{PYRAMID_GROUP}/{factor}']
+        dset.refresh()
+        return dset[start:min(stop, self.rows)]
+
+    def similar(self, spectrum, k=10, candidates=None):
+        """
+        Find the committed rows most similar to a spectrum by cosine
+        similarity, without scanning `/spectra`: the similarity index
+        (see `similarity.py`) picks `candidates` rows by their
+        projections, and only those rows are read and ranked exactly.
+
+        Parameters
+        ----------
+        spectrum : array
+            The spectrum to match, on the output’s channels (for a
+            resampled output, its shared axis).
+        k : int
+            Number of rows to return.
+        candidates : int
+            Number of rows to rank exactly, 4 * `k` by default. More
+            make a missed match less likely, at the cost of more reads.
+
+        Returns
+        -------
+            The IDs, row numbers, and cosine similarities of up to `k`
+            rows, most similar first.
+
+        Raises
+        ------
+        ValueError
+            If the output has no similarity index.
+        """
+        if self.projection is None:
+            raise ValueError(f'{self.filepath} has no similarity index')
+        count = max(k, candidates or 4 * k)
+        rows = np.sort(nearest_rows(self.vectors[:self.vector_rows],
+                                    self.projection, spectrum, count))
+        if not len(rows):
+            return np.zeros(0, object), rows, np.zeros(0, np.float32)
+        query = unit_rows(np.asarray(spectrum)[None])[0]
+        # Candidates cluster, as shots of one ID do; read each run of
+        # consecutive rows at once.
+        runs = np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1)
+        spectra = np.concatenate([self.read_rows(run[0], run[-1] + 1)
+                                  for run in runs])
+        scores = unit_rows(spectra) @ query
+        order = np.argsort(-scores, kind='stable')[:k]
+        rows, scores = rows[order], scores[order]
+        return self.meta[self.key_field()][rows], rows, scores
+
+    def find(self, **conditions):
+        """
+        Find committed rows by metadata. Each keyword names a column
+        and gives a value it must equal, a list, tuple or set of values
+        it must be one of, or a function of the column returning a
+        boolean array.
+
+        Returns
+        -------
+            An array of row numbers in increasing order.
+        """
+        mask = np.ones(self.rows, dtype=bool)
+        for key, value in conditions.items():
+            column = self.meta[key][:self.rows]
+            if callable(value):
+                mask &= np.asarray(value(column), dtype=bool)
+            elif isinstance(value, (list, tuple, set)):
+                mask &= np.isin(column, list(value))
+            else:
+                mask &= column == value
+        return np.flatnonzero(mask)
+
+    def select(self, **conditions):
+        """
+        Read the spectra and metadata of rows chosen as by `find()`.
+
+        Returns
+        -------
+            The spectra (a 2-D array for vector output, or a list for
+            trajectory output), and a dict of column name to array of
+            the metadata rows.
+        """
+        rows = self.find(**conditions)
+        meta = {k: v[:self.rows][rows] for k, v in self.meta.items()}
+        if self.is_trajectory():
+            ids = meta[self.key_field()]
+            return [self.spectrum(id) for id in ids], meta
+        if not len(rows):
+            return np.zeros((0, self.dset.shape[1]), self.dset.dtype), meta
+        # Read each run of consecutive rows at once.
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        runs = np.split(rows, breaks)
+        return np.concatenate([self.read_rows(run[0], run[-1] + 1)
+                               for run in runs]), meta
+
+
+class LazyMetadata(object):
+    """
+    Read-only dict-like view of an npz metadata file that reads each
+    column when it is first used.
+
+    `np.savez` stores columns uncompressed, so each column without
+    Python objects is memory-mapped from inside the archive rather
+    than read; other columns are loaded. The metadata file is replaced
+    rather than rewritten, so a view stays valid until it is dropped.
+    """
+
+    def __init__(self, filepath):
+        """
+        Parameters
+        ----------
+        filepath
+            Full path of the npz file.
+        """
+        self.filepath = filepath
+        self.columns = {}
+        self.members = {}
+        self.rows = 0
+        with zipfile.ZipFile(filepath) as zf, open(filepath, 'rb') as f:
+            for info in zf.infolist():
+                if not info.filename.endswith('.npy'):
+                    continue
+                key = info.filename[:-4]
+                with zf.open(info) as member:
+                    version = np.lib.format.read_magic(member)
+                    header = np.lib.format.read_array_header_1_0 \
+                        if version == (1, 0) else \
+                        np.lib.format.read_array_header_2_0
+                    shape, fortran, dtype = header(member)
+                    header_size = member.tell()
+                offset = None
+                if info.compress_type == zipfile.ZIP_STORED and \
+                        not dtype.hasobject:
+                    f.seek(info.header_offset + 26)
+                    name_size, extra_size = struct.unpack('<HH', f.read(4))
+                    offset = info.header_offset + 30 + name_size + \
+                        extra_size + header_size
+                self.members[key] = (shape, fortran, dtype, offset)
+        if self.members:
+            self.rows = next(iter(self.members.values()))[0][0]
+
+    def __getitem__(self, key):
+        if key not in self.columns:
+            shape, fortran, dtype, offset = self.members[key]
+            if offset is None:
+                with np.load(self.filepath, allow_pickle=True) as npz:
+                    self.columns[key] = npz[key]
+            elif not np.prod(shape):
+                self.columns[key] = np.zeros(shape, dtype=dtype)
+            else:
+                self.columns[key] = np.memmap(
+                    self.filepath, dtype=dtype, mode='r', offset=offset,
+                    shape=shape, order='F' if fortran else 'C')
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.members
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def keys(self):
+        return self.members.keys()
+
+    def values(self):
+        return (self[k] for k in self.members)
+
+    def items(self):
+        return ((k, self[k]) for k in self.members)
+
+
+class LRUCache(object):
+    """
+    Keeps the most recently used arrays up to a total size.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Parameters
+        ----------
+        max_bytes : int
+            Total size of the arrays kept.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns
+        -------
+            The cached array, or None.
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Add an array, dropping the least recently used ones to make
+        room. Arrays larger than the whole cache are not kept.
+        """
+        self.pop(key)
+        if value.nbytes > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.size += value.nbytes
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= old.nbytes
+
+    def pop(self, key):
+        """
+        Drop one entry, if present.
+        """
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.size -= value.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
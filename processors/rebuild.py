@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+import glob
+import h5py
+import numpy as np
+import os
+import shutil
+import processors
+from concurrent.futures import ProcessPoolExecutor
+from h5py import h5d, h5p, h5s, h5t
+from .aggregate import aggregate_path
+from .catalog import forget_dataset
+from .duplicates import HASH_FIELD
+from .index import create_index
+from .masterfiles import MasterfileRegistry
+from .preprocess import preprocessed_path
+from .resample import resampled_path
+from .state import PATH_DEFAULTS, hdf5_options, load_state, save_state
+from time import strftime
+
+SHARD_DIR = 'shards'
+
+
+def rebuild(importer, config, workers=None, shards=None):
+    """
+    Rebuild a dataset’s output from scratch with several processes.
+
+    The input files are split, in order, into contiguous shards. Each
+    worker process writes its shard’s spectra and metadata to its own
+    output in the `shards` subdirectory. The shards are then stitched
+    together without copying any spectra: a vector dataset’s `/spectra`
+    becomes a virtual dataset mapping each shard’s rows in turn, and a
+    trajectory dataset’s `/spectra/<id>` entries become external links.
+    The merged metadata has the same rows in the same order as a serial
+    build. The previous output is only replaced once every shard has
+    been written. Entries of the parsed-spectrum cache that can no
+    longer be used are then removed.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset, used to list the input files and to
+        stitch the result.
+    config : dict
+        The dataset configuration `importer` was created with.
+    workers : int
+        Number of worker processes; defaults to the number of CPUs.
+    shards : int
+        Number of shards; defaults to `workers`.
+
+    Returns
+    -------
+        The number of rows in the rebuilt output.
+    """
+    workers = workers or os.cpu_count()
+    shards = shards or workers
+    logger = importer.logger
+    input_data = importer.get_input_data()
+    files = [(dirname, file) for dirname, val in input_data.items()
+             for file in val]
+    if not files:
+        logger.info('No data in input, nothing to rebuild')
+        return 0
+    shards = min(shards, len(files))
+    bounds = np.linspace(0, len(files), shards + 1).astype(int)
+    shard_dir = os.path.join(importer.paths['output'], SHARD_DIR)
+    # The previous rebuild’s shards are still in use; within the same
+    # second, they must not be written to again.
+    stamp = base = strftime('%Y%m%d%H%M%S')
+    attempt = 0
+    while glob.glob(os.path.join(glob.escape(shard_dir), f'*_{stamp}_*')):
+        attempt += 1
+        stamp = f'{base}-{attempt}'
+    prefixes = [f'{importer.output_prefix}_{stamp}_{i:03d}'
+                for i in range(shards)]
+    config = shard_config(config, SHARD_DIR, 'rebuild')
+    # A trajectory dataset’s decimated levels are linked like its spectra.
+    if importer.is_trajectory() and importer.pyramid:
+        config['pyramid'] = importer.pyramid
+    # Workers get the masterfile parsed once here, pickled with the task.
+    importer.ensure_metadata()
+    config['masterfiles'] = MasterfileRegistry({
+        importer.masterfile_key(): (importer.metadata_fingerprint,
+                                    importer.metadata)})
+    logger.info(f'Rebuilding {importer.name} from {len(files)} files in '
+                f'{shards} shards with {workers} workers')
+    # Created here, as the workers would race to create it
+    os.makedirs(shard_dir, mode=0o755, exist_ok=True)
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(build_shard, type(importer).__name__,
+                                   config, prefix, files[lo:hi])
+                       for prefix, lo, hi in zip(prefixes, bounds[:-1],
+                                                 bounds[1:])]
+            counts = [future.result() for future in futures]
+    except BaseException:
+        for path in glob.glob(os.path.join(shard_dir, f'*_{stamp}_*')):
+            os.remove(path)
+        raise
+    prefixes = [p for p, n in zip(prefixes, counts) if n]
+    if not prefixes:
+        logger.info('No spectra found in input')
+        return 0
+    rows = stitch(importer, prefixes, stamp)
+    logger.info(f'Rebuilt {importer.name} with {rows} rows')
+    if importer.spectrum_cache is not None:
+        removed = importer.spectrum_cache.prune()
+        if removed:
+            logger.info(f'Removed {removed} stale entries from the '
+                        f'parsed-spectrum cache')
+    importer.catch_up()
+    return rows
+
+
+def shard_config(config, subdir, log_suffix):
+    """
+    Derive the configuration of a dataset’s shard processors, which
+    write to a subdirectory of its output directory. Everything derived
+    from the output (the preprocessed, resampled and per-sample
+    outputs, the catalog entries, and decimated levels and similarity
+    index) is left out, to be regenerated from the combined output.
+
+    Parameters
+    ----------
+    config : dict
+        The dataset configuration.
+    subdir : string
+        Subdirectory of the output directory for the shards.
+    log_suffix : string
+        Distinguishes the shards’ log files.
+
+    Returns
+    -------
+        A new configuration dict.
+    """
+    config = dict(config)
+    output_dir = config.get('output_dir', PATH_DEFAULTS['output_dir'])
+    config['output_dir'] = os.path.join(output_dir, subdir)
+    config['log_suffix'] = log_suffix
+    for key in ('preprocess', 'resample', 'aggregate', 'catalog',
+                'similarity', 'pyramid'):
+        config.pop(key, None)
+    return config
+
+
+def build_shard(class_name, config, output_prefix, files):
+    """
+    Worker process entry point: processes one shard of input files into
+    its own output.
+
+    Parameters
+    ----------
+    class_name : string
+        Processor class, as exported by the `processors` package.
+    config : dict
+        Processor configuration with `output_dir` set to the shards.
+    output_prefix : string
+        Output prefix for this shard.
+    files : list
+        Pairs of input directory name and file tuple.
+
+    Returns
+    -------
+        The number of rows written.
+    """
+    importer = getattr(processors, class_name)(
+        **config, output_prefix=output_prefix)
+    unprocessed = {}
+    for dirname, file in files:
+        unprocessed.setdefault(dirname, []).append(file)
+    importer.ensure_metadata()
+    importer.process_all(unprocessed)
+    importer.close()
+    return importer.count_rows()
+
+
+def stitch(importer, prefixes, stamp):
+    """
+    Replace a dataset’s output with one that presents the given shards
+    as a single `/spectra` and metadata table.
+
+    Each shard only left out duplicates of its own files, so with
+    `duplicates`, those of files in earlier shards are found here (see
+    `find_duplicates()`) and left out of the table, or linked to the
+    spectra they duplicate, as in a serial build.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    prefixes : list
+        Output prefixes of the shards, in order.
+    stamp : string
+        Identifies this rebuild’s files in the shards directory.
+
+    Returns
+    -------
+        The number of rows.
+    """
+    output = importer.paths['output']
+    shard_dir = os.path.join(output, SHARD_DIR)
+    suffix = '.hdf5' if importer.driver is None else '.%03d.hdf5'
+    metas = []
+    for prefix in prefixes:
+        with np.load(os.path.join(shard_dir, prefix + '_meta.npz'),
+                     allow_pickle=True) as npz:
+            metas.append({k: npz[k] for k in npz.files})
+    meta = {k: np.concatenate([m[k] for m in metas]) for k in metas[0]}
+    keep, links = find_duplicates(importer, meta)
+    meta = {k: v[keep] for k, v in meta.items()}
+    offsets = np.cumsum([0] + [len(m[importer.pkey_field]) for m in metas])
+    kept = [keep[lo:hi] for lo, hi in zip(offsets[:-1], offsets[1:])]
+    rows = len(meta[importer.pkey_field])
+
+    # Build the new spectra file beside the old one, then swap them.
+    new_prefix = f'{importer.output_prefix}_{stamp}_new'
+    new_path = os.path.join(output, new_prefix + suffix)
+    with h5py.File(new_path, 'w', libver='latest',
+                   **hdf5_options(new_path, importer.driver,
+                                  importer.member_size)) as fh:
+        fh.create_dataset('committed', data=rows)
+        create_index(fh, importer.pkey_field, meta[importer.pkey_field])
+        if importer.is_trajectory():
+            groups = ['spectra'] + [f'pyramid/{factor}'
+                                    for factor in importer.pyramid or []]
+            targets = {}
+            for prefix, shard_meta, mask in zip(prefixes, metas, kept):
+                target = os.path.join(SHARD_DIR, prefix + suffix)
+                for id in shard_meta[importer.pkey_field][mask]:
+                    id = id.decode() if isinstance(id, bytes) else str(id)
+                    # A duplicate links to the spectra it duplicates.
+                    source = links.get(id, id)
+                    targets.setdefault(source, target)
+                    for group in groups:
+                        fh[f'/{group}/{id}'] = h5py.ExternalLink(
+                            targets[source], f'/{group}/{source}')
+        else:
+            tail = os.path.join(SHARD_DIR,
+                                f'{importer.output_prefix}_{stamp}_tail'
+                                + suffix)
+            blocks = []
+            for prefix, mask in zip(prefixes, kept):
+                # Runs of rows that are kept
+                edges = np.flatnonzero(np.diff(np.r_[0, mask, 0]))
+                blocks += [(os.path.join(SHARD_DIR, prefix + suffix),
+                            int(first), int(last))
+                           for first, last in zip(edges[::2], edges[1::2])]
+            create_virtual_spectra(importer, fh, blocks, tail)
+    for path in glob.glob(os.path.join(output, importer.output_prefix +
+                                       suffix.replace('%03d', '[0-9]*'))):
+        os.remove(path)
+    for path in sorted(glob.glob(os.path.join(output, new_prefix + '.*'))):
+        os.replace(path, path.replace(new_prefix, importer.output_prefix))
+    if not os.path.exists(importer.paths['channels']):
+        first = os.path.join(shard_dir, importer.channels_file)
+        if os.path.exists(first):
+            shutil.copy2(first, importer.paths['channels'])
+    importer.save_metadata(meta)
+    # Their rows no longer match; `rebuild()` regenerates them.
+    if importer.preprocess:
+        pattern = glob.escape(preprocessed_path(importer))
+        for path in glob.glob(pattern.replace('%03d', '[0-9]*')):
+            os.remove(path)
+    if importer.resample and os.path.exists(resampled_path(importer)):
+        os.remove(resampled_path(importer))
+    if importer.aggregate and os.path.exists(aggregate_path(importer)):
+        os.remove(aggregate_path(importer))
+    if importer.catalog:
+        forget_dataset(importer)
+    for path in (importer.paths['journal'], importer.paths['journal_meta']):
+        if os.path.exists(path):
+            os.remove(path)
+
+    # Shards of earlier rebuilds are no longer referenced.
+    for path in glob.glob(os.path.join(shard_dir, '*')):
+        if os.path.isfile(path) and f'_{stamp}_' not in path and \
+                not path.endswith(importer.channels_file):
+            os.remove(path)
+    importer.save_masterfile_fingerprint()
+    state = load_state(importer.paths['state'])
+    if 'export' in state:
+        # The next export must start over, keeping the sequence going.
+        state['export'] = dict(state['export'], rows=0, meta_digest=None)
+    if importer.duplicates:
+        # Files each shard skipped as duplicates of its own files, and
+        # those found across shards
+        state['duplicates'] = {}
+        for prefix in prefixes:
+            shard = load_state(os.path.join(shard_dir, prefix + '_state.json'))
+            state['duplicates'].update(shard.get('duplicates', {}))
+        state['duplicates'].update(importer.skipped_duplicates)
+        importer.skipped_duplicates = {}
+    save_state(importer.paths['state'], state)
+    return rows
+
+
+def find_duplicates(importer, meta):
+    """
+    Find the files in the shards of a rebuild whose spectra are already
+    stored under an earlier ID, in this or an earlier shard, as a serial
+    build would (see `_BaseProcessor.match_content()`). Files that are
+    skipped are remembered in the importer’s `skipped_duplicates`.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    meta : dict
+        The shards’ metadata, concatenated in order.
+
+    Returns
+    -------
+        A boolean array of the rows to keep, and a dict of each ID to
+        link (with `duplicates: link`) to the ID whose spectra it has.
+    """
+    ids = meta[importer.pkey_field]
+    keep = np.ones(len(ids), dtype=bool)
+    links = {}
+    if not importer.duplicates or HASH_FIELD not in meta or not len(ids):
+        return keep, links
+    importer.content_hashes = {}
+    # Each ID’s rows are consecutive: one for trajectory output.
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    bounds = np.r_[starts, len(ids)]
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        id = ids[start]
+        id = id.decode() if isinstance(id, bytes) else str(id)
+        digest = str(meta[HASH_FIELD][start])
+        if importer.match_content((importer.input_id(id), id), id, digest):
+            keep[start:stop] = False
+        elif importer.content_hashes[digest] != id:
+            links[id] = importer.content_hashes[digest]
+    # Rebuilt from the new output when next needed
+    importer.content_hashes = None
+    return keep, links
+
+
+def create_virtual_spectra(importer, fh, blocks, tail):
+    """
+    Create a vector dataset’s `/spectra` as a virtual dataset over the
+    shards, followed by an empty, growable tail file where later batches
+    are appended (see `_VectorProcessor.write_data()`).
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    fh
+        The new output file.
+    blocks : list
+        Path of a shard file, relative to the output directory, and
+        first and last (exclusive) row, of each run of shard rows to
+        map, in order.
+    tail : string
+        Path of the tail file, relative to the output directory.
+    """
+    output = importer.paths['output']
+    shapes = {}
+    dtype = None
+    for source, first, last in blocks:
+        if source in shapes:
+            continue
+        source_path = os.path.join(output, source)
+        with h5py.File(source_path, 'r',
+                       **hdf5_options(source_path, importer.driver)) as shard:
+            shapes[source] = shard['spectra'].shape
+            dtype = shard['spectra'].dtype
+    channels = shapes[blocks[0][0]][1]
+    rows = sum(last - first for source, first, last in blocks)
+    tail_path = os.path.join(output, tail)
+    with h5py.File(tail_path, 'w', libver='latest',
+                   **hdf5_options(tail_path, importer.driver,
+                                  importer.member_size)) as tail_fh:
+        tail_fh.create_dataset('spectra', shape=(0, channels), dtype=dtype,
+                               chunks=True, maxshape=(None, channels))
+        tail_fh.attrs['spectra_tail_offset'] = rows
+
+    # h5py's VirtualLayout cannot express the unlimited tail mapping.
+    # In VDS source names, '%' must be escaped as '%%'.
+    dcpl = h5p.create(h5p.DATASET_CREATE)
+    dcpl.set_fill_value(np.array(np.nan, dtype=dtype))
+    vspace = h5s.create_simple((rows, channels), (h5s.UNLIMITED, channels))
+    offset = 0
+    for source, first, last in blocks:
+        vspace.select_hyperslab((offset, 0), (last - first, channels))
+        src_space = h5s.create_simple(shapes[source])
+        src_space.select_hyperslab((first, 0), (last - first, channels))
+        dcpl.set_virtual(vspace, source.replace('%', '%%').encode(),
+                         b'spectra', src_space)
+        offset += last - first
+    vspace.select_hyperslab((rows, 0), (h5s.UNLIMITED, 1),
+                            block=(1, channels))
+    src_space = h5s.create_simple((0, channels), (h5s.UNLIMITED, channels))
+    src_space.select_hyperslab((0, 0), (h5s.UNLIMITED, 1),
+                               block=(1, channels))
+    dcpl.set_virtual(vspace, tail.replace('%', '%%').encode(), b'spectra',
+                     src_space)
+    h5d.create(fh.id, b'spectra', h5t.py_create(dtype), vspace, dcpl=dcpl)
+    fh.attrs['spectra_tail'] = tail
+    fh.attrs['spectra_tail_offset'] = rows
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import h5py
+import json
+import numpy as np
+import os
+from .index import INDEX_GROUP, create_index, update_index
+from .preprocess import append, link_metadata
+from .pyramid import PYRAMID_GROUP, update_pyramid
+from .similarity import SIMILARITY_GROUP, update_similarity
+from .state import hdf5_options
+
+DEFAULTS = {
+    'start': None,
+    'stop': None,
+    'points': 1024,
+    'fill': None,
+    'output_prefix': 'resampled',
+}
+BLOCK_BYTES = 64 * 2**20
+
+
+def resample_config(config):
+    """
+    Checks a dataset’s `resample` configuration.
+
+    Parameters
+    ----------
+    config : dict
+        The configured options.
+
+    Returns
+    -------
+        The options with defaults filled in.
+
+    Raises
+    ------
+    ValueError
+        If an option is missing or invalid.
+    """
+    config = {**DEFAULTS, **(config or {})}
+    if config['start'] is None or config['stop'] is None:
+        raise ValueError('resample needs the start and stop of the axis')
+    if not config['start'] < config['stop']:
+        raise ValueError('The resampled axis must start before it stops')
+    if int(config['points']) < 2:
+        raise ValueError('The resampled axis needs at least 2 points')
+    return config
+
+
+def resample_axis(config):
+    """
+    Returns
+    -------
+        The shared axis of the resampled output, as an array.
+    """
+    return np.linspace(config['start'], config['stop'], int(config['points']))
+
+
+def interpolate(spectra, axis, fill=None):
+    """
+    Linearly interpolates a batch of trajectories onto a shared axis,
+    into one matrix for the whole batch. Each spectrum is a single
+    `np.interp` call over the whole axis, which walks both in order; a
+    fully vectorized version with one `np.searchsorted` over the
+    packed batch was several times slower, because of the temporaries
+    it needs for every (spectrum, axis value) pair.
+
+    Parameters
+    ----------
+    spectra : list
+        Arrays of shape (points, 2) of x and y, in any order of x.
+        Points with a NaN are ignored.
+    axis : array
+        The shared x values, in increasing order.
+    fill : float
+        Value outside each spectrum’s range of x; None for NaN.
+
+    Returns
+    -------
+        A 2-D array of one resampled spectrum per row.
+    """
+    fill = np.nan if fill is None else fill
+    result = np.full((len(spectra), len(axis)), fill, dtype=float)
+    for row, spectrum in zip(result, spectra):
+        spectrum = np.asarray(spectrum, dtype=float)[:, :2]
+        spectrum = spectrum[np.isfinite(spectrum).all(axis=1)]
+        if not len(spectrum):
+            continue
+        x, y = spectrum[:, 0], spectrum[:, 1]
+        if np.any(x[1:] < x[:-1]):
+            order = np.argsort(x, kind='stable')
+            x, y = x[order], y[order]
+        row[:] = np.interp(axis, x, y, left=fill, right=fill)
+    return result
+
+
+def resampled_path(importer):
+    """
+    Returns
+    -------
+        The resampled spectra output filename of a dataset.
+    """
+    return os.path.join(importer.paths['output'],
+                        importer.resample['output_prefix'] + '.hdf5')
+
+
+def update_resampled(importer, spectra=None, start=None, meta=None):
+    """
+    Brings a trajectory dataset’s resampled output up to date with its
+    main output. It mirrors the main output row for row under its own
+    prefix, but is stored like vector output: a `/spectra` matrix with
+    one row per spectrum on the shared axis, which is saved as its
+    channels file.
+
+    The rows committed to the main output since the last update are
+    resampled and appended. Usually these are the batch just
+    committed, whose spectra are passed in; otherwise, as after an
+    interruption, a rebuild or a change of options, the missing
+    spectra are read back from the main output. The similarity index,
+    if configured, is kept here rather than in the main output. The
+    metadata file is shared through a hard link.
+
+    Parameters
+    ----------
+    importer
+        Processor for the dataset.
+    spectra : list
+        The spectra of the batch just committed, if any.
+    start : int
+        Output row of the batch’s first row.
+    meta : dict
+        The main output’s metadata, if already loaded, as after
+        `commit_batch()` writes it.
+
+    Returns
+    -------
+        The number of rows resampled.
+    """
+    if meta is None:
+        meta = importer.read_metadata()
+    if meta is None:
+        return 0
+    config = importer.resample
+    axis = resample_axis(config)
+    ids = meta[importer.pkey_field]
+    rows = len(ids)
+    settings = json.dumps(config, sort_keys=True)
+    path = resampled_path(importer)
+    with h5py.File(path, 'a', libver='latest',
+                   **hdf5_options(path, None)) as fh:
+        done = int(fh['committed'][()]) if 'committed' in fh else 0
+        if done and (done > rows or fh.attrs.get('resample') != settings):
+            importer.logger.info(f'Resampling all of {importer.name} again')
+            done = 0
+        if done < rows:
+            if done == 0:
+                for name in ('spectra', INDEX_GROUP, PYRAMID_GROUP,
+                             SIMILARITY_GROUP):
+                    if name in fh:
+                        del fh[name]
+            if 'spectra' not in fh:
+                fh.create_dataset('spectra', shape=(0, len(axis)),
+                                  dtype=float, chunks=True,
+                                  maxshape=(None, len(axis)))
+            dset = fh['spectra']
+            dset.resize(done, axis=0)
+            if spectra is not None and start == done and \
+                    start + len(spectra) == rows:
+                append(dset, interpolate(spectra, axis, config['fill']))
+            else:
+                source = importer.open_output(importer.output_path())
+                try:
+                    step = max(1, BLOCK_BYTES // (len(axis) * 8))
+                    for first in range(done, rows, step):
+                        batch = [source[f'/spectra/{id}'][()]
+                                 for id in ids[first:first + step]]
+                        append(dset, interpolate(batch, axis, config['fill']))
+                finally:
+                    importer.close_output(source)
+            if INDEX_GROUP not in fh:
+                create_index(fh, importer.pkey_field, ids[:done])
+            update_index(fh, ids[done:], done)
+            fh.attrs['resample'] = settings
+            if 'committed' in fh:
+                fh['committed'][()] = rows
+            else:
+                fh.create_dataset('committed', data=rows)
+            importer.logger.debug(f'Resampled rows {done} to {rows}')
+        if importer.pyramid and 'spectra' in fh:
+            update_pyramid(fh, importer.pyramid, rows)
+        if importer.similarity and 'spectra' in fh:
+            update_similarity(fh, importer.similarity, rows)
+    channels = os.path.join(importer.paths['output'],
+                            config['output_prefix'] + '_channels.npy')
+    if not os.path.exists(channels) or \
+            not np.array_equal(np.load(channels), axis):
+        np.save(channels, axis)
+    link_metadata(importer, config['output_prefix'])
+    return rows - done
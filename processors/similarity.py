@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import json
+import numpy as np
+
+SIMILARITY_GROUP = 'similarity'
+DEFAULTS = {
+    'dims': 64,
+    'seed': 0,
+}
+BLOCK_BYTES = 64 * 2**20
+
+
+def similarity_config(config):
+    """
+    Checks a dataset’s `similarity` configuration.
+
+    Parameters
+    ----------
+    config
+        The configured options, or True for the defaults.
+
+    Returns
+    -------
+        The options with defaults filled in.
+
+    Raises
+    ------
+    ValueError
+        If an option is invalid.
+    """
+    config = {**DEFAULTS, **(config if isinstance(config, dict) else {})}
+    if int(config['dims']) < 1:
+        raise ValueError('The similarity index needs at least 1 dimension')
+    return config
+
+
+def unit_rows(spectra):
+    """
+    Scales each spectrum to unit Euclidean norm, so that dot products
+    are cosine similarities. NaNs count as 0.
+
+    Parameters
+    ----------
+    spectra : array
+        2-D array of one spectrum per row.
+
+    Returns
+    -------
+        A new float32 array with the same shape.
+    """
+    data = np.nan_to_num(np.array(spectra, dtype=np.float32), nan=0,
+                         posinf=0, neginf=0)
+    norms = np.linalg.norm(data, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    data /= norms
+    return data
+
+
+def projection(channels, config):
+    """
+    Draws the random projection of a dataset’s similarity index. Its
+    columns are independent Gaussian vectors, so distances between
+    projected spectra approximate those between the spectra
+    (Johnson–Lindenstrauss). Between spectra of unit norm, distance
+    ranks the same as cosine similarity.
+
+    Parameters
+    ----------
+    channels : int
+        Values per spectrum.
+    config : dict
+        Options, as from `similarity_config()`.
+
+    Returns
+    -------
+        A float32 array of shape (channels, dims).
+    """
+    dims = int(config['dims'])
+    rng = np.random.default_rng(config['seed'])
+    matrix = rng.standard_normal((channels, dims)) / np.sqrt(dims)
+    return matrix.astype(np.float32)
+
+
+def create_similarity(fh, config, channels):
+    """
+    Creates the empty similarity index of a vector output file, or
+    replaces one made with other options: `/similarity/projection` and
+    a growable `/similarity/vectors` of one projected spectrum per row.
+
+    Parameters
+    ----------
+    fh
+        The open output file, not yet in SWMR mode.
+    config : dict
+        Options, as from `similarity_config()`.
+    channels : int
+        Values per spectrum.
+    """
+    settings = json.dumps(config, sort_keys=True)
+    group = fh.get(SIMILARITY_GROUP)
+    if group is not None:
+        if group.attrs.get('settings') == settings:
+            return
+        del fh[SIMILARITY_GROUP]
+    dims = int(config['dims'])
+    group = fh.create_group(SIMILARITY_GROUP)
+    group.attrs['settings'] = settings
+    group.create_dataset('projection', data=projection(channels, config))
+    group.create_dataset('vectors', shape=(0, dims), dtype=np.float32,
+                         chunks=True, maxshape=(None, dims))
+
+
+def update_similarity(fh, config, start, spectra=None):
+    """
+    Brings the similarity index of a vector output file up to row
+    `start`, then appends the projections of new rows. Rows at or past
+    `start` left over from an interrupted batch are dropped; missing
+    rows, as in output written before the index was configured or
+    stitched by a rebuild, are read back from `/spectra` in large
+    blocks.
+
+    Parameters
+    ----------
+    fh
+        The open output file.
+    config : dict
+        Options, as from `similarity_config()`.
+    start : int
+        Output row of the first new row.
+    spectra : array
+        2-D array of new rows, or None.
+    """
+    source = fh['spectra']
+    create_similarity(fh, config, source.shape[1])
+    group = fh[SIMILARITY_GROUP]
+    matrix = group['projection'][()]
+    vectors = group['vectors']
+    step = max(1, BLOCK_BYTES // (source.shape[1] * source.dtype.itemsize))
+    for first in range(min(vectors.shape[0], start), start, step):
+        last = min(first + step, start)
+        write_vectors(vectors, first, source[first:last], matrix)
+    if spectra is None:
+        spectra = source[start:start]
+    write_vectors(vectors, start, spectra, matrix)
+
+
+def write_vectors(vectors, first, spectra, matrix):
+    """
+    Writes the projections of rows starting at row `first`, truncating
+    the index there first.
+    """
+    data = unit_rows(spectra) @ matrix
+    vectors.resize(first + len(data), axis=0)
+    vectors[first:] = data
+
+
+def copy_similarity(src, dst, rows):
+    """
+    Copies the similarity index of committed rows to a new output file.
+
+    Parameters
+    ----------
+    src, dst
+        The original and new output files.
+    rows : int
+        Number of committed rows.
+    """
+    if SIMILARITY_GROUP not in src:
+        return
+    group = src[SIMILARITY_GROUP]
+    target = dst.create_group(SIMILARITY_GROUP)
+    target.attrs['settings'] = group.attrs['settings']
+    target.create_dataset('projection', data=group['projection'][()])
+    vectors = group['vectors']
+    data = vectors[:min(rows, vectors.shape[0])]
+    target.create_dataset('vectors', data=data, chunks=True,
+                          maxshape=(None, vectors.shape[1]))
+
+
+def nearest_rows(vectors, matrix, spectrum, count):
+    """
+    Finds the rows most similar to a spectrum by their projections.
+    They are ranked by distance rather than dot product, since the
+    projection preserves distances between close spectra much better
+    than it preserves their norms.
+
+    Parameters
+    ----------
+    vectors : array
+        Projected rows, from `/similarity/vectors`.
+    matrix : array
+        The projection, from `/similarity/projection`.
+    spectrum : array
+        The spectrum to match, on the same channels.
+    count : int
+        Number of rows to return.
+
+    Returns
+    -------
+        An array of up to `count` row numbers, in no particular order.
+    """
+    count = min(count, len(vectors))
+    if count == 0:
+        return np.zeros(0, dtype=int)
+    query = (unit_rows(np.asarray(spectrum)[None]) @ matrix)[0]
+    # Squared distances, less the query’s own squared norm
+    distances = np.einsum('ij,ij->i', vectors, vectors) - 2 * (vectors @ query)
+    return np.argpartition(distances, count - 1)[:count]
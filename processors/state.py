@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+
+# Shared with _BaseProcessor so paths can be resolved without it.
+PATH_DEFAULTS = {
+    'output_dir': 'to-DEVAS',
+    'output_prefix': 'prepro_no_blr',
+}
+
+
+def file_fingerprint(filepath):
+    """
+    Identifies the current version of a file without reading it.
+
+    Parameters
+    ----------
+    filepath
+        The full path of a file.
+
+    Returns
+    -------
+        A list [size, mtime in nanoseconds], or None if the file
+        does not exist.
+    """
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def hdf5_options(filepath, driver, member_size=None):
+    """
+    Chooses the driver options for opening an HDF5 output file.
+
+    An existing family is opened with the member size recorded in it,
+    since HDF5 refuses any other size. A new family gets `member_size`,
+    or h5py’s default.
+
+    Parameters
+    ----------
+    filepath
+        The file’s full path (pattern, for the family driver).
+    driver
+        'family' or None.
+    member_size : int
+        Size of new family members in MiB.
+
+    Returns
+    -------
+        A dict of keyword arguments for `h5py.File`.
+    """
+    options = {'driver': driver}
+    if driver == 'family':
+        if os.path.exists(filepath.replace('%03d', '000')):
+            options['memb_size'] = 0
+        elif member_size:
+            options['memb_size'] = int(member_size * 2**20)
+    return options
+
+
+def load_state(filepath):
+    """
+    Reads a JSON state file.
+
+    Parameters
+    ----------
+    filepath
+        The full path of the state file.
+
+    Returns
+    -------
+        A dict of saved state, empty if the file does not exist.
+    """
+    if not os.path.isfile(filepath):
+        return {}
+    with open(filepath) as f:
+        return json.load(f)
+
+
+def save_state(filepath, state):
+    """
+    Writes a JSON state file, replacing the previous one atomically.
+
+    Parameters
+    ----------
+    filepath
+        The full path of the state file.
+    state
+        A JSON-serializable dict.
+    """
+    tmp_path = f'{filepath}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, filepath)
+
+
+def resolve_paths(config):
+    """
+    Resolves the input and output paths of a dataset from its
+    configuration, without creating anything.
+
+    Parameters
+    ----------
+    config : dict
+        Dataset configuration, as passed to a processor.
+
+    Returns
+    -------
+        A dict with the base directory, list of masterfiles, list of
+        data directories, output directory, metadata output file, and
+        state file.
+    """
+    base = os.path.join(config.get('root_dir', ''), config.get('base_dir', ''))
+    meta = config['meta_file']
+    if isinstance(meta, str):
+        meta = [meta]
+    data = config.get('data_dir', '')
+    if isinstance(data, str):
+        data = [data]
+    output = config.get('output_dir', PATH_DEFAULTS['output_dir'])
+    output = os.path.join(base, output)
+    prefix = config.get('output_prefix', PATH_DEFAULTS['output_prefix'])
+    return {
+        'base': base,
+        'metadata': [os.path.join(base, f) for f in meta],
+        'data': [os.path.join(base, d) for d in data],
+        'output': output,
+        'meta_output': os.path.join(output, prefix + '_meta.npz'),
+        'state': os.path.join(output, prefix + '_state.json'),
+    }
+
+
+def input_fingerprint(config):
+    """
+    Summarizes everything a dataset’s processing depends on: its
+    configuration, its masterfiles, and the modification times of its
+    data directories. Files are not stat’ed individually; adding,
+    removing or renaming a file changes its directory’s mtime.
+
+    Parameters
+    ----------
+    config : dict
+        Dataset configuration, as passed to a processor.
+
+    Returns
+    -------
+        A hex digest string.
+    """
+    paths = resolve_paths(config)
+    digest = hashlib.sha1()
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    for path in paths['metadata']:
+        digest.update(f'{path}\0{file_fingerprint(path)}\0'.encode())
+    for data_dir in paths['data']:
+        for root, _, _ in os.walk(data_dir):
+            mtime = os.stat(root).st_mtime_ns
+            digest.update(f'{root}\0{mtime}\0'.encode())
+    return digest.hexdigest()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import signal
+import struct
+from .state import file_fingerprint
+from time import monotonic, sleep
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(object):
+    """
+    Reports files written or moved into a set of directory trees,
+    using Linux inotify through libc.
+    """
+
+    def __init__(self, dirs):
+        """
+        Parameters
+        ----------
+        dirs : list
+            Directories to watch, including all subdirectories.
+        """
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'inotify_init1: {os.strerror(errno)}')
+        self.watches = {}
+        self.needs_rescan = False
+        try:
+            for top in dirs:
+                self.add_tree(top)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top):
+        """
+        Watch a directory and everything below it.
+
+        Parameters
+        ----------
+        top
+            The directory to add.
+
+        Returns
+        -------
+            Files already in the tree, which may have been written
+            before the watches were in place.
+        """
+        files = []
+        for root, _, filenames in os.walk(top):
+            self.add_watch(root)
+            files.extend(os.path.join(root, f) for f in filenames)
+        return files
+
+    def add_watch(self, path):
+        """
+        Watch one directory.
+
+        Parameters
+        ----------
+        path
+            The directory to add.
+        """
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'inotify_add_watch {path}: '
+                                 f'{os.strerror(errno)}')
+        self.watches[wd] = path
+
+    def close(self):
+        """
+        Release the inotify instance.
+        """
+        os.close(self.fd)
+
+    def poll(self, timeout):
+        """
+        Wait for events.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum number of seconds to wait.
+
+        Returns
+        -------
+            A list of paths of files that were created or written.
+            If events were lost, `needs_rescan` is set.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        paths = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(buf, offset)
+                offset += EVENT_HEADER.size
+                name = buf[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    self.needs_rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches or not name:
+                    continue
+                path = os.path.join(self.watches[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        paths.extend(self.add_tree(path))
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+                    paths.append(path)
+        return paths
+
+
+class PollingWatcher(object):
+    """
+    Reports new or changed files in a set of directory trees by
+    rescanning them, for systems without inotify.
+    """
+
+    def __init__(self, dirs, interval=60):
+        """
+        Parameters
+        ----------
+        dirs : list
+            Directories to watch, including all subdirectories.
+        interval : float
+            Minimum number of seconds between scans.
+        """
+        self.dirs = dirs
+        self.interval = interval
+        self.needs_rescan = False
+        self.last_scan = monotonic()
+        self.files = self.scan()
+
+    def close(self):
+        pass
+
+    def poll(self, timeout):
+        """
+        Rescan the trees if `interval` has passed, otherwise wait.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum number of seconds to wait.
+
+        Returns
+        -------
+            A list of paths of files that are new or have changed
+            since the previous scan.
+        """
+        wait = self.last_scan + self.interval - monotonic()
+        if wait > 0:
+            sleep(min(wait, timeout))
+            if wait > timeout:
+                return []
+        self.last_scan = monotonic()
+        files = self.scan()
+        paths = [path for path, fingerprint in files.items()
+                 if self.files.get(path) != fingerprint]
+        self.files = files
+        return paths
+
+    def scan(self):
+        """
+        Returns
+        -------
+            A dict of every file path in the trees to its fingerprint.
+        """
+        files = {}
+        for top in self.dirs:
+            for root, _, filenames in os.walk(top):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    files[path] = file_fingerprint(path)
+        return files
+
+
+class Debouncer(object):
+    """
+    Holds back reported files until they have stopped changing, so
+    partially written files are not processed.
+    """
+
+    def __init__(self, settle):
+        """
+        Parameters
+        ----------
+        settle : float
+            Number of seconds a file’s size and mtime must be stable.
+        """
+        self.settle = settle
+        self.pending = {}
+
+    def add(self, paths):
+        """
+        Start or restart the wait for files that were reported.
+
+        Parameters
+        ----------
+        paths : list
+            Paths from a watcher.
+        """
+        now = monotonic()
+        for path in paths:
+            self.pending[path] = (file_fingerprint(path), now)
+
+    def ready(self):
+        """
+        Returns
+        -------
+            A list of pending paths that have been stable for `settle`
+            seconds. They are no longer pending.
+        """
+        now = monotonic()
+        ready = []
+        for path, (fingerprint, since) in list(self.pending.items()):
+            current = file_fingerprint(path)
+            if current is None:
+                del self.pending[path]
+            elif current != fingerprint:
+                self.pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self.pending[path]
+                ready.append(path)
+        return ready
+
+
+def make_watcher(dirs, polling=False, interval=60):
+    """
+    Create an inotify watcher, or a polling one if inotify is not
+    available or `polling` is set.
+
+    Parameters
+    ----------
+    dirs : list
+        Directories to watch.
+    polling : bool
+        Whether to skip inotify.
+    interval : float
+        Seconds between scans for a polling watcher.
+
+    Returns
+    -------
+        An InotifyWatcher or PollingWatcher.
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(dirs)
+        except (AttributeError, OSError) as e:
+            logging.warning(f'Cannot use inotify ({e}); polling instead')
+    return PollingWatcher(dirs, interval)
+
+
+def watch(importers, settle=10, polling=False, interval=60, tick=1):
+    """
+    Run until SIGINT or SIGTERM, feeding new files in the importers’
+    data directories to `ingest()` as soon as they are complete.
+
+    Each importer first catches up with a normal `main()` run. The
+    importers keep their output open and their masterfile parsed
+    between events; when a masterfile changes, that importer runs
+    `main()` again so files that could not be matched before are
+    retried.
+
+    Parameters
+    ----------
+    importers : list
+        Processor instances, usually created with `keep_open`.
+    settle : float
+        Seconds a file must be unchanged before it is processed.
+    polling : bool
+        Whether to poll instead of using inotify.
+    interval : float
+        Seconds between scans when polling.
+    tick : float
+        Seconds between checks for complete files and masterfile
+        changes.
+    """
+    stopping = []
+
+    def stop(signum, frame):
+        logging.info(f'Received signal {signum}, stopping')
+        stopping.append(signum)
+
+    previous = {sig: signal.signal(sig, stop)
+                for sig in (signal.SIGINT, signal.SIGTERM)}
+    dirs = [d for importer in importers for d in importer.paths['data']]
+    watcher = make_watcher(dirs, polling, interval)
+    debouncer = Debouncer(settle)
+    try:
+        for importer in importers:
+            importer.main()
+        logging.info(f'Watching {len(dirs)} data directories')
+        while not stopping:
+            debouncer.add(watcher.poll(tick))
+            for importer in importers:
+                if watcher.needs_rescan or importer.masterfile_changed():
+                    importer.main()
+            watcher.needs_rescan = False
+            ready = debouncer.ready()
+            if not ready:
+                continue
+            for importer in importers:
+                count = importer.ingest(ready)
+                if count:
+                    logging.info(f'Ingested {count} new files '
+                                 f'for {importer.name}')
+    finally:
+        watcher.close()
+        for importer in importers:
+            importer.close()
+        for sig, handler in previous.items():
+            signal.signal(sig, handler)
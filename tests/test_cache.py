@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.cache import SpectrumCache  # noqa: E402
+
+
+class TestSpectrumCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.files = []
+        for name in ('a.csv', 'b.csv'):
+            path = os.path.join(self.tmp.name, name)
+            with open(path, 'w') as f:
+                f.write(name)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cache(self, channels, namespace='LIBSProcessor'):
+        return SpectrumCache(self.cache_dir, namespace,
+                             {'channels': channels})
+
+    def test_parameters_are_part_of_the_key(self):
+        cache = self.cache(4)
+        cache.put(self.files[0], (np.zeros((2, 4)), 'header'))
+        spectra, header = cache.get(self.files[0])
+        self.assertEqual(spectra.shape, (2, 4))
+        self.assertEqual(header, 'header')
+        self.assertIsNone(self.cache(8).get(self.files[0]))
+
+    def test_prune_removes_stale_entries(self):
+        old = self.cache(4)
+        for path in self.files:
+            old.put(path, np.zeros((2, 4)))
+        other = self.cache(4, namespace='MSLProcessor')
+        other.put(self.files[1], np.zeros((2, 4)))
+        cache = self.cache(8)
+        cache.put(self.files[0], np.zeros((2, 8)))
+        os.remove(self.files[1])
+        # Both entries of the old channel count are stale, one for
+        # a removed file; the other processor's are left alone.
+        self.assertEqual(cache.prune(), 2)
+        self.assertEqual(cache.get(self.files[0]).shape, (2, 8))
+        self.assertIsNone(old.get(self.files[0]))
+        with open(self.files[1], 'w') as f:
+            f.write('b.csv')
+        os.utime(self.files[1], ns=(0, 0))
+        self.assertEqual(other.prune(), 1)
+        self.assertEqual(cache.prune(), 0)
+        entries = [name for _, _, names in os.walk(self.cache_dir)
+                   for name in names]
+        self.assertEqual(len(entries), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
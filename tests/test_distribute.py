@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import glob
+import logging
+import multiprocessing
+import numpy as np
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processors.distribute as distribute  # noqa: E402
+from processors.masterfiles import MasterfileRegistry  # noqa: E402
+from processors.msl import MSLProcessor  # noqa: E402
+from processors.state import load_state  # noqa: E402
+
+FILES = 8
+LEASE = 1
+POLL = 0.1
+
+
+def make_msl_dataset(root):
+    """
+    Writes an MSL dataset of `FILES` files, two per directory.
+    """
+    clocks = [398380640 + i for i in range(FILES)]
+    with open(os.path.join(root, 'master.csv'), 'w') as f:
+        f.write('edr_type,spacecraft_clock,nbr_of_shots,autofocus,'
+                'distance_m,laser_energy,sol,temperature,target\n')
+        for i, clock in enumerate(clocks):
+            f.write(f'cl5,{clock},4,Yes,2.5,14,{10 + i // 2},-5.5,Rock{i}\n')
+    rng = np.random.default_rng(0)
+    for i, clock in enumerate(clocks):
+        sol = os.path.join(root, 'data', f'sol{10 + i // 2:05d}')
+        os.makedirs(sol, exist_ok=True)
+        data = rng.random((64, 7))
+        data[:, 0] = np.linspace(240, 700, 64)
+        name = f'cl5_{clock}ccs_f0050104ccam01013p3.csv'
+        np.savetxt(os.path.join(sol, name), data, delimiter=',',
+                   fmt='%.4f')
+
+
+def dataset_config(root):
+    return {'name': 'Test MSL', 'root_dir': root, 'meta_file': 'master.csv',
+            'data_dir': 'data', 'channels': 64, 'duplicates': 'skip',
+            'batch_size': 2}
+
+
+def run_worker(config, idle):
+    """
+    Worker process entry point, as `process_all.py --work`.
+    """
+    logging.basicConfig()
+    distribute.work([(MSLProcessor(**config), config)], lease=LEASE,
+                    poll=POLL, idle=idle)
+
+
+def run_stalling_worker(config, flag, go):
+    """
+    Worker process entry point that writes `flag` once it is processing
+    its first unit, and only goes on once `go` exists.
+    """
+    build_shard = distribute.build_shard
+
+    def stalling_build_shard(class_name, config, output_prefix, files):
+        with open(flag, 'w') as f:
+            f.write(output_prefix)
+        while not os.path.exists(go):
+            time.sleep(POLL)
+        return build_shard(class_name, config, output_prefix, files)
+
+    distribute.build_shard = stalling_build_shard
+    run_worker(config, idle=1)
+
+
+def wait_for(path, timeout=30):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise TimeoutError(f'{path} did not appear')
+        time.sleep(POLL)
+
+
+class TestDistribute(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.tmp = tempfile.TemporaryDirectory()
+        # Fresh interpreters, as on other hosts
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.kill()
+            process.join()
+        self.tmp.cleanup()
+
+    def start(self, target, *args):
+        process = self.context.Process(target=target, args=args)
+        process.start()
+        self.processes.append(process)
+        return process
+
+    def dataset(self, name):
+        root = os.path.join(self.tmp.name, name)
+        os.makedirs(root)
+        make_msl_dataset(root)
+        return dataset_config(root)
+
+    def serial_ids(self):
+        config = self.dataset('serial')
+        importer = MSLProcessor(**config)
+        importer.main()
+        importer.close()
+        return importer.read_metadata()[importer.pkey_field]
+
+    def test_killed_worker_is_taken_over(self):
+        expected = self.serial_ids()
+        config = self.dataset('distributed')
+        flag = os.path.join(self.tmp.name, 'stalled')
+        stalled = self.start(run_stalling_worker, config, flag,
+                             os.path.join(self.tmp.name, 'never'))
+
+        def kill_and_replace():
+            wait_for(flag)
+            os.kill(stalled.pid, signal.SIGKILL)
+            for _ in range(2):
+                self.start(run_worker, config, 2)
+
+        thread = threading.Thread(target=kill_and_replace, daemon=True)
+        thread.start()
+        importer = MSLProcessor(**config)
+        rows = distribute.coordinate(importer, config, unit_size=2,
+                                     lease=LEASE, poll=POLL)
+        thread.join()
+        # The killed worker had the first unit; its lease expired, and
+        # it was finished by another worker, once.
+        with open(flag) as f:
+            self.assertIn('unit_00000', f.read())
+        ids = importer.read_metadata()[importer.pkey_field]
+        self.assertEqual(rows, len(expected))
+        np.testing.assert_array_equal(ids, expected)
+        self.assertEqual(importer.get_skipped_ids(), [])
+        for process in self.processes[1:]:
+            process.join(30)
+            self.assertEqual(process.exitcode, 0)
+
+    def test_late_worker_discards_its_shard(self):
+        config = self.dataset('late')
+        importer = MSLProcessor(**config)
+        queue = distribute.WorkQueue(distribute.queue_dir(importer), LEASE)
+        files = [(dirname, file) for dirname, val in
+                 importer.get_input_data().items() for file in val]
+        queue.create([files[:2]])
+        flag = os.path.join(self.tmp.name, 'stalled')
+        go = os.path.join(self.tmp.name, 'go')
+        late = self.start(run_stalling_worker, config, flag, go)
+        wait_for(flag)
+        with open(flag) as f:
+            late_prefix = f.read()
+        # Stopped, it cannot renew its lease either.
+        os.kill(late.pid, signal.SIGSTOP)
+        time.sleep(LEASE * 1.5)
+        claimed = queue.claim()
+        self.assertIsNotNone(claimed)
+        unit, token = claimed
+        self.assertEqual(unit, 'unit_00000')
+        distribute.process_unit(importer, config, queue, unit, token,
+                                MasterfileRegistry())
+        os.kill(late.pid, signal.SIGCONT)
+        with open(go, 'w'):
+            pass
+        late.join(30)
+        self.assertEqual(late.exitcode, 0)
+        with open(importer.paths['log']) as f:
+            log = f.read()
+        self.assertIn(f'Lost the lease on {unit}', log)
+        self.assertIn(f'discarding {late_prefix}', log)
+        result = queue.result(unit)
+        self.assertEqual(result['status'], 'done')
+        self.assertEqual(result['token'], token)
+        self.assertTrue(os.path.exists(os.path.join(
+            queue.directory, result['prefix'] + '_meta.npz')))
+        # The late worker's shard was removed once it found the unit done.
+        leftover = glob.glob(os.path.join(glob.escape(queue.directory),
+                                          glob.escape(late_prefix) + '*'))
+        self.assertEqual(leftover, [])
+        self.assertEqual(load_state(queue.path(unit, 'lease')), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import email.utils
+import http.server
+import logging
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.mirror import Mirror  # noqa: E402
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves a directory with ETags, Last-Modified and byte ranges, like
+    the PDS server. Files named in `truncate` are cut short after that
+    many bytes, as by a dropped connection.
+    """
+    truncate = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or not os.path.exists(path):
+            return super().send_head()
+        Handler.requests.append((self.path, dict(self.headers)))
+        stat = os.stat(path)
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        f = open(path, 'rb')
+        start = 0
+        byte_range = self.headers.get('Range')
+        if byte_range and self.headers.get('If-Range') in (None, etag):
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            if start >= stat.st_size:
+                f.close()
+                self.send_response(416)
+                self.end_headers()
+                return None
+            f.seek(start)
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{stat.st_size - 1}/'
+                             f'{stat.st_size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(stat.st_size - start))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         email.utils.formatdate(stat.st_mtime, usegmt=True))
+        self.end_headers()
+        limit = self.truncate.get(self.path)
+        if limit is not None:
+            self.wfile.write(f.read(limit))
+            f.close()
+            self.close_connection = True
+            return None
+        return f
+
+
+class TestMirror(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.remote = os.path.join(self.tmp.name, 'remote')
+        self.local = os.path.join(self.tmp.name, 'local')
+        self.state = os.path.join(self.tmp.name, 'state')
+        self.contents = {}
+        for i, name in enumerate(('sol1/a.csv', 'sol1/b.csv', 'sol2/c.csv')):
+            path = os.path.join(self.remote, 'data', name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.contents[name] = os.urandom(100000 * (i + 1))
+            with open(path, 'wb') as f:
+                f.write(self.contents[name])
+        Handler.truncate = {}
+        Handler.requests = []
+
+        def handler(*args, **kwargs):
+            return Handler(*args, directory=self.remote, **kwargs)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        port = self.server.server_address[1]
+        self.mirror = Mirror(f'http://127.0.0.1:{port}/', workers=2,
+                             retries=0, state_dir=self.state)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def assertMirrored(self):
+        for name, data in self.contents.items():
+            with open(os.path.join(self.local, name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_unchanged_files_are_not_downloaded(self):
+        counts = self.mirror.mirror('data', self.local)
+        self.assertEqual(counts['new'], 3)
+        self.assertMirrored()
+        Handler.requests = []
+        counts = self.mirror.mirror('data', self.local)
+        self.assertEqual(counts['unchanged'], 3)
+        self.assertEqual(len(Handler.requests), 3)
+        for path, headers in Handler.requests:
+            self.assertIn('If-None-Match', headers)
+        # The manifest and partial files stay out of the mirrored tree.
+        self.assertEqual(sorted(os.listdir(self.local)), ['sol1', 'sol2'])
+
+    def test_truncated_download_resumes(self):
+        Handler.truncate = {'/data/sol2/c.csv': 120000}
+        counts = self.mirror.mirror('data', self.local)
+        self.assertEqual(counts, {'new': 2, 'updated': 0, 'unchanged': 0,
+                                  'failed': 1})
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'sol2',
+                                                     'c.csv')))
+        part = self.mirror.part_path(os.path.join(self.local, 'sol2',
+                                                  'c.csv'))
+        self.assertEqual(os.path.getsize(part), 120000)
+        Handler.truncate = {}
+        Handler.requests = []
+        counts = self.mirror.mirror('data', self.local)
+        self.assertEqual(counts['new'], 1)
+        self.assertEqual(counts['unchanged'], 2)
+        self.assertMirrored()
+        self.assertFalse(os.path.exists(part))
+        resumed = dict(Handler.requests)['/data/sol2/c.csv']
+        self.assertEqual(resumed['Range'], 'bytes=120000-')
+
+    def test_stale_partial_file_is_discarded(self):
+        local_path = os.path.join(self.local, 'sol1', 'a.csv')
+        part = self.mirror.part_path(local_path)
+        os.makedirs(os.path.dirname(part))
+        with open(part, 'wb') as f:
+            f.write(self.contents['sol1/a.csv'] + b'extra')
+        stat = os.stat(os.path.join(self.remote, 'data', 'sol1', 'a.csv'))
+        entry = {'partial_etag': f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'}
+        # The server answers the resume with 416: Range Not Satisfiable.
+        status, entry = self.mirror.fetch('data/sol1/a.csv', local_path,
+                                          entry)
+        self.assertEqual(status, 'failed')
+        self.assertFalse(os.path.exists(part))
+        status, entry = self.mirror.fetch('data/sol1/a.csv', local_path)
+        self.assertEqual(status, 'new')
+        with open(local_path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents['sol1/a.csv'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.msl import MSLProcessor  # noqa: E402
+from processors.reader import OutputReader  # noqa: E402
+from processors.rebuild import rebuild  # noqa: E402
+from processors.state import load_state  # noqa: E402
+
+CLOCKS = (398380640, 398380641, 398380642, 398380643)
+
+
+def make_msl_dataset(root):
+    """
+    Writes a small MSL dataset whose last file, in the second of two
+    directories, has the same spectra as the first.
+    """
+    with open(os.path.join(root, 'master.csv'), 'w') as f:
+        f.write('edr_type,spacecraft_clock,nbr_of_shots,autofocus,'
+                'distance_m,laser_energy,sol,temperature,target\n')
+        for i, clock in enumerate(CLOCKS):
+            f.write(f'cl5,{clock},4,Yes,2.5,14,{10 + i // 2},-5.5,Rock{i}\n')
+    rng = np.random.default_rng(0)
+    for i, clock in enumerate(CLOCKS):
+        sol = os.path.join(root, 'data', f'sol{10 + i // 2:05d}')
+        os.makedirs(sol, exist_ok=True)
+        path = os.path.join(sol, f'cl5_{clock}ccs_f0050104ccam01013p3.csv')
+        if i == len(CLOCKS) - 1:
+            shutil.copy(first, path)
+            continue
+        data = rng.random((64, 7))
+        data[:, 0] = np.linspace(240, 700, 64)
+        np.savetxt(path, data, delimiter=',', fmt='%.4f')
+        if i == 0:
+            first = path
+
+
+class TestRebuild(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def build(self, name, shards=None, rebuilds=1):
+        root = os.path.join(self.tmp.name, name)
+        os.makedirs(root)
+        make_msl_dataset(root)
+        config = {'name': f'Test MSL {name}', 'root_dir': root,
+                  'meta_file': 'master.csv', 'data_dir': 'data',
+                  'channels': 64, 'duplicates': 'skip', 'batch_size': 2}
+        importer = MSLProcessor(**config)
+        if shards:
+            for _ in range(rebuilds):
+                rebuild(importer, config, workers=shards, shards=shards)
+        else:
+            importer.main()
+        importer.close()
+        with OutputReader(importer.paths['output']) as reader:
+            spectra = reader.spectra()
+        meta = importer.read_metadata()
+        state = load_state(importer.paths['state'])
+        return meta, spectra, state.get('duplicates')
+
+    def test_duplicates_across_shards(self):
+        serial = self.build('serial')
+        rebuilt = self.build('rebuilt', shards=2)
+        # The duplicate is in the second shard, of a file in the first.
+        self.assertEqual(list(serial[2]), [str(CLOCKS[-1])])
+        self.assertEqual(rebuilt[2], serial[2])
+        for key in serial[0]:
+            np.testing.assert_array_equal(rebuilt[0][key], serial[0][key])
+        np.testing.assert_array_equal(rebuilt[1], serial[1])
+
+    def test_rebuilds_within_the_same_second(self):
+        serial = self.build('serial')
+        with mock.patch('processors.rebuild.strftime',
+                        return_value='20240101000000'):
+            rebuilt = self.build('rebuilt', shards=2, rebuilds=2)
+        for key in serial[0]:
+            np.testing.assert_array_equal(rebuilt[0][key], serial[0][key])
+        np.testing.assert_array_equal(rebuilt[1], serial[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
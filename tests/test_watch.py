@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import logging
+import numpy as np
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from processors.msl import MSLProcessor  # noqa: E402
+from processors.watch import watch  # noqa: E402
+
+
+def make_msl_dataset(root):
+    """
+    Writes a masterfile and one spectra file of a small MSL dataset.
+    """
+    sol = os.path.join(root, 'data', 'sol00010')
+    os.makedirs(sol)
+    with open(os.path.join(root, 'master.csv'), 'w') as f:
+        f.write('edr_type,spacecraft_clock,nbr_of_shots,autofocus,'
+                'distance_m,laser_energy,sol,temperature,target\n'
+                'cl5,398380640,4,Yes,2.5,14,10,-5.5,Rock0\n'
+                'cl5,398380641,4,Yes,2.5,14,10,-5.5,Rock1\n')
+    data = np.random.default_rng(0).random((64, 7))
+    data[:, 0] = np.linspace(240, 700, 64)
+    np.savetxt(os.path.join(sol, 'cl5_398380640ccs_f0050104ccam01013p3.csv'),
+               data, delimiter=',', fmt='%.4f')
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig()
+        self.tmp = tempfile.TemporaryDirectory()
+        make_msl_dataset(self.tmp.name)
+        self.importer = MSLProcessor(name='Test MSL', root_dir=self.tmp.name,
+                                     meta_file='master.csv', data_dir='data',
+                                     channels=64, keep_open=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_masterfile_change_reruns_once(self):
+        importer = self.importer
+        calls = []
+        main = importer.main
+
+        def counted_main():
+            calls.append(time.time())
+            main()
+
+        importer.main = counted_main
+        masterfile = importer.paths['metadata'][0]
+
+        def touch():
+            stat = os.stat(masterfile)
+            os.utime(masterfile, ns=(stat.st_atime_ns,
+                                     stat.st_mtime_ns + 10**9))
+
+        timers = [threading.Timer(0.5, touch),
+                  threading.Timer(2, os.kill,
+                                  (os.getpid(), signal.SIGINT))]
+        for timer in timers:
+            timer.start()
+        try:
+            watch([importer], settle=0.1, polling=True, interval=3600,
+                  tick=0.05)
+        finally:
+            for timer in timers:
+                timer.cancel()
+        # The initial run, and one after the masterfile changed
+        self.assertEqual(len(calls), 2)
+        self.assertFalse(importer.masterfile_changed())
+
+
+if __name__ == '__main__':
+    unittest.main()